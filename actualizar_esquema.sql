@@ -0,0 +1,548 @@
+-- Actualizacion idempotente de una base de datos existente al esquema de
+-- sistema_emergencias.sql: crea las tablas, indices, funciones y triggers
+-- que falten y sustituye las funciones por su version actual. Se puede
+-- lanzar tantas veces como se quiera.
+--
+-- alertas y asignaciones tienen que estar ya particionadas: una base de
+-- datos anterior a las particiones pasa antes por migracion_particiones.sql
+-- (que termina ejecutando este script). Parar los listeners antes:
+--     psql -d sistema_emergencias -f actualizar_esquema.sql
+--
+-- Cualquier cambio de esquema en sistema_emergencias.sql se repite aqui.
+
+BEGIN;
+
+DO $$
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = to_regclass('alertas')) IS DISTINCT FROM 'p' THEN
+        RAISE EXCEPTION 'alertas no esta particionada: ejecutar antes migracion_particiones.sql';
+    END IF;
+END;
+$$;
+
+-- Coalescencia
+ALTER TABLE alertas ADD COLUMN IF NOT EXISTS fecha_ultima_actividad TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL;
+ALTER TABLE alertas ADD COLUMN IF NOT EXISTS pulsaciones INTEGER DEFAULT 1 NOT NULL;
+
+-- Busqueda KNN del recurso disponible mas cercano
+CREATE INDEX IF NOT EXISTS idx_puntos_disponibles_ubicacion ON puntos_emergencia USING GIST(ubicacion) WHERE disponible = true;
+
+-- Telemetria y registro de dispositivos (telemetria.py)
+CREATE TABLE IF NOT EXISTS telemetria (
+    dispositivo_id VARCHAR(50) NOT NULL,
+    fecha TIMESTAMP NOT NULL,
+    latitud REAL NOT NULL,
+    longitud REAL NOT NULL,
+    bateria SMALLINT NOT NULL,
+    flags SMALLINT NOT NULL
+) PARTITION BY RANGE (fecha);
+
+CREATE TABLE IF NOT EXISTS telemetria_default PARTITION OF telemetria DEFAULT;
+
+CREATE INDEX IF NOT EXISTS idx_telemetria_dispositivo ON telemetria(dispositivo_id, fecha);
+
+CREATE TABLE IF NOT EXISTS dispositivos (
+    dispositivo_id VARCHAR(50) PRIMARY KEY,
+    primera_actividad TIMESTAMP NOT NULL,
+    ultima_actividad TIMESTAMP NOT NULL,
+    ubicacion GEOMETRY(Point, 4326) NOT NULL,
+    bateria SMALLINT NOT NULL,
+    flags SMALLINT NOT NULL,
+    uplinks BIGINT DEFAULT 0 NOT NULL,
+    CONSTRAINT chk_ubicacion_dispositivo CHECK (ST_SRID(ubicacion) = 4326)
+);
+
+CREATE INDEX IF NOT EXISTS idx_dispositivos_bateria ON dispositivos(bateria);
+
+CREATE OR REPLACE FUNCTION crear_particiones(p_desde DATE, p_hasta DATE)
+RETURNS INTEGER AS $$
+DECLARE
+    v_mes DATE := date_trunc('month', p_desde);
+    v_tabla TEXT;
+    v_particion TEXT;
+    v_creadas INTEGER := 0;
+BEGIN
+    WHILE v_mes <= p_hasta LOOP
+        FOREACH v_tabla IN ARRAY ARRAY['alertas', 'asignaciones', 'telemetria'] LOOP
+            v_particion := v_tabla || '_' || to_char(v_mes, 'YYYY_MM');
+            -- Bases de datos migradas sin telemetria: solo las tablas que existan
+            IF to_regclass(v_tabla) IS NOT NULL AND to_regclass(v_particion) IS NULL THEN
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                    v_particion, v_tabla, v_mes, (v_mes + INTERVAL '1 month')::DATE
+                );
+                v_creadas := v_creadas + 1;
+            END IF;
+        END LOOP;
+        v_mes := v_mes + INTERVAL '1 month';
+    END LOOP;
+    RETURN v_creadas;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT crear_particiones(CURRENT_DATE, (CURRENT_DATE + INTERVAL '3 months')::DATE);
+
+-- Deduplicacion persistente de uplinks
+CREATE TABLE IF NOT EXISTS uplinks_procesados (
+    uplink_id VARCHAR(100) PRIMARY KEY,
+    alerta_id INTEGER,
+    fecha_recepcion TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_uplinks_fecha ON uplinks_procesados(fecha_recepcion);
+
+CREATE OR REPLACE FUNCTION purgar_uplinks(p_antiguedad INTERVAL DEFAULT '1 day')
+RETURNS INTEGER AS $$
+DECLARE
+    v_borrados INTEGER;
+BEGIN
+    DELETE FROM uplinks_procesados
+    WHERE fecha_recepcion < CURRENT_TIMESTAMP - p_antiguedad;
+    GET DIAGNOSTICS v_borrados = ROW_COUNT;
+    RETURN v_borrados;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Capacidad de los recursos y avisos al motor de reasignacion
+CREATE OR REPLACE FUNCTION ocupar_recurso()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE puntos_emergencia 
+    SET capacidad_actual = capacidad_actual + 1,
+        disponible = (capacidad_actual + 1 < capacidad_maxima)
+    WHERE id = NEW.punto_emergencia_id;
+    
+    UPDATE alertas 
+    SET estado = 'asignada'
+    WHERE id = NEW.alerta_id;
+    
+    -- En lugar de la clave ajena (ver asignaciones)
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'La alerta % no existe', NEW.alerta_id
+            USING ERRCODE = 'foreign_key_violation';
+    END IF;
+    
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_ocupar_recurso ON asignaciones;
+CREATE TRIGGER trg_ocupar_recurso
+    AFTER INSERT ON asignaciones
+    FOR EACH ROW EXECUTE FUNCTION ocupar_recurso();
+
+CREATE OR REPLACE FUNCTION liberar_recurso()
+RETURNS TRIGGER AS $$
+DECLARE
+    r RECORD;
+BEGIN
+    FOR r IN
+        UPDATE puntos_emergencia pe
+        SET capacidad_actual = GREATEST(capacidad_actual - 1, 0),
+            disponible = (GREATEST(capacidad_actual - 1, 0) < capacidad_maxima)
+        WHERE pe.id IN (
+            -- La asignacion es posterior a la alerta: solo sus particiones
+            SELECT punto_emergencia_id 
+            FROM asignaciones 
+            WHERE alerta_id = NEW.id AND fecha_asignacion >= NEW.fecha_creacion
+        )
+        RETURNING pe.id, pe.tipo, ST_X(pe.ubicacion) AS lon, ST_Y(pe.ubicacion) AS lat,
+                  pe.capacidad_maxima - pe.capacidad_actual AS libres
+    LOOP
+        PERFORM pg_notify('recursos_liberados', json_build_object(
+            'id', r.id,
+            'tipo', r.tipo,
+            'lon', r.lon,
+            'lat', r.lat,
+            'libres', r.libres
+        )::text);
+    END LOOP;
+    
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_liberar_recurso ON alertas;
+CREATE TRIGGER trg_liberar_recurso
+    AFTER UPDATE OF estado ON alertas
+    FOR EACH ROW
+    WHEN (NEW.estado = 'resuelta' AND OLD.estado <> 'resuelta')
+    EXECUTE FUNCTION liberar_recurso();
+
+CREATE OR REPLACE FUNCTION borrar_asignaciones()
+RETURNS TRIGGER AS $$
+BEGIN
+    DELETE FROM asignaciones
+    WHERE alerta_id = OLD.id AND fecha_asignacion >= OLD.fecha_creacion;
+    
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_borrar_asignaciones ON alertas;
+CREATE TRIGGER trg_borrar_asignaciones
+    AFTER DELETE ON alertas
+    FOR EACH ROW EXECUTE FUNCTION borrar_asignaciones();
+
+CREATE OR REPLACE FUNCTION avisar_pendientes(p_ids INTEGER[])
+RETURNS INTEGER AS $$
+DECLARE
+    v_avisadas INTEGER;
+BEGIN
+    PERFORM pg_notify('alertas_pendientes', json_build_object(
+        'id', a.id,
+        'tipo', a.tipo,
+        'lon', ST_X(a.ubicacion),
+        'lat', ST_Y(a.ubicacion),
+        'fecha', EXTRACT(EPOCH FROM a.fecha_creacion::TIMESTAMPTZ)
+    )::text)
+    FROM alertas a
+    WHERE a.id = ANY(p_ids) AND a.estado = 'pendiente';
+    GET DIAGNOSTICS v_avisadas = ROW_COUNT;
+    RETURN v_avisadas;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Indice de recursos en memoria (LISTEN/NOTIFY)
+CREATE OR REPLACE FUNCTION notificar_recurso()
+RETURNS TRIGGER AS $$
+DECLARE
+    r puntos_emergencia;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        r := OLD;
+    ELSE
+        r := NEW;
+    END IF;
+    
+    PERFORM pg_notify('recursos_emergencia', json_build_object(
+        'operacion', TG_OP,
+        'id', r.id,
+        'codigo', r.codigo,
+        'nombre', r.nombre,
+        'tipo', r.tipo,
+        'municipio', r.municipio,
+        'telefono', r.telefono,
+        'lon', ST_X(r.ubicacion),
+        'lat', ST_Y(r.ubicacion),
+        'capacidad_actual', r.capacidad_actual,
+        'capacidad_maxima', r.capacidad_maxima,
+        'disponible', r.disponible,
+        'velocidad_promedio_kmh', r.velocidad_promedio_kmh,
+        'tiempo_preparacion_segundos', r.tiempo_preparacion_segundos
+    )::text);
+    
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_notificar_recurso ON puntos_emergencia;
+CREATE TRIGGER trg_notificar_recurso
+    AFTER INSERT OR UPDATE OR DELETE ON puntos_emergencia
+    FOR EACH ROW EXECUTE FUNCTION notificar_recurso();
+
+-- Instantanea de lectura (consultas.py)
+CREATE OR REPLACE FUNCTION notificar_alerta()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM pg_notify('alertas_eventos', json_build_object(
+            'evento', 'alta',
+            'id', NEW.id,
+            'dispositivo_id', NEW.dispositivo_id,
+            'tipo', NEW.tipo,
+            'estado', NEW.estado,
+            'lon', ST_X(NEW.ubicacion),
+            'lat', ST_Y(NEW.ubicacion),
+            'fecha', EXTRACT(EPOCH FROM NEW.fecha_creacion::TIMESTAMPTZ)
+        )::text);
+    ELSE
+        PERFORM pg_notify('alertas_eventos', json_build_object(
+            'evento', 'resuelta',
+            'id', NEW.id
+        )::text);
+    END IF;
+    
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_notificar_alerta_alta ON alertas;
+-- Las historicas (reimportar.py) entran ya resueltas: ni se publican ni
+-- generan un NOTIFY por fila en la carga
+CREATE TRIGGER trg_notificar_alerta_alta
+    AFTER INSERT ON alertas
+    FOR EACH ROW
+    WHEN (NEW.estado <> 'resuelta')
+    EXECUTE FUNCTION notificar_alerta();
+
+DROP TRIGGER IF EXISTS trg_notificar_alerta_resuelta ON alertas;
+CREATE TRIGGER trg_notificar_alerta_resuelta
+    AFTER UPDATE OF estado ON alertas
+    FOR EACH ROW
+    WHEN (NEW.estado = 'resuelta' AND OLD.estado <> 'resuelta')
+    EXECUTE FUNCTION notificar_alerta();
+
+CREATE OR REPLACE FUNCTION notificar_asignacion()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('alertas_eventos', json_build_object(
+        'evento', 'asignacion',
+        'id', NEW.alerta_id,
+        'recurso_id', NEW.punto_emergencia_id,
+        'distancia_metros', NEW.distancia_metros,
+        'tiempo_estimado_segundos', NEW.tiempo_estimado_segundos,
+        'fecha', EXTRACT(EPOCH FROM NEW.fecha_asignacion::TIMESTAMPTZ)
+    )::text);
+    
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_notificar_asignacion ON asignaciones;
+CREATE TRIGGER trg_notificar_asignacion
+    AFTER INSERT ON asignaciones
+    FOR EACH ROW EXECUTE FUNCTION notificar_asignacion();
+
+-- Mapa de calor (mapa_calor.py)
+CREATE TABLE IF NOT EXISTS mapa_alertas (
+    hora TIMESTAMP NOT NULL,
+    tipo tipo_emergencia NOT NULL,
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    PRIMARY KEY (hora, tipo, x, y)
+);
+
+CREATE OR REPLACE FUNCTION celda_mapa(p_coordenada DOUBLE PRECISION)
+RETURNS INTEGER AS $$
+    SELECT floor(p_coordenada / 0.01)::INTEGER;
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION coordenada_mapa(p_celda INTEGER)
+RETURNS DOUBLE PRECISION AS $$
+    SELECT p_celda * 0.01::DOUBLE PRECISION;
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION acumular_mapa()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO mapa_alertas (hora, tipo, x, y, total)
+    SELECT
+        date_trunc('hour', fecha_creacion),
+        tipo,
+        celda_mapa(ST_X(ubicacion)),
+        celda_mapa(ST_Y(ubicacion)),
+        COUNT(*)
+    FROM nuevas
+    GROUP BY 1, 2, 3, 4
+    ORDER BY 1, 2, 3, 4
+    ON CONFLICT (hora, tipo, x, y) DO UPDATE
+    SET total = mapa_alertas.total + EXCLUDED.total;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_acumular_mapa ON alertas;
+CREATE TRIGGER trg_acumular_mapa
+    AFTER INSERT ON alertas
+    REFERENCING NEW TABLE AS nuevas
+    FOR EACH STATEMENT EXECUTE FUNCTION acumular_mapa();
+
+CREATE OR REPLACE FUNCTION recalcular_mapa(p_desde TIMESTAMP, p_hasta TIMESTAMP)
+RETURNS INTEGER AS $$
+DECLARE
+    v_celdas INTEGER;
+BEGIN
+    DELETE FROM mapa_alertas
+    WHERE hora >= date_trunc('hour', p_desde) AND hora < p_hasta
+      AND hora >= (SELECT date_trunc('hour', MIN(fecha_creacion)) FROM alertas);
+
+    INSERT INTO mapa_alertas (hora, tipo, x, y, total)
+    SELECT
+        date_trunc('hour', fecha_creacion),
+        tipo,
+        celda_mapa(ST_X(ubicacion)),
+        celda_mapa(ST_Y(ubicacion)),
+        COUNT(*)
+    FROM alertas
+    WHERE fecha_creacion >= date_trunc('hour', p_desde) AND fecha_creacion < p_hasta
+    GROUP BY 1, 2, 3, 4;
+
+    GET DIAGNOSTICS v_celdas = ROW_COUNT;
+    RETURN v_celdas;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION mapa_calor(
+    p_oeste DOUBLE PRECISION,
+    p_sur DOUBLE PRECISION,
+    p_este DOUBLE PRECISION,
+    p_norte DOUBLE PRECISION,
+    p_desde TIMESTAMP,
+    p_hasta TIMESTAMP,
+    p_tipo tipo_emergencia DEFAULT NULL,
+    p_agrupar INTEGER DEFAULT 1
+)
+RETURNS TABLE (
+    oeste DOUBLE PRECISION,
+    sur DOUBLE PRECISION,
+    este DOUBLE PRECISION,
+    norte DOUBLE PRECISION,
+    total BIGINT
+) AS $$
+    SELECT
+        coordenada_mapa(t.tx * p_agrupar),
+        coordenada_mapa(t.ty * p_agrupar),
+        coordenada_mapa((t.tx + 1) * p_agrupar),
+        coordenada_mapa((t.ty + 1) * p_agrupar),
+        SUM(t.total)
+    FROM (
+        SELECT
+            floor(m.x::DOUBLE PRECISION / p_agrupar)::INTEGER AS tx,
+            floor(m.y::DOUBLE PRECISION / p_agrupar)::INTEGER AS ty,
+            m.total
+        FROM mapa_alertas m
+        WHERE m.hora >= date_trunc('hour', p_desde) AND m.hora < p_hasta
+          AND (p_tipo IS NULL OR m.tipo = p_tipo)
+          AND m.x BETWEEN celda_mapa(p_oeste) AND celda_mapa(p_este)
+          AND m.y BETWEEN celda_mapa(p_sur) AND celda_mapa(p_norte)
+    ) t
+    GROUP BY t.tx, t.ty;
+$$ LANGUAGE sql STABLE;
+
+-- Mapa recien creado: se rellena con las alertas que ya hay
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM mapa_alertas) THEN
+        PERFORM recalcular_mapa(
+            COALESCE((SELECT MIN(fecha_creacion) FROM alertas), CURRENT_TIMESTAMP::TIMESTAMP),
+            (CURRENT_TIMESTAMP + INTERVAL '1 hour')::TIMESTAMP
+        );
+    END IF;
+END;
+$$;
+
+-- Ruta rapida: las firmas anteriores convivirian con la nueva (sobrecarga)
+-- y harian ambiguas las llamadas
+DROP FUNCTION IF EXISTS registrar_y_asignar(VARCHAR, tipo_emergencia, DOUBLE PRECISION, DOUBLE PRECISION);
+DROP FUNCTION IF EXISTS registrar_y_asignar(VARCHAR, tipo_emergencia, DOUBLE PRECISION, DOUBLE PRECISION, INTEGER);
+DROP FUNCTION IF EXISTS registrar_y_asignar(VARCHAR, tipo_emergencia, DOUBLE PRECISION, DOUBLE PRECISION, INTEGER, VARCHAR);
+DROP FUNCTION IF EXISTS registrar_y_asignar(VARCHAR, tipo_emergencia, DOUBLE PRECISION, DOUBLE PRECISION, INTEGER, VARCHAR, INTERVAL);
+
+CREATE OR REPLACE FUNCTION registrar_y_asignar(
+    p_dispositivo_id VARCHAR,
+    p_tipo tipo_emergencia,
+    p_longitud DOUBLE PRECISION,
+    p_latitud DOUBLE PRECISION,
+    p_candidatos INTEGER DEFAULT 10,
+    p_uplink_id VARCHAR DEFAULT NULL,
+    p_ventana INTERVAL DEFAULT '1 day',
+    p_reasignacion BOOLEAN DEFAULT false
+)
+RETURNS TABLE (
+    alerta_id INTEGER,
+    id INTEGER,
+    nombre VARCHAR,
+    codigo VARCHAR,
+    municipio VARCHAR,
+    telefono VARCHAR,
+    distancia_metros DOUBLE PRECISION,
+    tiempo_estimado_segundos INTEGER
+) AS $$
+#variable_conflict use_column
+DECLARE
+    v_ubicacion GEOMETRY := ST_SetSRID(ST_MakePoint(p_longitud, p_latitud), 4326);
+    r RECORD;
+BEGIN
+    -- Uplink ya registrado dentro de la ventana: se devuelve una fila vacia
+    -- (alerta_id NULL). Uno mas antiguo es otro uplink con el mismo fCnt
+    -- (el dispositivo se reinicio) y se vuelve a registrar
+    IF p_uplink_id IS NOT NULL THEN
+        INSERT INTO uplinks_procesados AS u (uplink_id)
+        VALUES (p_uplink_id)
+        ON CONFLICT (uplink_id) DO UPDATE
+        SET alerta_id = NULL, fecha_recepcion = EXCLUDED.fecha_recepcion
+        WHERE u.fecha_recepcion < CURRENT_TIMESTAMP - p_ventana;
+        
+        IF NOT FOUND THEN
+            RETURN NEXT;
+            RETURN;
+        END IF;
+    END IF;
+    
+    INSERT INTO alertas (dispositivo_id, tipo, ubicacion)
+    VALUES (p_dispositivo_id, p_tipo, v_ubicacion)
+    RETURNING alertas.id INTO alerta_id;
+    
+    IF p_uplink_id IS NOT NULL THEN
+        UPDATE uplinks_procesados u
+        SET alerta_id = registrar_y_asignar.alerta_id
+        WHERE u.uplink_id = p_uplink_id;
+    END IF;
+    
+    -- KNN sobre el indice GIST y distancia geodesica solo en los candidatos.
+    -- Se reclama el primero que se pueda bloquear y siga disponible.
+    FOR r IN
+        SELECT 
+            pe.id,
+            pe.nombre,
+            pe.codigo,
+            pe.municipio,
+            pe.telefono,
+            ST_Distance(pe.ubicacion::geography, v_ubicacion::geography) AS distancia_metros,
+            pe.velocidad_promedio_kmh,
+            pe.tiempo_preparacion_segundos
+        FROM (
+            SELECT *
+            FROM puntos_emergencia c
+            WHERE 
+                c.tipo = p_tipo
+                AND c.disponible = true
+            ORDER BY c.ubicacion <-> v_ubicacion
+            LIMIT p_candidatos
+        ) pe
+        ORDER BY 6 ASC
+    LOOP
+        PERFORM 1
+        FROM puntos_emergencia c
+        WHERE c.id = r.id AND c.disponible = true
+        FOR UPDATE SKIP LOCKED;
+        
+        IF FOUND THEN
+            id := r.id;
+            nombre := r.nombre;
+            codigo := r.codigo;
+            municipio := r.municipio;
+            telefono := r.telefono;
+            distancia_metros := r.distancia_metros;
+            tiempo_estimado_segundos := (
+                (r.distancia_metros / 1000.0) / 
+                (r.velocidad_promedio_kmh / 60.0) * 60 + 
+                r.tiempo_preparacion_segundos
+            )::INTEGER;
+            
+            INSERT INTO asignaciones (
+                alerta_id,
+                punto_emergencia_id,
+                distancia_metros,
+                tiempo_estimado_segundos
+            ) VALUES (alerta_id, id, distancia_metros, tiempo_estimado_segundos);
+            
+            EXIT;
+        END IF;
+    END LOOP;
+    
+    -- Sin recurso: queda pendiente para el motor de reasignacion (si lo hay)
+    IF id IS NULL AND p_reasignacion THEN
+        PERFORM avisar_pendientes(ARRAY[alerta_id]);
+    END IF;
+    
+    RETURN NEXT;
+END;
+$$ LANGUAGE plpgsql;
+
+COMMIT;
+
+SELECT 'Esquema actualizado' AS estado;
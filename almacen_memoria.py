@@ -0,0 +1,326 @@
+"""
+Almacen en memoria para SistemaEmergencias
+Sustituye a PostgreSQL/PostGIS para medir y probar la parte Python del
+sistema (decodificacion, reparto, resultados) sin base de datos
+"""
+
+import csv
+import itertools
+import logging
+import random
+import re
+import threading
+from datetime import datetime, timedelta
+
+from cache_recursos import IndiceRecursos, CANAL_RECURSOS
+from integracion import RESULTADO_DUPLICADO, UplinkDuplicado, construir_resultado
+from tiempos_viaje import ordenar_por_tiempo
+from despacho import OPTIMO, VORAZ, repartir_optimo
+
+logger = logging.getLogger(__name__)
+
+# Caja aproximada de Las Hurdes (puntos sinteticos)
+LON_MIN, LON_MAX = -6.45, -6.10
+LAT_MIN, LAT_MAX = 40.25, 40.50
+
+TIPOS = ('medica', 'policial', 'bomberos', 'rescate')
+
+_PUNTO = re.compile(r"ST_SetSRID\(ST_MakePoint\(\s*([-\d.]+)\s*,\s*([-\d.]+)\s*\)\s*,\s*4326\)")
+_INSERT_PUNTOS = re.compile(
+    r"INSERT INTO puntos_emergencia\s*\(([^)]*)\)\s*VALUES\s*(.*?);",
+    re.DOTALL
+)
+
+
+class AlmacenMemoria:
+    """
+    Tablas alertas, puntos_emergencia, asignaciones y uplinks_procesados en
+    diccionarios, con la semantica de los triggers de sistema_emergencias.sql:
+    una asignacion ocupa una plaza del recurso (y lo marca no disponible al
+    llenarse) y pasa la alerta a 'asignada'; resolver la alerta libera la plaza.
+
+    Implementa los pasos de acceso a datos de SistemaEmergencias
+    (_registrar_alerta, _asignar_recurso, _registrar_y_asignar,
+    _actualizar_incidente, _resolver_alerta, _procesar_lote) con los mismos
+    argumentos salvo el cursor. El recurso mas cercano se busca con
+    IndiceRecursos (haversine), que el almacen mantiene al dia como lo haria
+    el trigger notificar_recurso; con una rejilla de tiempos de viaje, entre
+    los `knn_candidatos` mas cercanos se elige el que antes llega. Con
+    despacho 'optimo' los lotes se reparten con despacho.repartir_optimo.
+    """
+
+    def __init__(self, celda_grados: float = 0.05, tiempos=None, knn_candidatos: int = 10,
+                 despacho: str = VORAZ, despacho_max_celdas: int = 1_000_000,
+                 dedup_ventana_segundos: float = 86400):
+        self.puntos = {}
+        self.alertas = {}
+        self.asignaciones = {}
+        self.uplinks = {}
+        self._ventana_uplinks = timedelta(seconds=dedup_ventana_segundos)
+
+        self._indice = IndiceRecursos(celda_grados)
+        self._indice.cargado = True
+        self._tiempos = tiempos
+        self._knn_candidatos = knn_candidatos
+        self._despacho = despacho
+        self._despacho_max_celdas = despacho_max_celdas
+        self._lock = threading.Lock()
+        self._ids_alerta = itertools.count(1)
+        self._ids_asignacion = itertools.count(1)
+
+    # Carga de recursos
+
+    def cargar_puntos(self, puntos: list):
+        """Anade recursos (diccionarios con los campos de puntos_emergencia, lat y lon)"""
+        with self._lock:
+            for punto in puntos:
+                punto = dict(punto)
+                punto.setdefault('id', len(self.puntos) + 1)
+                punto.setdefault('telefono', None)
+                punto.setdefault('capacidad_actual', 0)
+                punto.setdefault('capacidad_maxima', 5)
+                punto.setdefault('velocidad_promedio_kmh', 50.0)
+                punto.setdefault('tiempo_preparacion_segundos', 180)
+                punto['disponible'] = punto['capacidad_actual'] < punto['capacidad_maxima']
+                self.puntos[punto['id']] = punto
+                self._notificar(punto)
+
+        logger.info(f"Almacen en memoria: {len(self.puntos)} puntos de emergencia")
+
+    def cargar_sql(self, ruta: str = 'sistema_emergencias.sql'):
+        """Carga los recursos de los INSERT INTO puntos_emergencia del script SQL"""
+        with open(ruta, encoding='utf-8') as f:
+            script = f.read()
+
+        puntos = []
+        for columnas, valores in _INSERT_PUNTOS.findall(script):
+            columnas = [c.strip() for c in columnas.split(',')]
+            for fila in re.findall(r"\((.*)\)", valores):
+                # La ubicacion ocupa una columna: se sustituye por "lon lat"
+                fila = _PUNTO.sub(lambda m: f"'{m.group(1)} {m.group(2)}'", fila)
+                campos = dict(zip(columnas, next(csv.reader([fila], quotechar="'", skipinitialspace=True))))
+
+                lon, lat = campos.pop('ubicacion').split()
+                punto = {'lon': float(lon), 'lat': float(lat)}
+                for columna, valor in campos.items():
+                    if columna in ('capacidad_maxima', 'capacidad_actual', 'tiempo_preparacion_segundos'):
+                        valor = int(valor)
+                    elif columna == 'velocidad_promedio_kmh':
+                        valor = float(valor)
+                    punto[columna] = valor
+                puntos.append(punto)
+
+        self.cargar_puntos(puntos)
+
+    def generar_puntos(self, n: int, semilla: int = None, capacidad: int = None):
+        """Anade n recursos sinteticos repartidos por Las Hurdes (capacidad fija o 1-5)"""
+        aleatorio = random.Random(semilla)
+        inicio = len(self.puntos)
+        self.cargar_puntos([
+            {
+                'codigo': f"SIM-{inicio + i:06d}",
+                'nombre': f"Recurso simulado {inicio + i}",
+                'tipo': aleatorio.choice(TIPOS),
+                'municipio': 'Simulado',
+                'lat': aleatorio.uniform(LAT_MIN, LAT_MAX),
+                'lon': aleatorio.uniform(LON_MIN, LON_MAX),
+                'capacidad_maxima': capacidad or aleatorio.randint(1, 5),
+                'velocidad_promedio_kmh': aleatorio.uniform(40.0, 60.0),
+                'tiempo_preparacion_segundos': aleatorio.randint(180, 420)
+            }
+            for i in range(n)
+        ])
+
+    # Pasos de SistemaEmergencias
+
+    def registrar_alerta(self, dispositivo_id: str, tipo: str, latitud: float,
+                         longitud: float, uplink_id: str = None) -> int:
+        with self._lock:
+            return self._insertar_alerta(dispositivo_id, tipo, latitud, longitud, uplink_id)
+
+    def asignar_recurso(self, alerta_id: int, tipo: str, latitud: float,
+                        longitud: float) -> dict:
+        with self._lock:
+            return self._asignar(alerta_id, tipo, latitud, longitud)
+
+    def registrar_y_asignar(self, dispositivo_id: str, tipo: str, latitud: float,
+                            longitud: float, uplink_id: str = None) -> dict:
+        """Como la funcion registrar_y_asignar: fila con alerta_id y el recurso (o None)"""
+        fila = dict.fromkeys((
+            'alerta_id', 'id', 'nombre', 'codigo', 'municipio', 'telefono',
+            'distancia_metros', 'tiempo_estimado_segundos'
+        ))
+        with self._lock:
+            try:
+                alerta_id = self._insertar_alerta(dispositivo_id, tipo, latitud, longitud, uplink_id)
+            except UplinkDuplicado:
+                return fila
+            fila.update(self._asignar(alerta_id, tipo, latitud, longitud) or {})
+            fila['alerta_id'] = alerta_id
+        return fila
+
+    def actualizar_incidente(self, alerta_id: int, latitud: float, longitud: float,
+                             uplink_id: str = None) -> bool:
+        with self._lock:
+            alerta = self.alertas.get(alerta_id)
+            self._comprobar_uplink(uplink_id)
+            if alerta is None or alerta['estado'] == 'resuelta':
+                return False
+
+            if uplink_id is not None:
+                self.uplinks[uplink_id] = (alerta_id, datetime.now())
+            alerta['latitud'] = latitud
+            alerta['longitud'] = longitud
+            alerta['fecha_ultima_actividad'] = datetime.now()
+            alerta['pulsaciones'] += 1
+            return True
+
+    def resolver_alerta(self, alerta_id: int) -> bool:
+        with self._lock:
+            alerta = self.alertas.get(alerta_id)
+            if alerta is None or alerta['estado'] == 'resuelta':
+                logger.warning(f"Alerta {alerta_id} no encontrada o ya estaba resuelta")
+                return False
+
+            alerta['estado'] = 'resuelta'
+            # Trigger liberar_recurso
+            for asignacion in self.asignaciones.get(alerta_id, ()):
+                punto = self.puntos[asignacion['punto_emergencia_id']]
+                punto['capacidad_actual'] = max(punto['capacidad_actual'] - 1, 0)
+                punto['disponible'] = punto['capacidad_actual'] < punto['capacidad_maxima']
+                self._notificar(punto)
+
+        logger.info(f"Alerta {alerta_id} resuelta, recurso liberado")
+        return True
+
+    def procesar_lote(self, alertas: list) -> list:
+        """Registra y asigna el lote en orden de llegada, con un solo bloqueo"""
+        if self._despacho == OPTIMO:
+            return self._procesar_lote_optimo(alertas)
+
+        resultados = []
+        with self._lock:
+            for dispositivo_id, datos, uplink_id in alertas:
+                try:
+                    alerta_id = self._insertar_alerta(
+                        dispositivo_id, datos['tipo'], datos['latitud'], datos['longitud'], uplink_id
+                    )
+                except UplinkDuplicado:
+                    resultados.append(dict(RESULTADO_DUPLICADO))
+                    continue
+                recurso = self._asignar(alerta_id, datos['tipo'], datos['latitud'], datos['longitud'])
+                resultados.append((alerta_id, dispositivo_id, datos['tipo'], recurso))
+
+        return [
+            construir_resultado(*r) if isinstance(r, tuple) else r
+            for r in resultados
+        ]
+
+    def _procesar_lote_optimo(self, alertas: list) -> list:
+        """Registra el lote y lo reparte entero de una vez (ver despacho.py)"""
+        resultados = []
+        with self._lock:
+            registradas = []
+            for dispositivo_id, datos, uplink_id in alertas:
+                try:
+                    alerta_id = self._insertar_alerta(
+                        dispositivo_id, datos['tipo'], datos['latitud'], datos['longitud'], uplink_id
+                    )
+                except UplinkDuplicado:
+                    resultados.append(dict(RESULTADO_DUPLICADO))
+                    continue
+                registradas.append((alerta_id, dispositivo_id, datos))
+                resultados.append(len(registradas) - 1)
+
+            candidatos = {
+                i: self._candidatos(datos['tipo'], datos['latitud'], datos['longitud'])
+                for i, (_, _, datos) in enumerate(registradas)
+            }
+            recursos = {
+                fila['id']: dict(self.puntos[fila['id']], libres=self._libres(fila['id']))
+                for filas in candidatos.values() for fila in filas
+            }
+            asignaciones = repartir_optimo(
+                [(datos['tipo'], datos['latitud'], datos['longitud']) for _, _, datos in registradas],
+                recursos, candidatos, self._despacho_max_celdas
+            )
+            for i, recurso in asignaciones.items():
+                self._ocupar(registradas[i][0], recurso)
+
+        return [
+            construir_resultado(*registradas[r][:2], registradas[r][2]['tipo'], asignaciones.get(r))
+            if isinstance(r, int) else r
+            for r in resultados
+        ]
+
+    # Internos (con el bloqueo tomado)
+
+    def _comprobar_uplink(self, uplink_id):
+        """UplinkDuplicado si se registro dentro de la ventana"""
+        if uplink_id is None or uplink_id not in self.uplinks:
+            return
+        if datetime.now() - self.uplinks[uplink_id][1] < self._ventana_uplinks:
+            raise UplinkDuplicado(uplink_id)
+
+    def _insertar_alerta(self, dispositivo_id, tipo, latitud, longitud, uplink_id):
+        self._comprobar_uplink(uplink_id)
+
+        alerta_id = next(self._ids_alerta)
+        ahora = datetime.now()
+        self.alertas[alerta_id] = {
+            'id': alerta_id,
+            'dispositivo_id': dispositivo_id,
+            'tipo': tipo,
+            'latitud': latitud,
+            'longitud': longitud,
+            'estado': 'pendiente',
+            'fecha_creacion': ahora,
+            'fecha_ultima_actividad': ahora,
+            'pulsaciones': 1
+        }
+        if uplink_id is not None:
+            self.uplinks[uplink_id] = (alerta_id, ahora)
+        return alerta_id
+
+    def _asignar(self, alerta_id, tipo, latitud, longitud):
+        if self._tiempos is not None:
+            candidatos = self._candidatos(tipo, latitud, longitud)
+            recurso = candidatos[0] if candidatos else None
+        else:
+            recurso = self._indice.mas_cercano(tipo, latitud, longitud)
+        if recurso is None:
+            return None
+
+        self._ocupar(alerta_id, recurso)
+        return recurso
+
+    def _candidatos(self, tipo, latitud, longitud):
+        candidatos = self._indice.candidatos(tipo, latitud, longitud, self._knn_candidatos)
+        if self._tiempos is not None:
+            candidatos = ordenar_por_tiempo(self._tiempos, candidatos, latitud, longitud)
+        return candidatos
+
+    def _libres(self, recurso_id):
+        punto = self.puntos[recurso_id]
+        return punto['capacidad_maxima'] - punto['capacidad_actual']
+
+    def _ocupar(self, alerta_id, recurso):
+        self.asignaciones.setdefault(alerta_id, []).append({
+            'id': next(self._ids_asignacion),
+            'alerta_id': alerta_id,
+            'punto_emergencia_id': recurso['id'],
+            'distancia_metros': round(recurso['distancia_metros'], 2),
+            'tiempo_estimado_segundos': recurso['tiempo_estimado_segundos'],
+            'fecha_asignacion': datetime.now()
+        })
+
+        # Trigger ocupar_recurso
+        punto = self.puntos[recurso['id']]
+        punto['capacidad_actual'] += 1
+        punto['disponible'] = punto['capacidad_actual'] < punto['capacidad_maxima']
+        self._notificar(punto)
+        self.alertas[alerta_id]['estado'] = 'asignada'
+
+    def _notificar(self, punto: dict):
+        """Equivalente al trigger notificar_recurso"""
+        self._indice.actualizar(CANAL_RECURSOS, dict(punto, operacion='UPDATE'))
@@ -0,0 +1,502 @@
+"""
+Variante asyncio del listener y del sistema de emergencias
+Un solo proceso mantiene cientos de alertas en vuelo mientras espera a la BD,
+sin un hilo por conexion. Necesita asyncpg y aiomqtt.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import random
+import signal
+import sys
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+try:
+    import aiomqtt
+except ImportError:
+    aiomqtt = None
+
+from decoder import PayloadDecoder
+from deduplicacion import CacheDeduplicacion, clave_persistente, clave_uplink
+from integracion import (
+    CONSULTA_CANDIDATOS,
+    CONSULTA_RECURSO_CERCANO,
+    RESULTADO_DUPLICADO,
+    UplinkDuplicado,
+    alerta_registrada,
+    construir_resultado,
+    contar_resultado
+)
+from metricas import METRICAS
+from telemetria import TELEMETRIA
+from tiempos_viaje import RejillaTiempos, ordenar_por_tiempo
+
+if sys.platform == 'win32':
+    os.environ['PGCLIENTENCODING'] = 'UTF8'
+    os.environ['PYTHONIOENCODING'] = 'utf-8'
+
+logger = logging.getLogger(__name__)
+
+
+def _posicional(consulta: str, nombres: tuple) -> str:
+    """Pasa los parametros %(nombre)s de psycopg2 a $n de asyncpg"""
+    for i, nombre in enumerate(nombres, 1):
+        consulta = consulta.replace(f"%({nombre})s", f"${i}")
+    return consulta
+
+
+_PARAMETROS_CANDIDATOS = ('tipo', 'latitud', 'longitud', 'candidatos')
+
+CONSULTA_CANDIDATOS_ASYNC = _posicional(CONSULTA_CANDIDATOS, _PARAMETROS_CANDIDATOS)
+CONSULTA_RECURSO_CERCANO_ASYNC = _posicional(CONSULTA_RECURSO_CERCANO, _PARAMETROS_CANDIDATOS)
+
+# Errores tras los que merece la pena repetir con otra conexion del pool
+_ERRORES_CONEXION = (OSError, asyncio.TimeoutError)
+if asyncpg is not None:
+    _ERRORES_CONEXION += (asyncpg.PostgresConnectionError, asyncpg.InterfaceError)
+
+
+class SistemaEmergenciasAsync:
+    """
+    Equivalente de SistemaEmergencias sobre un pool de asyncpg.
+
+    procesar_alerta y resolver_alerta son corrutinas con la misma semantica
+    y los mismos resultados que las sincronas. Respeta 'ruta_rapida',
+    'knn_candidatos', 'dedup_persistente', 'dedup_ventana_segundos', 'asignacion_concurrente' y
+    'reintentos_asignacion', 'tiempos_viaje' y 'reasignacion' de db_config; el indice de recursos y la
+    coalescencia solo existen en la variante sincrona (se avisa si estan activados).
+    """
+
+    def __init__(self, db_config: dict):
+        if asyncpg is None:
+            raise ImportError("SistemaEmergenciasAsync necesita asyncpg (pip install asyncpg)")
+
+        self.db_config = db_config
+        self.decoder = PayloadDecoder()
+        self.pool = None
+
+        self.ruta_rapida = db_config.get('ruta_rapida', False)
+        self.knn_candidatos = db_config.get('knn_candidatos', 10)
+        self.dedup_persistente = db_config.get('dedup_persistente', False)
+        self.dedup_ventana = float(db_config.get('dedup_ventana_segundos', 86400))
+        self.asignacion_concurrente = db_config.get('asignacion_concurrente', False)
+        self.reintentos_asignacion = db_config.get('reintentos_asignacion', 5)
+        self.reasignacion = db_config.get('reasignacion', False)
+
+        # Con el mismo DB_CONFIG la variante sincrona agruparia las pulsaciones
+        # repetidas; aqui cada una crea alerta
+        for clave in ('coalescencia', 'cache_recursos'):
+            if db_config.get(clave):
+                logger.warning(f"'{clave}' no esta disponible en la variante asincrona, se ignora")
+
+        # Lectura por mmap: no bloquea el bucle de forma apreciable
+        self.tiempos = None
+        if db_config.get('tiempos_viaje'):
+            self.tiempos = RejillaTiempos(db_config['tiempos_viaje'])
+
+    async def conectar_bd(self) -> bool:
+        """Crea el pool de conexiones"""
+        try:
+            pool_max = self.db_config.get('pool_max') or 10
+            self.pool = await asyncpg.create_pool(
+                host=self.db_config['host'],
+                port=self.db_config.get('port', 5432),
+                database=self.db_config['database'],
+                user=self.db_config['user'],
+                password=self.db_config['password'],
+                min_size=self.db_config.get('pool_min') or pool_max,
+                max_size=pool_max,
+                server_settings={'client_encoding': 'UTF8'}
+            )
+            logger.info(f"Pool asincrono de conexiones a BD: {self.db_config['database']} (max {pool_max})")
+            return True
+        except Exception as e:
+            logger.error(f"Error conectando a BD: {e}")
+            return False
+
+    async def desconectar_bd(self):
+        if self.pool:
+            await self.pool.close()
+            self.pool = None
+        logger.info("Desconectado de BD")
+
+    async def procesar_alerta(self, dispositivo_id: str, payload_base64: str,
+                              uplink_id: str = None) -> dict:
+        """Decodifica, registra y asigna recurso (ver SistemaEmergencias.procesar_alerta)"""
+        logger.debug("Procesando alerta de dispositivo: %s", dispositivo_id)
+
+        datos = self.decoder.decode(payload_base64)
+        if not datos:
+            return {'exito': False, 'error': 'Payload invalido'}
+        TELEMETRIA.registrar(dispositivo_id, datos)
+
+        uplink_id = clave_persistente(uplink_id) if self.dedup_persistente else None
+
+        try:
+            return await self._procesar_datos(dispositivo_id, datos, uplink_id)
+        except Exception as e:
+            logger.error(f"Error procesando alerta en BD: {e}")
+            return {'exito': False, 'error': 'Error en BD'}
+
+    async def resolver_alerta(self, alerta_id: int) -> bool:
+        """Marca una alerta como resuelta (el trigger libera el recurso)"""
+        try:
+            fila = await self._con_reintento(
+                lambda conn: conn.fetchrow("""
+                    UPDATE alertas
+                    SET estado = 'resuelta'
+                    WHERE id = $1 AND estado != 'resuelta'
+                    RETURNING id
+                """, alerta_id)
+            )
+        except Exception as e:
+            logger.error(f"Error resolviendo alerta: {e}")
+            return False
+
+        if fila:
+            logger.info(f"Alerta {alerta_id} resuelta, recurso liberado")
+            return True
+        logger.warning(f"Alerta {alerta_id} no encontrada o ya estaba resuelta")
+        return False
+
+    async def _con_reintento(self, paso, *args, idempotente: bool = True):
+        """
+        Ejecuta paso(conn, *args); si la conexion se cae, una vez mas con otra.
+        Una escritura no idempotente solo se repite si la conexion fallo antes
+        de enviarla: caida ya enviada, el commit pudo llegar a la BD aunque se
+        perdiera la respuesta, y repetirla la duplicaria
+        """
+        enviado = False
+        try:
+            async with self.pool.acquire() as conn:
+                enviado = True
+                return await paso(conn, *args)
+        except _ERRORES_CONEXION as e:
+            if enviado and not idempotente:
+                logger.error(f"Conexion a BD perdida ({e}) tras enviar una escritura, no se repite")
+                raise
+            logger.warning(f"Conexion a BD perdida ({e}), reintentando con una nueva")
+            async with self.pool.acquire() as conn:
+                return await paso(conn, *args)
+
+    async def _procesar_datos(self, dispositivo_id: str, datos: dict,
+                              uplink_id: str = None) -> dict:
+        if self.ruta_rapida:
+            fila = await self._con_reintento(
+                lambda conn: conn.fetchrow(
+                    "SELECT * FROM registrar_y_asignar($1, $2, $3, $4, $5, $6, make_interval(secs => $7), $8)",
+                    dispositivo_id, datos['tipo'], datos['longitud'], datos['latitud'],
+                    self.knn_candidatos, uplink_id, self.dedup_ventana, self.reasignacion
+                ),
+                # Con uplink_id, repetirla da duplicado en lugar de otra alerta
+                idempotente=uplink_id is not None
+            )
+            if fila['alerta_id'] is None:
+                logger.debug("Uplink duplicado descartado: %s", uplink_id)
+                return dict(RESULTADO_DUPLICADO)
+
+            logger.debug("Alerta registrada: ID %s", fila['alerta_id'])
+            asignacion = fila if fila['id'] is not None else None
+            return construir_resultado(fila['alerta_id'], dispositivo_id, datos['tipo'], asignacion)
+
+        try:
+            alerta_id = await self._con_reintento(
+                self._registrar_alerta, dispositivo_id, datos, uplink_id,
+                idempotente=uplink_id is not None
+            )
+        except UplinkDuplicado:
+            logger.debug("Uplink duplicado descartado: %s", uplink_id)
+            return dict(RESULTADO_DUPLICADO)
+
+        logger.debug("Alerta registrada: ID %s", alerta_id)
+
+        # La alerta ya esta registrada: un fallo al asignar la deja pendiente
+        asignar = self._asignar_con_bloqueo if self.asignacion_concurrente else self._asignar_recurso
+        try:
+            # Repetir una asignacion ya confirmada ocuparia dos plazas
+            asignacion = await self._con_reintento(asignar, alerta_id, datos, idempotente=False)
+        except Exception as e:
+            logger.error(f"Error asignando recurso: {e}")
+            asignacion = None
+
+        if not asignacion and self.reasignacion:
+            try:
+                await self._con_reintento(
+                    lambda conn: conn.execute("SELECT avisar_pendientes($1)", [alerta_id])
+                )
+            except Exception as e:
+                logger.error(f"Error avisando de alertas pendientes: {e}")
+
+        return construir_resultado(alerta_id, dispositivo_id, datos['tipo'], asignacion)
+
+    async def _registrar_alerta(self, conn, dispositivo_id: str, datos: dict,
+                                uplink_id: str = None) -> int:
+        """Inserta la alerta; UplinkDuplicado si el uplink ya estaba registrado"""
+        if uplink_id is None:
+            return await conn.fetchval("""
+                INSERT INTO alertas (dispositivo_id, tipo, ubicacion)
+                VALUES ($1, $2, ST_SetSRID(ST_MakePoint($3, $4), 4326))
+                RETURNING id
+            """, dispositivo_id, datos['tipo'], datos['longitud'], datos['latitud'])
+
+        async with conn.transaction():
+            alerta_id = await conn.fetchval("""
+                WITH nueva AS (
+                    INSERT INTO alertas (dispositivo_id, tipo, ubicacion)
+                    VALUES ($1, $2, ST_SetSRID(ST_MakePoint($3, $4), 4326))
+                    RETURNING id
+                )
+                INSERT INTO uplinks_procesados (uplink_id, alerta_id)
+                SELECT $5, id FROM nueva
+                ON CONFLICT (uplink_id) DO UPDATE
+                SET alerta_id = EXCLUDED.alerta_id, fecha_recepcion = EXCLUDED.fecha_recepcion
+                WHERE uplinks_procesados.fecha_recepcion < CURRENT_TIMESTAMP - make_interval(secs => $6)
+                RETURNING alerta_id
+            """, dispositivo_id, datos['tipo'], datos['longitud'], datos['latitud'], uplink_id,
+                self.dedup_ventana)
+            if alerta_id is None:
+                # Deshace tambien la alerta insertada por la CTE
+                raise UplinkDuplicado(uplink_id)
+        return alerta_id
+
+    async def _asignar_recurso(self, conn, alerta_id: int, datos: dict):
+        async with conn.transaction():
+            if self.tiempos is not None:
+                candidatos = self._ordenar_candidatos(await conn.fetch(
+                    CONSULTA_CANDIDATOS_ASYNC,
+                    datos['tipo'], datos['latitud'], datos['longitud'], self.knn_candidatos
+                ), datos)
+                recurso = candidatos[0] if candidatos else None
+            else:
+                recurso = await conn.fetchrow(
+                    CONSULTA_RECURSO_CERCANO_ASYNC,
+                    datos['tipo'], datos['latitud'], datos['longitud'], self.knn_candidatos
+                )
+            if recurso:
+                await self._insertar_asignacion(conn, alerta_id, recurso)
+        return recurso
+
+    async def _asignar_con_bloqueo(self, conn, alerta_id: int, datos: dict):
+        """Como SistemaEmergencias._asignar_con_bloqueo, cediendo el bucle al esperar"""
+        for intento in range(self.reintentos_asignacion):
+            async with conn.transaction():
+                candidatos = self._ordenar_candidatos(await conn.fetch(
+                    CONSULTA_CANDIDATOS_ASYNC,
+                    datos['tipo'], datos['latitud'], datos['longitud'], self.knn_candidatos
+                ), datos)
+                if not candidatos:
+                    return None
+
+                for recurso in candidatos:
+                    bloqueado = await conn.fetchval("""
+                        SELECT id
+                        FROM puntos_emergencia
+                        WHERE id = $1 AND disponible = true
+                        FOR UPDATE SKIP LOCKED
+                    """, recurso['id'])
+                    if bloqueado is not None:
+                        await self._insertar_asignacion(conn, alerta_id, recurso)
+                        return recurso
+
+            await asyncio.sleep(random.uniform(0, 0.01 * (intento + 1)))
+
+        logger.warning(f"No se pudo reclamar recurso para alerta {alerta_id} tras {self.reintentos_asignacion} intentos")
+        return None
+
+    def _ordenar_candidatos(self, candidatos: list, datos: dict) -> list:
+        if self.tiempos is None:
+            return candidatos
+        return ordenar_por_tiempo(self.tiempos, candidatos, datos['latitud'], datos['longitud'])
+
+    async def _insertar_asignacion(self, conn, alerta_id: int, recurso):
+        await conn.execute("""
+            INSERT INTO asignaciones (
+                alerta_id,
+                punto_emergencia_id,
+                distancia_metros,
+                tiempo_estimado_segundos
+            ) VALUES ($1, $2, $3, $4)
+        """, alerta_id, recurso['id'], recurso['distancia_metros'], recurso['tiempo_estimado_segundos'])
+
+
+class ListenerLoRaWANAsync:
+    """
+    Listener MQTT sobre aiomqtt. Cada mensaje se procesa en su propia tarea;
+    'max_en_vuelo' de procesamiento_config limita las alertas simultaneas
+    (al llegar al limite se deja de leer del broker).
+    """
+
+    def __init__(self, mqtt_config: dict, db_config: dict,
+                 procesamiento_config: dict = None):
+        if aiomqtt is None:
+            raise ImportError("ListenerLoRaWANAsync necesita aiomqtt (pip install aiomqtt)")
+
+        procesamiento_config = procesamiento_config or {}
+        self.mqtt_config = mqtt_config
+        self.db_config = db_config
+        self.sistema = SistemaEmergenciasAsync(db_config)
+        self.max_en_vuelo = procesamiento_config.get('max_en_vuelo', 200)
+        self.dedup = CacheDeduplicacion(
+            ttl_segundos=procesamiento_config.get('dedup_ttl_segundos', 300),
+            max_entradas=procesamiento_config.get('dedup_max_entradas', 100_000)
+        )
+        # Telemetria: el volcado va en su propio hilo (psycopg2), fuera del bucle
+        self.telemetria = procesamiento_config.get('telemetria', False)
+        self.telemetria_config = {
+            'capacidad': procesamiento_config.get('telemetria_buffer', 100_000),
+            'intervalo': procesamiento_config.get('telemetria_intervalo', 5.0),
+            'umbral_bateria': procesamiento_config.get('bateria_baja', 20)
+        }
+
+        self._en_vuelo = None
+        self._tareas = set()
+
+        # Metricas
+        self.procesadas = 0
+        self.errores = 0
+
+    async def iniciar(self):
+        """Conecta a BD y al broker y procesa mensajes hasta que se cancele"""
+        logger.info("Iniciando listener LoRaWAN asincrono")
+        logger.info(f"Broker MQTT: {self.mqtt_config['broker']}:{self.mqtt_config['port']}")
+        logger.info(f"Topic: {self.mqtt_config['topic']}")
+
+        if not await self.sistema.conectar_bd():
+            logger.error("No se pudo conectar a BD")
+            return False
+        if self.telemetria:
+            TELEMETRIA.iniciar(self.db_config, **self.telemetria_config)
+
+        self._en_vuelo = asyncio.Semaphore(self.max_en_vuelo)
+        espera = 1.0
+        try:
+            while True:
+                try:
+                    await self._escuchar()
+                except aiomqtt.MqttError as e:
+                    logger.warning(f"Desconexion del broker ({e}), reconectando en {espera:.0f}s")
+                    await asyncio.sleep(espera)
+                    espera = min(espera * 2, 30.0)
+        finally:
+            await self.detener()
+
+    async def _escuchar(self):
+        async with aiomqtt.Client(
+            self.mqtt_config['broker'],
+            port=self.mqtt_config['port'],
+            username=self.mqtt_config.get('username'),
+            password=self.mqtt_config.get('password'),
+            keepalive=60
+        ) as client:
+            await client.subscribe(self.mqtt_config['topic'])
+            logger.info("Listener activo. Presiona Ctrl+C para detener")
+
+            async for mensaje in client.messages:
+                await self._en_vuelo.acquire()
+                tarea = asyncio.create_task(self._on_message(mensaje.payload))
+                self._tareas.add(tarea)
+                tarea.add_done_callback(self._tarea_terminada)
+
+    def _tarea_terminada(self, tarea):
+        self._tareas.discard(tarea)
+        self._en_vuelo.release()
+
+    async def _on_message(self, contenido: bytes):
+        uplink_id = None
+        try:
+            payload = json.loads(contenido.decode('utf-8'))
+
+            dev_eui = payload.get('devEUI', payload.get('deviceName', 'unknown'))
+            payload_base64 = payload.get('data', '')
+
+            uplink_id = clave_uplink(dev_eui, payload)
+            if self.dedup.es_duplicado(uplink_id):
+                logger.debug("Uplink duplicado descartado: %s", uplink_id)
+                return
+
+            with METRICAS.cronometro('etapa_segundos', etapa='alerta'):
+                resultado = await self.sistema.procesar_alerta(dev_eui, payload_base64, uplink_id)
+            self._registrar_resultado(contar_resultado(resultado), uplink_id)
+
+        except json.JSONDecodeError:
+            logger.error("JSON invalido")
+        except Exception as e:
+            self.errores += 1
+            logger.error(f"Error procesando mensaje: {e}")
+            if uplink_id is not None:
+                self.dedup.olvidar(uplink_id)
+
+    def _registrar_resultado(self, resultado: dict, uplink_id: str = None):
+        self.procesadas += 1
+        # Si no llego a la BD, el reenvio del dispositivo debe pasar
+        if uplink_id is not None and not alerta_registrada(resultado):
+            self.dedup.olvidar(uplink_id)
+        if resultado['exito']:
+            if logger.isEnabledFor(logging.DEBUG):
+                asig = resultado['asignacion']
+                logger.debug("Alerta %s: %s (%s), %.0fm", resultado['alerta_id'], asig['nombre'],
+                             asig['municipio'], asig['distancia_metros'])
+        elif resultado.get('duplicado'):
+            logger.debug("Uplink ya registrado por otra instancia, descartado")
+        else:
+            self.errores += 1
+            logger.error(f"Error: {resultado.get('error')}")
+
+    def metricas(self) -> dict:
+        return {
+            'en_vuelo': len(self._tareas),
+            'procesadas': self.procesadas,
+            'errores': self.errores,
+            'duplicados': self.dedup.duplicados
+        }
+
+    async def detener(self):
+        """Espera a las alertas en vuelo y cierra el pool"""
+        logger.info("Deteniendo listener")
+        if self._tareas:
+            await asyncio.gather(*self._tareas, return_exceptions=True)
+        await asyncio.to_thread(TELEMETRIA.detener)
+        await self.sistema.desconectar_bd()
+
+
+async def _main(listener):
+    tarea = asyncio.current_task()
+    bucle = asyncio.get_running_loop()
+    if sys.platform != 'win32':
+        bucle.add_signal_handler(signal.SIGINT, tarea.cancel)
+        bucle.add_signal_handler(signal.SIGTERM, tarea.cancel)
+    try:
+        await listener.iniciar()
+    except asyncio.CancelledError:
+        logger.info("Interrupcion recibida")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.StreamHandler(),
+            logging.FileHandler('sistema_emergencias.log')
+        ]
+    )
+
+    try:
+        import config
+        from config import DB_CONFIG, MQTT_CONFIG
+    except ImportError:
+        print("Error: No se encontro config.py")
+        sys.exit(1)
+
+    PROCESAMIENTO_CONFIG = getattr(config, 'PROCESAMIENTO_CONFIG', None)
+
+    try:
+        asyncio.run(_main(ListenerLoRaWANAsync(MQTT_CONFIG, DB_CONFIG, PROCESAMIENTO_CONFIG)))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Latencia por carril con el listener saturado, sin BD ni broker
+
+Entrega al listener (almacen en memoria) una rafaga de latidos, alertas
+policiales y reintentos mucho mayor de lo que procesan los trabajadores,
+con alertas medicas intercaladas, y compara la latencia extremo a extremo
+de las criticas con la cola FIFO y con carriles (estricto y ponderado).
+Los latidos van al carril bajo, que es el unico que descarta; las
+policiales y los reintentos, al normal, que bloquea. Los percentiles
+salen de los histogramas de METRICAS (limite superior del cubo).
+
+Uso: python benchmark_carriles.py [mensajes] [trabajadores]
+"""
+
+import base64
+import json
+import logging
+import random
+import struct
+import sys
+import time
+from types import SimpleNamespace
+
+from benchmark_pipeline import CONFIG_MEMORIA, LAT_MAX, LAT_MIN, LON_MAX, LON_MIN, preparar
+from decoder import FLAG_BOTON, FLAG_LATIDO, FLAG_REINTENTO
+from listener import ListenerLoRaWAN
+from metricas import METRICAS
+from procesamiento import CARRILES_DEFECTO, ESTRICTO, PONDERADO
+
+PROPORCION_CRITICAS = 0.05
+PROPORCION_LATIDOS = 0.6
+CAPACIDAD = 2000
+
+
+def generar_mensajes(n, semilla=42):
+    aleatorio = random.Random(semilla)
+    mensajes = []
+    for i in range(n):
+        sorteo = aleatorio.random()
+        if sorteo < PROPORCION_CRITICAS:
+            tipo, flags = 1, FLAG_BOTON
+        elif sorteo < PROPORCION_CRITICAS + PROPORCION_LATIDOS:
+            tipo, flags = aleatorio.randint(1, 4), FLAG_LATIDO
+        elif aleatorio.random() < 0.5:
+            # Alerta policial: carril normal
+            tipo, flags = 2, FLAG_BOTON
+        else:
+            # Reintento de una medica: carril normal
+            tipo, flags = 1, FLAG_REINTENTO | FLAG_BOTON
+        payload = struct.pack(
+            '>BiiBB',
+            tipo,
+            int(aleatorio.uniform(LAT_MIN, LAT_MAX) * 1_000_000),
+            int(aleatorio.uniform(LON_MIN, LON_MAX) * 1_000_000),
+            aleatorio.randint(0, 100),
+            flags
+        )
+        dev_eui = f"{aleatorio.randrange(5000):016x}"
+        mensajes.append(SimpleNamespace(
+            topic=f"application/1/device/{dev_eui}/event/up",
+            payload=json.dumps({
+                'devEUI': dev_eui, 'fCnt': i, 'data': base64.b64encode(payload).decode()
+            }).encode('utf-8'),
+            critica=tipo == 1 and flags == FLAG_BOTON
+        ))
+    return mensajes
+
+
+def ejecutar(nombre, mensajes, trabajadores, carriles=None, despacho=ESTRICTO):
+    procesamiento = {
+        'trabajadores': trabajadores,
+        'capacidad_cola': CAPACIDAD,
+        'intervalo_metricas': 0
+    }
+    if carriles:
+        procesamiento.update(carriles=carriles, despacho_carriles=despacho)
+    listener = ListenerLoRaWAN(
+        {'broker': 'localhost', 'port': 1883, 'topic': 'application/+/device/+/event/up'},
+        CONFIG_MEMORIA,
+        procesamiento
+    )
+    preparar(listener.sistema, 500)
+    METRICAS._histogramas.clear()
+    METRICAS._contadores.clear()
+    listener.pool.iniciar()
+
+    inicio = time.perf_counter()
+    for msg in mensajes:
+        listener._on_message(None, None, msg)
+    # Esperar a que se vacie la cola
+    while listener.cola.metricas()['profundidad']:
+        time.sleep(0.001)
+    time.sleep(0.05)
+    segundos = time.perf_counter() - inicio
+    listener.pool.detener()
+
+    m = listener.cola.metricas()
+    print(f"\n  {nombre}: {len(mensajes) / segundos:,.0f} msg/s ofrecidos, "
+          f"{m['procesadas']:,} procesados, {m['descartadas']:,} descartados")
+    if carriles:
+        for carril, c in m['carriles'].items():
+            h = METRICAS.histograma('carril_extremo_segundos', carril=carril)
+            if h is None:
+                continue
+            print(
+                f"    {carril:<8} n={h.total:>6}  p50 {_ms(h.percentil(50)):>8}  p99 {_ms(h.percentil(99)):>8}  "
+                f"descartadas {c['descartadas']:>6}  fuera de SLO "
+                f"{METRICAS.contador('carril_slo_incumplido_total', carril=carril):>6}"
+            )
+    else:
+        h = METRICAS.histograma('extremo_segundos')
+        # En orden de llegada: las criticas tienen la misma espera que el resto
+        print(f"    todas    n={h.total:>6}  p50 {_ms(h.percentil(50)):>8}  p99 {_ms(h.percentil(99)):>8}")
+
+
+def _ms(segundos):
+    if segundos is None:
+        return '-'
+    if segundos == float('inf'):
+        return '>10s'
+    return f"{segundos * 1000:g}ms"
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    trabajadores = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    logging.basicConfig(level=logging.CRITICAL)
+
+    mensajes = generar_mensajes(n)
+    criticas = sum(m.critica for m in mensajes)
+
+    print("\n" + "=" * 72)
+    print(f"CARRILES BAJO SATURACION ({n:,} uplinks, {criticas:,} criticos, {trabajadores} trabajadores)")
+    print("=" * 72)
+
+    # FIFO: las criticas esperan detras de toda la cola
+    ejecutar("FIFO (una cola)", mensajes, trabajadores)
+
+    carriles = {
+        carril: dict(config, capacidad=CAPACIDAD)
+        for carril, config in CARRILES_DEFECTO.items()
+    }
+    ejecutar("Carriles, estricto", mensajes, trabajadores, carriles, ESTRICTO)
+    ejecutar("Carriles, ponderado", mensajes, trabajadores, carriles, PONDERADO)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark del decodificador de payloads
+
+Compara mensajes por segundo de PayloadDecoder.decode (uno a uno) con
+PayloadDecoder.decode_batch, con y sin NumPy. No necesita BD ni broker.
+
+Uso: python benchmark_decoder.py [mensajes]
+"""
+
+import base64
+import logging
+import random
+import struct
+import sys
+import time
+
+import decoder
+from decoder import PayloadDecoder
+
+# Caja aproximada de Las Hurdes
+LON_MIN, LON_MAX = -6.45, -6.10
+LAT_MIN, LAT_MAX = 40.25, 40.50
+
+
+def generar_payloads(n, invalidos=0.01):
+    """Payloads como los de test_alerta.generar_payload, con un % de basura"""
+    payloads = []
+    for _ in range(n):
+        if random.random() < invalidos:
+            payloads.append(base64.b64encode(b'\x01\x02').decode())
+            continue
+        payload_bytes = struct.pack(
+            '>BiiBB',
+            random.randint(1, 4),
+            int(random.uniform(LAT_MIN, LAT_MAX) * 1_000_000),
+            int(random.uniform(LON_MIN, LON_MAX) * 1_000_000),
+            random.randint(0, 100),
+            0x01
+        )
+        payloads.append(base64.b64encode(payload_bytes).decode())
+    return payloads
+
+
+def medir(nombre, funcion, n, repeticiones=3):
+    mejor = min(_cronometrar(funcion) for _ in range(repeticiones))
+    print(f"  {nombre:<32} {n / mejor:>14,.0f} msg/s   ({mejor * 1000:.1f} ms)")
+    return n / mejor
+
+
+def _cronometrar(funcion):
+    inicio = time.perf_counter()
+    funcion()
+    return time.perf_counter() - inicio
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+
+    # Como en produccion con INFO desactivado: el coste de log no debe contar
+    logging.basicConfig(level=logging.CRITICAL)
+
+    random.seed(42)
+    payloads = generar_payloads(n)
+    dec = PayloadDecoder()
+
+    print("\n" + "="*64)
+    print(f"BENCHMARK DECODIFICADOR ({n:,} payloads)")
+    print("="*64)
+
+    base = medir("decode (uno a uno)", lambda: [dec.decode(p) for p in payloads], n)
+
+    numpy = decoder.np
+    if numpy is not None:
+        lote = medir("decode_batch (NumPy)", lambda: dec.decode_batch(payloads), n)
+        print(f"  {'':<32} {lote / base:>13.1f}x")
+
+    decoder.np = None
+    try:
+        lote = medir("decode_batch (array)", lambda: dec.decode_batch(payloads), n)
+        print(f"  {'':<32} {lote / base:>13.1f}x")
+    finally:
+        decoder.np = numpy
+
+    print("="*64)
+
+
+if __name__ == "__main__":
+    main()
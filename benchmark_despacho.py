@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark del reparto de lotes con recursos escasos (despacho.py)
+
+1. Resolucion de la asignacion alertas x plazas con cada implementacion
+   disponible (SciPy, NumPy, Python puro solo en tamanos pequenos).
+2. Lote completo en el almacen en memoria, reparto voraz frente a optimo:
+   alertas cubiertas, tiempo estimado total y latencia del lote.
+
+Uso: python benchmark_despacho.py [alertas por lote] [lotes]
+"""
+
+import logging
+import random
+import sys
+import time
+
+import despacho
+from almacen_memoria import TIPOS, AlmacenMemoria
+from despacho import OPTIMO, VORAZ
+
+# Caja aproximada de Las Hurdes
+LON_MIN, LON_MAX = -6.45, -6.10
+LAT_MIN, LAT_MAX = 40.25, 40.50
+
+TAMANOS = (100, 1000)
+MAX_PYTHON = 100
+MAX_NUMPY = 1000
+
+
+def matriz_aleatoria(n, m, semilla=1):
+    aleatorio = random.Random(semilla)
+    # Tiempos de 3 a 40 minutos y un 25% de pares imposibles (tipo distinto)
+    infinito = 40 * 60 * (n + 1)
+    return [
+        [infinito if aleatorio.random() < 0.25 else aleatorio.uniform(180, 2400) for _ in range(m)]
+        for _ in range(n)
+    ], infinito
+
+
+def cronometrar(funcion):
+    inicio = time.perf_counter()
+    resultado = funcion()
+    return time.perf_counter() - inicio, resultado
+
+
+def benchmark_resolucion():
+    print("Asignacion alertas x plazas")
+    for n in TAMANOS:
+        costes, infinito = matriz_aleatoria(n, n)
+        implementaciones = []
+        if despacho.linear_sum_assignment is not None:
+            implementaciones.append(('scipy', lambda: despacho.resolver_asignacion(costes, infinito)))
+        if despacho.np is not None and n <= MAX_NUMPY:
+            matriz = despacho.np.asarray(costes)
+            implementaciones.append(('numpy', lambda: despacho._hungaro_numpy(matriz, infinito)))
+        if n <= MAX_PYTHON:
+            implementaciones.append(('python', lambda: despacho._hungaro(costes, infinito)))
+
+        referencia = None
+        for nombre, funcion in implementaciones:
+            segundos, columnas = cronometrar(funcion)
+            coste = sum(costes[i][j] for i, j in enumerate(columnas) if 0 <= j < n)
+            if referencia is None:
+                referencia = coste
+            aviso = "" if abs(coste - referencia) < 1e-6 * max(referencia, 1) else "  DISTINTO"
+            print(f"  {n:>5} x {n:<5} {nombre:<8} {segundos * 1000:>10.1f} ms  coste {coste:,.0f}{aviso}")
+
+
+def crear_almacen(modo, puntos, capacidad):
+    almacen = AlmacenMemoria(despacho=modo)
+    almacen.generar_puntos(puntos, semilla=42, capacidad=capacidad)
+    return almacen
+
+
+def generar_lotes(alertas, lotes, semilla=7):
+    aleatorio = random.Random(semilla)
+    # Alertas agrupadas en pocos focos: compiten por los mismos recursos
+    focos = [
+        (aleatorio.uniform(LAT_MIN, LAT_MAX), aleatorio.uniform(LON_MIN, LON_MAX))
+        for _ in range(5)
+    ]
+    resultado = []
+    for l in range(lotes):
+        lote = []
+        for i in range(alertas):
+            lat, lon = aleatorio.choice(focos)
+            lote.append((
+                f"{aleatorio.randrange(5000):016x}",
+                {
+                    'tipo': aleatorio.choice(TIPOS),
+                    'latitud': lat + aleatorio.gauss(0, 0.01),
+                    'longitud': lon + aleatorio.gauss(0, 0.01)
+                },
+                f"b{l}-{i}"
+            ))
+        resultado.append(lote)
+    return resultado
+
+
+def benchmark_lotes(alertas, lotes):
+    # Plazas para algo menos de la mitad de las alertas
+    puntos = max(alertas * lotes // 4, 10)
+    print(f"\nLotes de {alertas} alertas ({lotes} lotes, {puntos} recursos de 1 plaza)")
+    for modo in (VORAZ, OPTIMO):
+        almacen = crear_almacen(modo, puntos, capacidad=1)
+        cubiertas = 0
+        tiempo_total = 0
+        segundos = 0.0
+        for lote in generar_lotes(alertas, lotes):
+            duracion, resultados = cronometrar(lambda: almacen.procesar_lote(lote))
+            segundos += duracion
+            for resultado in resultados:
+                if resultado['exito']:
+                    cubiertas += 1
+                    tiempo_total += resultado['asignacion']['tiempo_estimado_minutos']
+        total = alertas * lotes
+        print(
+            f"  {modo:<8} cubiertas {cubiertas:>6}/{total:<6} "
+            f"tiempo medio {tiempo_total / max(cubiertas, 1):>6.1f} min  "
+            f"{segundos / lotes * 1000:>8.2f} ms/lote"
+        )
+
+
+if __name__ == "__main__":
+    alertas = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    lotes = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    logging.basicConfig(level=logging.CRITICAL)
+
+    benchmark_resolucion()
+    benchmark_lotes(alertas, lotes)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark de la busqueda del recurso mas cercano
+
+Compara la consulta original (ST_Distance sobre toda la tabla) con la
+busqueda KNN de integracion.py para distintos tamanos de puntos_emergencia.
+Los puntos sinteticos se insertan dentro de una transaccion que se deshace
+al final de cada tamano: la base de datos queda como estaba.
+"""
+
+import sys
+import os
+import random
+import statistics
+import time
+
+if sys.platform == 'win32':
+    os.environ['PGCLIENTENCODING'] = 'UTF8'
+    os.environ['PYTHONIOENCODING'] = 'utf-8'
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from integracion import CONSULTA_RECURSO_CERCANO
+from config import DB_CONFIG
+
+TAMANOS = [10, 100, 1_000, 10_000, 100_000]
+REPETICIONES = 200
+CANDIDATOS = DB_CONFIG.get('knn_candidatos', 10)
+
+# Caja aproximada de Las Hurdes
+LON_MIN, LON_MAX = -6.45, -6.10
+LAT_MIN, LAT_MAX = 40.25, 40.50
+
+# Consulta anterior: distancia geodesica a todas las filas y ordenacion completa
+CONSULTA_ANTERIOR = """
+    WITH alerta AS (
+        SELECT ST_SetSRID(ST_MakePoint(%(longitud)s, %(latitud)s), 4326) AS ubicacion
+    )
+    SELECT
+        pe.id,
+        ST_Distance(pe.ubicacion::geography, alerta.ubicacion::geography) AS distancia_metros,
+        (
+            (ST_Distance(pe.ubicacion::geography, alerta.ubicacion::geography) / 1000.0) /
+            (pe.velocidad_promedio_kmh / 60.0) * 60 +
+            pe.tiempo_preparacion_segundos
+        )::INTEGER AS tiempo_estimado_segundos
+    FROM puntos_emergencia pe
+    CROSS JOIN alerta
+    WHERE
+        pe.tipo = %(tipo)s
+        AND pe.disponible = true
+    ORDER BY distancia_metros ASC
+    LIMIT 1
+"""
+
+INSERTAR_PUNTOS = """
+    INSERT INTO puntos_emergencia (codigo, nombre, tipo, ubicacion, municipio, capacidad_maxima)
+    SELECT
+        'BENCH-' || g,
+        'Recurso sintetico ' || g,
+        (ARRAY['medica', 'policial', 'bomberos', 'rescate']::tipo_emergencia[])[1 + g %% 4],
+        ST_SetSRID(ST_MakePoint(
+            %(lon_min)s + random() * (%(lon_max)s - %(lon_min)s),
+            %(lat_min)s + random() * (%(lat_max)s - %(lat_min)s)
+        ), 4326),
+        'Benchmark',
+        5
+    FROM generate_series(1, %(n)s) g
+"""
+
+
+def medir(cursor, consulta, puntos):
+    """Ejecuta la consulta para cada punto y devuelve los tiempos en ms"""
+    tiempos = []
+    for tipo, lat, lon in puntos:
+        inicio = time.perf_counter()
+        cursor.execute(consulta, {
+            'tipo': tipo,
+            'latitud': lat,
+            'longitud': lon,
+            'candidatos': CANDIDATOS
+        })
+        cursor.fetchone()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    return tiempos
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p))]
+
+
+def main():
+    conn = psycopg2.connect(
+        host=DB_CONFIG['host'],
+        port=DB_CONFIG.get('port', 5432),
+        database=DB_CONFIG['database'],
+        user=DB_CONFIG['user'],
+        password=DB_CONFIG['password'],
+        options='-c client_encoding=UTF8'
+    )
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+
+    random.seed(42)
+    puntos = [
+        (
+            random.choice(['medica', 'policial', 'bomberos', 'rescate']),
+            random.uniform(LAT_MIN, LAT_MAX),
+            random.uniform(LON_MIN, LON_MAX)
+        )
+        for _ in range(REPETICIONES)
+    ]
+
+    print("\n" + "="*72)
+    print("BENCHMARK RECURSO MAS CERCANO (ms por consulta)")
+    print("="*72)
+    print(f"{'Puntos':>8} | {'Anterior p50':>12} {'p95':>8} | {'KNN p50':>8} {'p95':>8} | {'Mejora':>7}")
+    print("-"*72)
+
+    try:
+        for n in TAMANOS:
+            cursor.execute(INSERTAR_PUNTOS, {
+                'n': n,
+                'lon_min': LON_MIN, 'lon_max': LON_MAX,
+                'lat_min': LAT_MIN, 'lat_max': LAT_MAX
+            })
+            cursor.execute("ANALYZE puntos_emergencia")
+
+            # Calentar cache y planes
+            medir(cursor, CONSULTA_ANTERIOR, puntos[:10])
+            medir(cursor, CONSULTA_RECURSO_CERCANO, puntos[:10])
+
+            anterior = medir(cursor, CONSULTA_ANTERIOR, puntos)
+            knn = medir(cursor, CONSULTA_RECURSO_CERCANO, puntos)
+
+            p50_ant = statistics.median(anterior)
+            p50_knn = statistics.median(knn)
+            print(
+                f"{n:>8} | {p50_ant:>12.3f} {percentil(anterior, 0.95):>8.3f} | "
+                f"{p50_knn:>8.3f} {percentil(knn, 0.95):>8.3f} | {p50_ant / p50_knn:>6.1f}x"
+            )
+
+            conn.rollback()
+    finally:
+        conn.rollback()
+        cursor.close()
+        conn.close()
+
+    print("="*72)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n\nInterrumpido")
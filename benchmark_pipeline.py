@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark por capas del procesamiento de alertas, sin BD ni broker
+
+Usa el almacen en memoria (almacen_memoria.py) para medir solo la parte
+Python: decodificacion, registro y asignacion, construccion del resultado,
+lotes y el listener completo (JSON, deduplicacion, cola y trabajadores).
+
+Uso: python benchmark_pipeline.py [mensajes] [puntos]
+"""
+
+import base64
+import json
+import logging
+import random
+import struct
+import sys
+import time
+from types import SimpleNamespace
+
+from integracion import SistemaEmergencias
+from listener import ListenerLoRaWAN
+
+# Caja aproximada de Las Hurdes
+LON_MIN, LON_MAX = -6.45, -6.10
+LAT_MIN, LAT_MAX = 40.25, 40.50
+
+TAMANO_LOTE = 100
+
+
+def generar_mensajes(n, dispositivos=5000):
+    """Uplinks de ChirpStack ya serializados (como llegan del broker)"""
+    mensajes = []
+    for i in range(n):
+        payload = struct.pack(
+            '>BiiBB',
+            random.randint(1, 4),
+            int(random.uniform(LAT_MIN, LAT_MAX) * 1_000_000),
+            int(random.uniform(LON_MIN, LON_MAX) * 1_000_000),
+            random.randint(0, 100),
+            0x01
+        )
+        dev_eui = f"{random.randrange(dispositivos):016x}"
+        mensajes.append({
+            'devEUI': dev_eui,
+            'fCnt': i,
+            'data': base64.b64encode(payload).decode()
+        })
+    return mensajes
+
+
+CONFIG_MEMORIA = {'almacen': 'memoria', 'almacen_puntos': 0}
+
+
+def preparar(sistema, puntos):
+    sistema.conectar_bd()
+    # Capacidad de sobra: todas las alertas pasan por la asignacion completa
+    sistema.almacen.generar_puntos(puntos, semilla=42, capacidad=10**9)
+    return sistema
+
+
+def crear_sistema(puntos, **opciones):
+    return preparar(SistemaEmergencias(dict(CONFIG_MEMORIA, **opciones)), puntos)
+
+
+def cronometrar(funcion):
+    inicio = time.perf_counter()
+    funcion()
+    return time.perf_counter() - inicio
+
+
+def informar(nombre, n, segundos, anterior=None):
+    por_mensaje = segundos / n * 1e6
+    extra = f"  (+{por_mensaje - anterior:.1f} us)" if anterior is not None else ""
+    print(f"  {nombre:<34} {n / segundos:>10,.0f} msg/s  {por_mensaje:>8.1f} us/msg{extra}")
+    return por_mensaje
+
+
+def procesar_listener(puntos, mensajes, trabajadores, lote_max=0):
+    """Entrega los mensajes al listener como lo haria paho y espera a la cola"""
+    listener = ListenerLoRaWAN(
+        {'broker': 'localhost', 'port': 1883, 'topic': 'application/+/device/+/event/up'},
+        CONFIG_MEMORIA,
+        {'trabajadores': trabajadores, 'capacidad_cola': len(mensajes), 'intervalo_metricas': 0,
+         'lote_max': lote_max}
+    )
+    preparar(listener.sistema, puntos)
+    if listener.acumulador is not None:
+        listener.acumulador.iniciar()
+    listener.pool.iniciar()
+
+    crudos = [
+        SimpleNamespace(topic=f"application/1/device/{m['devEUI']}/event/up",
+                        payload=json.dumps(m).encode('utf-8'))
+        for m in mensajes
+    ]
+
+    def ejecutar():
+        for msg in crudos:
+            listener._on_message(None, None, msg)
+        while listener.cola.metricas()['procesadas'] < len(crudos):
+            time.sleep(0.001)
+
+    segundos = cronometrar(ejecutar)
+    if listener.acumulador is not None:
+        listener.acumulador.detener()
+    listener.pool.detener()
+    return segundos, listener.acumulador
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    puntos = int(sys.argv[2]) if len(sys.argv) > 2 else 2_000
+
+    # Como en produccion con INFO desactivado: el coste de log no debe contar
+    logging.basicConfig(level=logging.CRITICAL)
+
+    random.seed(42)
+    mensajes = generar_mensajes(n)
+
+    print("\n" + "="*72)
+    print(f"BENCHMARK POR CAPAS ({n:,} alertas, {puntos:,} recursos en memoria)")
+    print("="*72)
+
+    sistema = crear_sistema(puntos)
+    segundos = cronometrar(lambda: [sistema.decoder.decode(m['data']) for m in mensajes])
+    base = informar("decodificacion", n, segundos)
+
+    segundos = cronometrar(lambda: [
+        sistema.procesar_alerta(m['devEUI'], m['data']) for m in mensajes
+    ])
+    informar("procesar_alerta", n, segundos, base)
+
+    sistema = crear_sistema(puntos, ruta_rapida=True)
+    segundos = cronometrar(lambda: [
+        sistema.procesar_alerta(m['devEUI'], m['data']) for m in mensajes
+    ])
+    informar("procesar_alerta (ruta rapida)", n, segundos, base)
+
+    sistema = crear_sistema(puntos, coalescencia=True)
+    segundos = cronometrar(lambda: [
+        sistema.procesar_alerta(m['devEUI'], m['data']) for m in mensajes
+    ])
+    informar("procesar_alerta (coalescencia)", n, segundos, base)
+
+    sistema = crear_sistema(puntos)
+
+    def por_lotes():
+        for i in range(0, n, TAMANO_LOTE):
+            trozo = mensajes[i:i + TAMANO_LOTE]
+            lote = sistema.decoder.decode_batch([m['data'] for m in trozo])
+            sistema.procesar_lote([
+                (m['devEUI'], lote.fila(j)) for j, m in enumerate(trozo)
+            ])
+    informar(f"decode_batch + procesar_lote ({TAMANO_LOTE})", n, cronometrar(por_lotes), base)
+
+    for trabajadores in (1, 4):
+        segundos, _ = procesar_listener(puntos, mensajes, trabajadores)
+        informar(f"listener ({trabajadores} trabajador{'es' if trabajadores > 1 else ''})", n, segundos, base)
+
+    # Micro-lotes: el acumulador lee la cola, el tamano no depende de los hilos
+    segundos, acumulador = procesar_listener(puntos, mensajes, 4, lote_max=TAMANO_LOTE)
+    informar(f"listener (micro-lotes de {TAMANO_LOTE})", n, segundos, base)
+    print(f"    {acumulador.lotes} lotes, media {acumulador.alertas / max(acumulador.lotes, 1):.1f} "
+          f"alertas, maximo {acumulador.lote_maximo}")
+
+    print("="*72)
+
+
+if __name__ == "__main__":
+    main()
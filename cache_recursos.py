@@ -0,0 +1,194 @@
+"""
+Indice en memoria de los recursos de emergencia disponibles
+Rejilla por tipo de emergencia con distancia haversine
+"""
+
+import bisect
+import logging
+import math
+import threading
+
+from psycopg2.extras import RealDictCursor
+
+logger = logging.getLogger(__name__)
+
+RADIO_TIERRA_METROS = 6_371_008.8
+METROS_POR_GRADO = 111_195.0
+
+CANAL_RECURSOS = 'recursos_emergencia'
+
+
+def distancia_haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Distancia en metros sobre la esfera"""
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * RADIO_TIERRA_METROS * math.asin(math.sqrt(a))
+
+
+def tiempo_estimado(distancia_metros: float, velocidad_kmh: float,
+                    preparacion_segundos: int) -> int:
+    """Mismo calculo que la consulta SQL de asignacion"""
+    return int(round(
+        (distancia_metros / 1000.0) / (velocidad_kmh / 60.0) * 60 + preparacion_segundos
+    ))
+
+
+class IndiceRecursos:
+    """
+    Recursos disponibles agrupados por tipo en una rejilla de celdas de
+    `celda_grados` grados. Se mantiene al dia con las notificaciones que
+    emite el trigger notificar_recurso.
+    """
+
+    def __init__(self, celda_grados: float = 0.05):
+        self.celda = celda_grados
+        self._recursos = {}
+        self._rejillas = {}
+        self._lock = threading.Lock()
+        self.cargado = False
+
+    def cargar(self, conn):
+        """Carga completa desde puntos_emergencia"""
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute("""
+                SELECT
+                    id, codigo, nombre, tipo, municipio, telefono,
+                    ST_X(ubicacion) AS lon,
+                    ST_Y(ubicacion) AS lat,
+                    capacidad_actual, capacidad_maxima, disponible,
+                    velocidad_promedio_kmh, tiempo_preparacion_segundos
+                FROM puntos_emergencia
+            """)
+            filas = cursor.fetchall()
+
+        with self._lock:
+            self._recursos = {}
+            self._rejillas = {}
+            for fila in filas:
+                self._guardar(dict(fila))
+            self.cargado = True
+
+        logger.info(f"Indice de recursos cargado: {len(filas)} puntos")
+
+    def actualizar(self, canal: str, datos: dict):
+        """Aplica una notificacion del trigger notificar_recurso"""
+        with self._lock:
+            self._quitar(datos['id'])
+            if datos.get('operacion') != 'DELETE':
+                self._guardar(datos)
+
+    def ocupar(self, recurso_id: int):
+        """Refleja una asignacion propia antes de que llegue la notificacion"""
+        with self._lock:
+            recurso = self._recursos.get(recurso_id)
+            if recurso:
+                recurso = dict(recurso)
+                recurso['capacidad_actual'] += 1
+                recurso['disponible'] = recurso['capacidad_actual'] < recurso['capacidad_maxima']
+                self._quitar(recurso_id)
+                self._guardar(recurso)
+
+    def marcar_no_disponible(self, recurso_id: int):
+        with self._lock:
+            recurso = self._recursos.get(recurso_id)
+            if recurso:
+                recurso = dict(recurso, disponible=False)
+                self._quitar(recurso_id)
+                self._guardar(recurso)
+
+    def mas_cercano(self, tipo: str, latitud: float, longitud: float) -> dict:
+        """
+        Recurso disponible mas cercano del tipo indicado
+
+        Returns:
+            Diccionario con los mismos campos que la consulta SQL, o None
+        """
+        candidatos = self.candidatos(tipo, latitud, longitud, 1)
+        return candidatos[0] if candidatos else None
+
+    def candidatos(self, tipo: str, latitud: float, longitud: float, k: int) -> list:
+        """Los k recursos disponibles mas cercanos del tipo, de menor a mayor distancia"""
+        with self._lock:
+            rejilla = self._rejillas.get(tipo)
+            if not rejilla:
+                return []
+
+            cx, cy = self._celda(latitud, longitud)
+            # Ancho minimo de una celda en metros (la longitud encoge con la latitud)
+            lado = self.celda * METROS_POR_GRADO * math.cos(math.radians(min(abs(latitud) + self.celda, 89.0)))
+
+            # (distancia, id) de los k mejores hasta ahora, ordenados
+            mejores = []
+            visitadas = 0
+            anillo = 0
+            while visitadas < len(rejilla):
+                # Todo lo que quede fuera del anillo esta al menos a esta distancia
+                if len(mejores) == k and (anillo - 1) * lado > mejores[-1][0]:
+                    break
+
+                for celda in self._anillo(cx, cy, anillo):
+                    ids = rejilla.get(celda)
+                    if not ids:
+                        continue
+                    visitadas += 1
+                    for recurso_id in ids:
+                        recurso = self._recursos[recurso_id]
+                        d = distancia_haversine(latitud, longitud, recurso['lat'], recurso['lon'])
+                        if len(mejores) < k or d < mejores[-1][0]:
+                            bisect.insort(mejores, (d, recurso_id))
+                            del mejores[k:]
+                anillo += 1
+
+            return [self._fila(self._recursos[recurso_id], d) for d, recurso_id in mejores]
+
+    @staticmethod
+    def _fila(recurso: dict, distancia: float) -> dict:
+        return {
+            'id': recurso['id'],
+            'nombre': recurso['nombre'],
+            'codigo': recurso['codigo'],
+            'municipio': recurso['municipio'],
+            'telefono': recurso['telefono'],
+            'distancia_metros': distancia,
+            'tiempo_preparacion_segundos': recurso['tiempo_preparacion_segundos'],
+            'tiempo_estimado_segundos': tiempo_estimado(
+                distancia,
+                float(recurso['velocidad_promedio_kmh']),
+                recurso['tiempo_preparacion_segundos']
+            )
+        }
+
+    def _celda(self, latitud: float, longitud: float) -> tuple:
+        return (math.floor(longitud / self.celda), math.floor(latitud / self.celda))
+
+    @staticmethod
+    def _anillo(cx: int, cy: int, anillo: int):
+        if anillo == 0:
+            yield (cx, cy)
+            return
+        for x in range(cx - anillo, cx + anillo + 1):
+            yield (x, cy - anillo)
+            yield (x, cy + anillo)
+        for y in range(cy - anillo + 1, cy + anillo):
+            yield (cx - anillo, y)
+            yield (cx + anillo, y)
+
+    def _guardar(self, recurso: dict):
+        self._recursos[recurso['id']] = recurso
+        if recurso['disponible']:
+            celda = self._celda(recurso['lat'], recurso['lon'])
+            self._rejillas.setdefault(recurso['tipo'], {}).setdefault(celda, set()).add(recurso['id'])
+
+    def _quitar(self, recurso_id: int):
+        recurso = self._recursos.pop(recurso_id, None)
+        if recurso and recurso['disponible']:
+            rejilla = self._rejillas.get(recurso['tipo'], {})
+            celda = self._celda(recurso['lat'], recurso['lon'])
+            ids = rejilla.get(celda)
+            if ids:
+                ids.discard(recurso_id)
+                if not ids:
+                    del rejilla[celda]
@@ -0,0 +1,187 @@
+"""
+Coalescencia de alertas por dispositivo
+Las pulsaciones repetidas de un mismo incidente actualizan la alerta abierta
+en lugar de crear alertas y asignaciones nuevas
+"""
+
+import logging
+import threading
+import time
+
+from cache_recursos import distancia_haversine
+
+logger = logging.getLogger(__name__)
+
+# Indices compartidos por los SistemaEmergencias del proceso (ver indice_compartido)
+_COMPARTIDOS = {}
+_LOCK_COMPARTIDOS = threading.Lock()
+
+
+class IndiceIncidentes:
+    """
+    Alertas abiertas (pendiente/asignada) por dispositivo_id.
+
+    Una alerta nueva se agrupa con una abierta del mismo dispositivo si es
+    del mismo tipo, esta a menos de `radio_metros` y la abierta tuvo
+    actividad en los ultimos `ventana_segundos`. Las que llevan mas de la
+    ventana sin actividad ya no agrupan y se retiran en una pasada cada
+    `ventana_segundos / 10` (aunque se resuelvan desde otro proceso).
+    """
+
+    def __init__(self, radio_metros: float = 500, ventana_segundos: float = 900):
+        self.radio = radio_metros
+        self.ventana = ventana_segundos
+        self.cargado = False
+        self._abiertas = {}
+        self._por_alerta = {}
+        self._lock = threading.Lock()
+        self._proxima_purga = time.time() + ventana_segundos / 10
+
+        # Metricas
+        self.coalescidas = 0
+
+    def cargar(self, cursor):
+        """Carga las alertas abiertas con actividad dentro de la ventana"""
+        cursor.execute("""
+            SELECT
+                a.id AS alerta_id,
+                a.dispositivo_id,
+                a.tipo,
+                ST_Y(a.ubicacion) AS latitud,
+                ST_X(a.ubicacion) AS longitud,
+                EXTRACT(EPOCH FROM (CURRENT_TIMESTAMP - a.fecha_ultima_actividad)) AS antiguedad,
+                pe.id AS recurso_id,
+                pe.nombre,
+                pe.municipio,
+                asg.distancia_metros,
+                asg.tiempo_estimado_segundos
+            FROM alertas a
+            LEFT JOIN asignaciones asg ON asg.alerta_id = a.id
+            LEFT JOIN puntos_emergencia pe ON pe.id = asg.punto_emergencia_id
+            WHERE
+                a.estado != 'resuelta'
+                AND a.fecha_ultima_actividad > CURRENT_TIMESTAMP - make_interval(secs => %s)
+        """, (self.ventana,))
+        filas = cursor.fetchall()
+        cursor.connection.commit()
+
+        ahora = time.time()
+        with self._lock:
+            self._abiertas = {}
+            self._por_alerta = {}
+            for fila in filas:
+                if fila['recurso_id'] is not None:
+                    resultado = {
+                        'exito': True,
+                        'alerta_id': fila['alerta_id'],
+                        'dispositivo_id': fila['dispositivo_id'],
+                        'tipo': fila['tipo'],
+                        'asignacion': {
+                            'recurso_id': fila['recurso_id'],
+                            'nombre': fila['nombre'],
+                            'municipio': fila['municipio'],
+                            'distancia_metros': float(fila['distancia_metros']),
+                            'tiempo_estimado_minutos': fila['tiempo_estimado_segundos'] // 60
+                        }
+                    }
+                else:
+                    resultado = {
+                        'exito': False,
+                        'alerta_id': fila['alerta_id'],
+                        'error': 'Sin recursos disponibles'
+                    }
+                self._guardar(
+                    fila['dispositivo_id'], fila['tipo'],
+                    fila['latitud'], fila['longitud'],
+                    resultado, ahora - float(fila['antiguedad'])
+                )
+            self.cargado = True
+
+        logger.info(f"Indice de incidentes cargado: {len(filas)} alertas abiertas")
+
+    def buscar(self, dispositivo_id: str, tipo: str, latitud: float, longitud: float) -> dict:
+        """Resultado de la alerta abierta con la que agrupar, o None"""
+        ahora = time.time()
+        with self._lock:
+            self._purgar(ahora)
+            for incidente in self._abiertas.get(dispositivo_id, ()):
+                if (
+                    incidente['tipo'] == tipo
+                    and ahora - incidente['ultima'] <= self.ventana
+                    and distancia_haversine(
+                        latitud, longitud, incidente['latitud'], incidente['longitud']
+                    ) <= self.radio
+                ):
+                    return incidente['resultado']
+        return None
+
+    def registrar(self, dispositivo_id: str, tipo: str, latitud: float,
+                  longitud: float, resultado: dict):
+        """Anade la alerta recien creada (resultado de procesar_alerta)"""
+        ahora = time.time()
+        with self._lock:
+            self._purgar(ahora)
+            self._guardar(dispositivo_id, tipo, latitud, longitud, resultado, ahora)
+
+    def actualizar(self, alerta_id: int, latitud: float, longitud: float):
+        """Nueva pulsacion agrupada: ultima posicion y ultima actividad"""
+        with self._lock:
+            incidente = self._por_alerta.get(alerta_id)
+            if incidente:
+                incidente['latitud'] = latitud
+                incidente['longitud'] = longitud
+                incidente['ultima'] = time.time()
+                self.coalescidas += 1
+
+    def cerrar(self, alerta_id: int):
+        with self._lock:
+            self._quitar(alerta_id)
+
+    def __len__(self):
+        return len(self._por_alerta)
+
+    def _purgar(self, ahora: float):
+        """Retira las alertas sin actividad en la ventana (con el bloqueo tomado)"""
+        if ahora < self._proxima_purga:
+            return
+        self._proxima_purga = ahora + self.ventana / 10
+        limite = ahora - self.ventana
+        caducadas = [a for a, incidente in self._por_alerta.items() if incidente['ultima'] < limite]
+        for alerta_id in caducadas:
+            self._quitar(alerta_id)
+        if caducadas:
+            logger.debug("Indice de incidentes: %d alertas sin actividad retiradas", len(caducadas))
+
+    def _quitar(self, alerta_id: int):
+        incidente = self._por_alerta.pop(alerta_id, None)
+        if incidente:
+            abiertas = self._abiertas.get(incidente['dispositivo_id'], [])
+            abiertas.remove(incidente)
+            if not abiertas:
+                del self._abiertas[incidente['dispositivo_id']]
+
+    def _guardar(self, dispositivo_id, tipo, latitud, longitud, resultado, ultima):
+        incidente = {
+            'dispositivo_id': dispositivo_id,
+            'tipo': tipo,
+            'latitud': latitud,
+            'longitud': longitud,
+            'ultima': ultima,
+            'resultado': resultado
+        }
+        self._abiertas.setdefault(dispositivo_id, []).append(incidente)
+        self._por_alerta[resultado['alerta_id']] = incidente
+
+
+def indice_compartido(clave: tuple, radio_metros: float = 500,
+                      ventana_segundos: float = 900) -> IndiceIncidentes:
+    """
+    Un indice por proceso y `clave` (la BD y los parametros): los
+    trabajadores con SistemaEmergencias propio agrupan contra las mismas
+    alertas abiertas y la memoria no se multiplica por trabajador
+    """
+    with _LOCK_COMPARTIDOS:
+        indice = _COMPARTIDOS.get(clave)
+        if indice is None:
+            indice = _COMPARTIDOS[clave] = IndiceIncidentes(radio_metros, ventana_segundos)
+        return indice
@@ -7,7 +7,47 @@ DB_CONFIG = {
     'port': 5432,
     'database': 'sistema_emergencias',
     'user': 'postgres',
-    'password': 'tu_password_aqui'  # CAMBIAR
+    'password': 'tu_password_aqui',  # CAMBIAR
+    # Pool de conexiones (0 = una sola conexion compartida)
+    'pool_max': 0,
+    'pool_min': 0,                   # por defecto igual a pool_max
+    'pool_ping_segundos': 30,        # comprobar conexiones ociosas antes de usarlas
+    # Registrar y asignar con una sola llamada (funcion registrar_y_asignar)
+    'ruta_rapida': False,
+    # Candidatos KNN sobre los que se calcula la distancia geodesica exacta
+    'knn_candidatos': 10,
+    # Reclamar recursos con FOR UPDATE SKIP LOCKED (varios trabajadores)
+    'asignacion_concurrente': False,
+    'reintentos_asignacion': 5,
+    # Registrar uplinks en uplinks_procesados (deduplicacion entre instancias)
+    'dedup_persistente': False,
+    # Un uplink registrado hace mas de esto vuelve a aceptarse (fCnt
+    # reiniciado); retencion.py borra las filas mas antiguas
+    'dedup_ventana_segundos': 86400,
+    # Indice en memoria de recursos disponibles (LISTEN/NOTIFY)
+    'cache_recursos': False,
+    'cache_celda_grados': 0.05,
+    'cache_max_retraso': 15,         # segundos sin latido antes de volver a SQL
+    # Agrupar pulsaciones repetidas de un dispositivo en su alerta abierta
+    'coalescencia': False,
+    'coalescencia_radio_metros': 500,
+    'coalescencia_ventana_segundos': 900,
+    # Almacen: 'postgis' o 'memoria' (sin BD, para pruebas y benchmarks)
+    'almacen': 'postgis',
+    'almacen_puntos': 'sistema_emergencias.sql',  # o n de recursos sinteticos
+    # Rejilla de tiempos de viaje por carretera (tiempos_viaje.py): los
+    # candidatos KNN se ordenan por tiempo de llegada. None = linea recta.
+    # La ruta rapida (funcion SQL) sigue usando la linea recta
+    'tiempos_viaje': None,           # p.ej. 'tiempos_viaje.bin'
+    # Reparto de los micro-lotes (lote_max en PROCESAMIENTO_CONFIG):
+    # 'voraz' en orden de llegada u 'optimo' (despacho.py), que con recursos
+    # escasos cubre mas alertas y con menor tiempo total. Por encima de
+    # despacho_max_celdas (alertas x plazas libres) se reparte en voraz
+    'despacho': 'voraz',
+    'despacho_max_celdas': 1000000,
+    # Avisar (NOTIFY) de las alertas que se quedan sin recurso para que el
+    # motor de reasignacion (reasignacion.py) las asigne al liberarse uno
+    'reasignacion': False
 }
 
 # MQTT (ChirpStack)
@@ -19,4 +59,59 @@ MQTT_CONFIG = {
     'topic': 'application/+/device/+/event/up'
 }
 
-
+# Procesamiento de alertas (listener)
+PROCESAMIENTO_CONFIG = {
+    'trabajadores': 4,               # 0 = procesar en el hilo MQTT
+    'capacidad_cola': 1000,
+    'politica_cola': 'bloquear',     # bloquear | descartar_antiguo | disco
+    'ruta_desborde': 'cola_desborde.jsonl',
+    # Carriles de prioridad en lugar de la cola FIFO (None = desactivado). El
+    # carril sale del tipo y de los flags (latido o payload invalido -> baja,
+    # reintento de una critica -> normal). Los carriles con alertas reales
+    # bloquean: solo el bajo puede descartar sin perder alertas
+    'carriles': None,                # p.ej. procesamiento.CARRILES_DEFECTO:
+    #   {'critica': {'capacidad': 1000, 'politica': 'bloquear', 'peso': 8, 'slo_ms': 250},
+    #    'normal': {'capacidad': 5000, 'politica': 'bloquear', 'peso': 3, 'slo_ms': 2000},
+    #    'baja': {'capacidad': 5000, 'politica': 'descartar_antiguo', 'peso': 1, 'slo_ms': 30000}}
+    'despacho_carriles': 'estricto', # estricto | ponderado (turnos por peso)
+    'carril_por_tipo': {'medica': 'critica', 'rescate': 'critica', 'bomberos': 'critica', 'policial': 'normal'},
+    'intervalo_metricas': 60,        # segundos, 0 = desactivado
+    # Micro-lotes: un INSERT masivo y un commit por lote (0 = desactivado).
+    # Con trabajadores > 0, un solo hilo lee la cola y arma los lotes
+    'lote_max': 0,
+    'lote_espera_ms': 20,            # espera maxima de una alerta en el lote
+    'lote_espera_por_tipo': {'medica': 5, 'rescate': 5},
+    # Deduplicacion de uplinks en memoria (devEUI + fCnt)
+    'dedup_ttl_segundos': 300,
+    'dedup_max_entradas': 100000,
+    # Listener asincrono (asincrono.py): alertas procesandose a la vez
+    'max_en_vuelo': 200,
+    # Supervisor (supervisor.py): procesos listener y reparto entre ellos
+    'procesos': 0,                   # 0 = uno por nucleo
+    'reparto': 'hash',               # hash (un dispositivo, un proceso) | compartida
+    # Con reparto hash, un solo consumidor por proceso para no reordenar los
+    # uplinks de un dispositivo: sin carriles y, sin micro-lotes ni spool,
+    # trabajadores = 0. False = mas hilos por proceso, sin orden
+    'orden_por_dispositivo': True,
+    'grupo_compartido': 'sistema_emergencias',
+    # Metricas por etapa (metricas.py): /metrics Prometheus y resumen en el log
+    'puerto_metricas': 0,            # 0 = desactivado; con supervisor, puerto + indice
+    'volcado_metricas': 0,           # segundos entre resumenes p50/p99, 0 = desactivado
+    # Spool en disco (spool.py): las alertas se guardan antes de ir a BD y se
+    # registran por lotes cuando la BD responde. None = desactivado.
+    # Conviene dedup_persistente para no repetir alertas al reanudar
+    'spool_directorio': None,        # p.ej. 'spool'; con supervisor, un subdirectorio por proceso
+    'spool_fsync_ms': 50,            # ventana de fsync agrupado
+    'spool_lote': 100,
+    'spool_segmento_mb': 16,
+    # Motor de reasignacion en el listener (con supervisor, solo el primer
+    # proceso); tambien se puede lanzar aparte: python reasignacion.py
+    'motor_reasignacion': False,
+    'reasignacion_ventana_segundos': 30,  # entre pendientes de edad parecida, la mas cercana
+    # Telemetria de bateria y registro de dispositivos (telemetria.py): se
+    # acumula en memoria y se vuelca a BD por lotes, fuera de la ruta de la alerta
+    'telemetria': False,
+    'telemetria_buffer': 100000,     # filas en memoria; si la BD no responde se pierden las mas antiguas
+    'telemetria_intervalo': 5,       # segundos entre volcados
+    'bateria_baja': 20               # umbral del medidor dispositivos_bateria_baja
+}
@@ -0,0 +1,439 @@
+"""
+API de lectura para paneles de despacho
+
+Sirve las alertas abiertas, la utilizacion de recursos por municipio y las
+ultimas asignaciones desde una instantanea en memoria, sin consultar la BD
+en cada peticion. La instantanea se carga al conectar (y al reconectar) y
+se mantiene con las notificaciones de los triggers:
+
+    - recursos_emergencia (notificar_recurso): capacidad de cada recurso
+    - alertas_eventos (notificar_alerta, notificar_asignacion): altas,
+      asignaciones y resoluciones
+
+Cada vista tiene su version: el ETag cambia solo cuando cambia lo que
+devuelve, y un panel que pregunta con If-None-Match recibe 304 sin cuerpo.
+LISTEN no funciona en las replicas de solo lectura: la escucha va contra
+el primario, pero solo le cuesta la carga inicial y los avisos.
+
+Uso: python consultas.py [--puerto 9110] [--host 127.0.0.1]
+"""
+
+import argparse
+import collections
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from psycopg2.extras import RealDictCursor
+
+from cache_recursos import CANAL_RECURSOS
+from decoder import PayloadDecoder
+from notificaciones import EscuchaNotificaciones
+
+logger = logging.getLogger(__name__)
+
+CANAL_ALERTAS = 'alertas_eventos'
+
+VISTAS = ('alertas', 'municipios', 'asignaciones')
+
+# Valores de tipo_emergencia: cada parametro distinto ocupa una entrada de la cache
+TIPOS = frozenset(PayloadDecoder.TIPOS.values())
+
+CONSULTA_RECURSOS = """
+    SELECT id, codigo, nombre, tipo, municipio, capacidad_actual, capacidad_maxima, disponible
+    FROM puntos_emergencia
+"""
+
+CONSULTA_ABIERTAS = """
+    SELECT
+        a.id,
+        a.dispositivo_id,
+        a.tipo,
+        a.estado,
+        ST_X(a.ubicacion) AS lon,
+        ST_Y(a.ubicacion) AS lat,
+        EXTRACT(EPOCH FROM a.fecha_creacion::TIMESTAMPTZ) AS fecha,
+        asg.punto_emergencia_id AS recurso_id,
+        asg.distancia_metros,
+        asg.tiempo_estimado_segundos,
+        EXTRACT(EPOCH FROM asg.fecha_asignacion::TIMESTAMPTZ) AS fecha_asignacion
+    FROM alertas a
+    LEFT JOIN asignaciones asg
+        ON asg.alerta_id = a.id AND asg.fecha_asignacion >= a.fecha_creacion
+    WHERE a.estado <> 'resuelta'
+"""
+
+# Solo las particiones del ultimo dia
+CONSULTA_RECIENTES = """
+    SELECT
+        asg.alerta_id AS id,
+        asg.punto_emergencia_id AS recurso_id,
+        asg.distancia_metros,
+        asg.tiempo_estimado_segundos,
+        EXTRACT(EPOCH FROM asg.fecha_asignacion::TIMESTAMPTZ) AS fecha
+    FROM asignaciones asg
+    WHERE asg.fecha_asignacion > CURRENT_TIMESTAMP - INTERVAL '1 day'
+    ORDER BY asg.fecha_asignacion DESC
+    LIMIT %s
+"""
+
+
+class Instantanea:
+    """
+    Recursos, alertas abiertas y ultimas asignaciones en memoria, con una
+    version por vista y el JSON de cada consulta cacheado hasta que cambia
+    """
+
+    def __init__(self, max_recientes: int = 200):
+        self.max_recientes = max_recientes
+        self.cargada = False
+
+        self._lock = threading.Lock()
+        self._recursos = {}
+        self._abiertas = {}
+        self._recientes = collections.deque(maxlen=max_recientes)
+        self._versiones = dict.fromkeys(VISTAS, 0)
+        self._cache = {}
+        # Cambia en cada carga completa: un ETag anterior nunca coincide
+        self._generacion = f"{int(time.time() * 1000):x}"
+
+    # Mantenimiento (hilo de EscuchaNotificaciones)
+
+    def cargar(self, conn):
+        """Carga completa, despues del LISTEN"""
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(CONSULTA_RECURSOS)
+            recursos = cursor.fetchall()
+            cursor.execute(CONSULTA_ABIERTAS)
+            abiertas = cursor.fetchall()
+            cursor.execute(CONSULTA_RECIENTES, (self.max_recientes,))
+            recientes = cursor.fetchall()
+
+        with self._lock:
+            self._recursos = {fila['id']: dict(fila) for fila in recursos}
+            self._abiertas = {}
+            for fila in abiertas:
+                alerta = _alerta(fila)
+                if fila['recurso_id'] is not None:
+                    alerta['asignacion'] = _asignacion(dict(
+                        fila, fecha=fila['fecha_asignacion']
+                    ))
+                self._abiertas[alerta['id']] = alerta
+            self._recientes.clear()
+            self._recientes.extend(_asignacion(fila) for fila in reversed(recientes))
+
+            self._generacion = f"{int(time.time() * 1000):x}"
+            self._versiones = dict.fromkeys(VISTAS, 0)
+            self._cache = {}
+            self.cargada = True
+
+        logger.info(f"Instantanea cargada: {len(recursos)} recursos, {len(abiertas)} alertas abiertas")
+
+    def actualizar(self, canal: str, datos: dict):
+        with self._lock:
+            if canal == CANAL_RECURSOS:
+                self._actualizar_recurso(datos)
+            elif datos['evento'] == 'alta':
+                # Una historica ya resuelta no tendra evento que la cierre
+                if datos.get('estado') == 'resuelta':
+                    return
+                self._abiertas[datos['id']] = _alerta(datos)
+                self._versiones['alertas'] += 1
+            elif datos['evento'] == 'asignacion':
+                asignacion = _asignacion(datos)
+                alerta = self._abiertas.get(datos['id'])
+                if alerta is not None:
+                    alerta['estado'] = 'asignada'
+                    alerta['asignacion'] = asignacion
+                    self._versiones['alertas'] += 1
+                self._recientes.append(asignacion)
+                self._versiones['asignaciones'] += 1
+            elif datos['evento'] == 'resuelta':
+                if self._abiertas.pop(datos['id'], None) is not None:
+                    self._versiones['alertas'] += 1
+
+    def _actualizar_recurso(self, datos: dict):
+        anterior = self._recursos.get(datos['id'], {})
+        if datos.get('operacion') == 'DELETE':
+            self._recursos.pop(datos['id'], None)
+            recurso = {}
+        else:
+            recurso = self._recursos[datos['id']] = {
+                campo: datos.get(campo)
+                for campo in ('id', 'codigo', 'nombre', 'tipo', 'municipio',
+                              'capacidad_actual', 'capacidad_maxima', 'disponible')
+            }
+        self._versiones['municipios'] += 1
+
+        # Las asignaciones muestran nombre y municipio del recurso
+        if (anterior.get('nombre'), anterior.get('municipio')) != (recurso.get('nombre'), recurso.get('municipio')):
+            self._versiones['alertas'] += 1
+            self._versiones['asignaciones'] += 1
+
+    # Lectura
+
+    def alertas_abiertas(self, tipo: str = None) -> list:
+        """Alertas sin resolver (con su asignacion, si la tienen), mas antiguas primero"""
+        with self._lock:
+            alertas = [
+                self._con_recurso(alerta) for alerta in self._abiertas.values()
+                if tipo is None or alerta['tipo'] == tipo
+            ]
+        alertas.sort(key=lambda a: a['fecha'])
+        return alertas
+
+    def utilizacion_por_municipio(self) -> list:
+        """Capacidad ocupada y total de los recursos de cada municipio, por tipo"""
+        municipios = {}
+        with self._lock:
+            for recurso in self._recursos.values():
+                municipio = municipios.setdefault(recurso['municipio'], {
+                    'municipio': recurso['municipio'],
+                    'recursos': 0,
+                    'disponibles': 0,
+                    'capacidad_actual': 0,
+                    'capacidad_maxima': 0,
+                    'por_tipo': {}
+                })
+                por_tipo = municipio['por_tipo'].setdefault(
+                    recurso['tipo'], {'capacidad_actual': 0, 'capacidad_maxima': 0}
+                )
+                for resumen in (municipio, por_tipo):
+                    resumen['capacidad_actual'] += recurso['capacidad_actual']
+                    resumen['capacidad_maxima'] += recurso['capacidad_maxima']
+                municipio['recursos'] += 1
+                municipio['disponibles'] += bool(recurso['disponible'])
+
+        for municipio in municipios.values():
+            municipio['utilizacion'] = _proporcion(municipio)
+            for por_tipo in municipio['por_tipo'].values():
+                por_tipo['utilizacion'] = _proporcion(por_tipo)
+        return sorted(municipios.values(), key=lambda m: m['municipio'])
+
+    def asignaciones_recientes(self, limite: int = None) -> list:
+        """Ultimas asignaciones, la mas reciente primero"""
+        with self._lock:
+            recientes = list(self._recientes)
+            recientes.reverse()
+            return [self._con_recurso_asignacion(a) for a in recientes[:limite]]
+
+    def vista(self, nombre: str, **parametros) -> tuple:
+        """
+        JSON de una vista y su ETag, cacheados hasta que la vista cambie
+
+        Returns:
+            (etag, cuerpo en bytes)
+        """
+        clave = (nombre, tuple(sorted(parametros.items())))
+        with self._lock:
+            version = self._versiones[nombre]
+            etag = f'"{self._generacion}-{version}"'
+            cacheada = self._cache.get(clave)
+            if cacheada is not None and cacheada[0] == etag:
+                return cacheada
+
+        if nombre == 'alertas':
+            datos = self.alertas_abiertas(parametros.get('tipo'))
+        elif nombre == 'municipios':
+            datos = self.utilizacion_por_municipio()
+        else:
+            datos = self.asignaciones_recientes(parametros.get('limite'))
+        cuerpo = json.dumps(datos, ensure_ascii=False, default=float).encode('utf-8')
+
+        with self._lock:
+            # Si ha cambiado mientras se serializaba, se sirve igual pero no se guarda
+            if self._versiones[nombre] == version and f'"{self._generacion}-{version}"' == etag:
+                self._cache[clave] = (etag, cuerpo)
+        return etag, cuerpo
+
+    def _con_recurso(self, alerta: dict) -> dict:
+        alerta = dict(alerta)
+        if 'asignacion' in alerta:
+            alerta['asignacion'] = self._con_recurso_asignacion(alerta['asignacion'])
+        return alerta
+
+    def _con_recurso_asignacion(self, asignacion: dict) -> dict:
+        recurso = self._recursos.get(asignacion['recurso_id'], {})
+        return dict(asignacion, nombre=recurso.get('nombre'), municipio=recurso.get('municipio'))
+
+
+def _alerta(fila) -> dict:
+    return {
+        'id': fila['id'],
+        'dispositivo_id': fila['dispositivo_id'],
+        'tipo': fila['tipo'],
+        'estado': fila['estado'],
+        'lat': fila['lat'],
+        'lon': fila['lon'],
+        'fecha': float(fila['fecha'])
+    }
+
+
+def _asignacion(fila) -> dict:
+    return {
+        'alerta_id': fila['id'],
+        'recurso_id': fila['recurso_id'],
+        'distancia_metros': float(fila['distancia_metros']),
+        'tiempo_estimado_segundos': fila['tiempo_estimado_segundos'],
+        'fecha': float(fila['fecha'])
+    }
+
+
+def _proporcion(resumen: dict) -> float:
+    if not resumen['capacidad_maxima']:
+        return 0.0
+    return round(resumen['capacidad_actual'] / resumen['capacidad_maxima'], 3)
+
+
+class ServidorConsultas:
+    """
+    Servidor HTTP local de solo lectura:
+
+        /alertas[?tipo=medica]     alertas abiertas
+        /municipios                utilizacion de recursos por municipio
+        /asignaciones[?limite=50]  ultimas asignaciones
+        /estado                    carga y retraso de la escucha
+    """
+
+    def __init__(self, instantanea: Instantanea, escucha: EscuchaNotificaciones = None,
+                 puerto: int = 9110, host: str = '127.0.0.1'):
+        instantanea_servida = instantanea
+
+        class _Manejador(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                partes = urlsplit(self.path)
+                nombre = partes.path.strip('/')
+                parametros = {k: v[-1] for k, v in parse_qs(partes.query).items()}
+
+                if nombre == 'estado':
+                    self._responder(200, json.dumps({
+                        'cargada': instantanea_servida.cargada,
+                        'al_dia': escucha.al_dia() if escucha is not None else None
+                    }).encode('utf-8'))
+                    return
+                if nombre not in VISTAS:
+                    self.send_error(404)
+                    return
+                if not instantanea_servida.cargada:
+                    self.send_error(503, "Instantanea sin cargar")
+                    return
+
+                argumentos = {}
+                if nombre == 'alertas' and 'tipo' in parametros:
+                    if parametros['tipo'] not in TIPOS:
+                        self.send_error(400, f"tipo debe ser uno de: {', '.join(sorted(TIPOS))}")
+                        return
+                    argumentos['tipo'] = parametros['tipo']
+                if nombre == 'asignaciones' and 'limite' in parametros:
+                    try:
+                        # Mas alla de max_recientes la respuesta es la misma
+                        argumentos['limite'] = min(max(int(parametros['limite']), 0),
+                                                   instantanea_servida.max_recientes)
+                    except ValueError:
+                        self.send_error(400, "limite debe ser un entero")
+                        return
+
+                etag, cuerpo = instantanea_servida.vista(nombre, **argumentos)
+                if etag in self.headers.get('If-None-Match', ''):
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                self._responder(200, cuerpo, etag)
+
+            def _responder(self, codigo, cuerpo, etag=None):
+                self.send_response(codigo)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(cuerpo)))
+                self.send_header('Cache-Control', 'no-cache')
+                if etag is not None:
+                    self.send_header('ETag', etag)
+                if escucha is not None and not escucha.al_dia():
+                    self.send_header('X-Instantanea-Retrasada', '1')
+                self.end_headers()
+                self.wfile.write(cuerpo)
+
+            def log_message(self, formato, *args):
+                pass
+
+        self.servidor = ThreadingHTTPServer((host, puerto), _Manejador)
+        self.servidor.daemon_threads = True
+        self._hilo = None
+
+    def iniciar(self):
+        self._hilo = threading.Thread(target=self.servidor.serve_forever, name="consultas-http", daemon=True)
+        self._hilo.start()
+        host, puerto = self.servidor.server_address[:2]
+        logger.info(f"API de consultas en http://{host}:{puerto}/")
+
+    def detener(self):
+        self.servidor.shutdown()
+        self.servidor.server_close()
+
+
+class ServicioConsultas:
+    """Instantanea, escucha de notificaciones y servidor HTTP juntos"""
+
+    def __init__(self, db_config: dict, puerto: int = 9110, host: str = '127.0.0.1',
+                 max_recientes: int = 200):
+        self.instantanea = Instantanea(max_recientes)
+        self.escucha = EscuchaNotificaciones(
+            {
+                'host': db_config['host'],
+                'port': db_config.get('port', 5432),
+                'database': db_config['database'],
+                'user': db_config['user'],
+                'password': db_config['password'],
+                'options': '-c client_encoding=UTF8'
+            },
+            [CANAL_ALERTAS, CANAL_RECURSOS],
+            al_notificar=self.instantanea.actualizar,
+            al_conectar=self.instantanea.cargar
+        )
+        self.servidor = ServidorConsultas(self.instantanea, self.escucha, puerto, host)
+
+    def iniciar(self):
+        self.escucha.iniciar()
+        self.servidor.iniciar()
+
+    def detener(self):
+        self.servidor.detener()
+        self.escucha.detener()
+
+
+def signal_handler(sig, frame):
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="API de lectura de incidentes abiertos")
+    parser.add_argument('--puerto', type=int, default=9110)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--recientes', type=int, default=200, help="asignaciones recientes en memoria")
+    args = parser.parse_args()
+
+    if sys.platform == 'win32':
+        os.environ['PGCLIENTENCODING'] = 'UTF8'
+
+    signal.signal(signal.SIGINT, signal_handler)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    try:
+        from config import DB_CONFIG
+    except ImportError:
+        print("Error: No se encontro config.py")
+        sys.exit(1)
+
+    servicio = ServicioConsultas(DB_CONFIG, args.puerto, args.host, args.recientes)
+    try:
+        servicio.iniciar()
+        threading.Event().wait()
+    finally:
+        servicio.detener()
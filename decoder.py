@@ -1,11 +1,76 @@
 """Decodificador de payloads LoRaWAN"""
 
 import base64
+import binascii
 import struct
 import logging
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 logger = logging.getLogger(__name__)
 
+# [tipo][lat 4B][lon 4B][bat][flags]
+FORMATO_PAYLOAD = '>BiiBB'
+TAMANO_PAYLOAD = struct.calcsize(FORMATO_PAYLOAD)
+
+# Bits del byte de flags
+FLAG_BOTON = 0x01       # pulsacion del boton
+FLAG_REINTENTO = 0x02   # retransmision de una alerta ya enviada
+FLAG_LATIDO = 0x04      # latido periodico del dispositivo
+
+if np is not None:
+    DTYPE_PAYLOAD = np.dtype([
+        ('tipo', 'u1'),
+        ('lat', '>i4'),
+        ('lon', '>i4'),
+        ('bateria', 'u1'),
+        ('flags', 'u1')
+    ])
+
+
+class LoteDecodificado:
+    """
+    Resultado columnar de PayloadDecoder.decode_batch.
+
+    Cada columna tiene una posicion por payload de entrada; las filas con
+    valido[i] == 0 no se pudieron decodificar y sus valores son 0.
+    Las columnas son arrays de NumPy si esta instalado, o array.array si no.
+    """
+
+    def __init__(self, valido, tipo_codigo, latitud, longitud, bateria, flags):
+        self.valido = valido
+        self.tipo_codigo = tipo_codigo
+        self.latitud = latitud
+        self.longitud = longitud
+        self.bateria = bateria
+        self.flags = flags
+
+    def __len__(self):
+        return len(self.valido)
+
+    def tipos(self) -> list:
+        """Nombre del tipo de emergencia de cada fila (None si no es valida)"""
+        return [
+            PayloadDecoder.TIPOS.get(int(c), 'medica') if v else None
+            for c, v in zip(self.tipo_codigo, self.valido)
+        ]
+
+    def fila(self, i: int) -> dict:
+        """Fila i con el mismo formato que PayloadDecoder.decode"""
+        if not self.valido[i]:
+            return None
+        return {
+            'tipo': PayloadDecoder.TIPOS.get(int(self.tipo_codigo[i]), 'medica'),
+            'latitud': float(self.latitud[i]),
+            'longitud': float(self.longitud[i]),
+            'bateria': int(self.bateria[i]),
+            'flags': int(self.flags[i])
+        }
+
 
 class PayloadDecoder:
     """Decodifica los mensajes binarios de los dispositivos"""
@@ -25,29 +90,100 @@ class PayloadDecoder:
         try:
             payload_bytes = base64.b64decode(payload_base64)
             
-            if len(payload_bytes) < 11:
+            if len(payload_bytes) < TAMANO_PAYLOAD:
                 logger.error(f"Payload incompleto: {len(payload_bytes)} bytes")
                 return None
             
-            tipo_codigo = payload_bytes[0]
-            lat_raw = struct.unpack('>i', payload_bytes[1:5])[0]
-            lon_raw = struct.unpack('>i', payload_bytes[5:9])[0]
-            bateria = payload_bytes[9]
+            tipo_codigo, lat_raw, lon_raw, bateria, flags = struct.unpack_from(
+                FORMATO_PAYLOAD, payload_bytes
+            )
             
             # Las coordenadas vienen multiplicadas por 10^6
             latitud = lat_raw / 1_000_000.0
             longitud = lon_raw / 1_000_000.0
             tipo = self.TIPOS.get(tipo_codigo, 'medica')
             
-            logger.info(f"Payload decodificado: tipo={tipo}, coords=({latitud:.6f}, {longitud:.6f})")
+            logger.debug("Payload decodificado: tipo=%s, coords=(%.6f, %.6f)", tipo, latitud, longitud)
             
             return {
                 'tipo': tipo,
                 'latitud': latitud,
                 'longitud': longitud,
-                'bateria': bateria
+                'bateria': bateria,
+                'flags': flags
             }
             
         except Exception as e:
             logger.error(f"Error decodificando: {e}")
             return None
+    
+    def cabecera(self, payload_base64: str) -> tuple:
+        """
+        Tipo y flags sin decodificar coordenadas ni registrar errores
+        (clasificacion por prioridad en el listener)
+        
+        Returns:
+            (tipo, flags), o None si el payload no es valido
+        """
+        try:
+            payload_bytes = binascii.a2b_base64(payload_base64)
+        except (binascii.Error, TypeError, ValueError):
+            return None
+        if len(payload_bytes) < TAMANO_PAYLOAD:
+            return None
+        return self.TIPOS.get(payload_bytes[0], 'medica'), payload_bytes[TAMANO_PAYLOAD - 1]
+    
+    def decode_batch(self, payloads) -> LoteDecodificado:
+        """
+        Decodifica muchos payloads de una vez en formato columnar.
+        
+        Los payloads invalidos no lanzan excepcion ni devuelven None:
+        quedan marcados con valido[i] == 0.
+        """
+        payloads = list(payloads)
+        n = len(payloads)
+        
+        # Copiar los 11 bytes de cada payload a un unico buffer contiguo
+        buffer = bytearray(n * TAMANO_PAYLOAD)
+        valido = bytearray(n)
+        a2b = binascii.a2b_base64
+        
+        for i, payload in enumerate(payloads):
+            try:
+                payload_bytes = a2b(payload)
+            except (binascii.Error, TypeError, ValueError):
+                continue
+            if len(payload_bytes) < TAMANO_PAYLOAD:
+                continue
+            inicio = i * TAMANO_PAYLOAD
+            buffer[inicio:inicio + TAMANO_PAYLOAD] = payload_bytes[:TAMANO_PAYLOAD]
+            valido[i] = 1
+        
+        invalidos = n - sum(valido)
+        if invalidos:
+            logger.warning("Lote con %d payloads invalidos de %d", invalidos, n)
+        
+        if np is not None:
+            registros = np.frombuffer(bytes(buffer), dtype=DTYPE_PAYLOAD)
+            return LoteDecodificado(
+                valido=np.frombuffer(bytes(valido), dtype=np.bool_),
+                tipo_codigo=registros['tipo'],
+                latitud=registros['lat'] / 1_000_000.0,
+                longitud=registros['lon'] / 1_000_000.0,
+                bateria=registros['bateria'],
+                flags=registros['flags']
+            )
+        
+        if n:
+            tipos, lats, lons, baterias, flags = zip(*struct.iter_unpack(FORMATO_PAYLOAD, buffer))
+        else:
+            tipos = lats = lons = baterias = flags = ()
+        
+        return LoteDecodificado(
+            valido=array('B', valido),
+            tipo_codigo=array('B', tipos),
+            latitud=array('d', [x / 1_000_000.0 for x in lats]),
+            longitud=array('d', [x / 1_000_000.0 for x in lons]),
+            bateria=array('B', baterias),
+            flags=array('B', flags)
+        )
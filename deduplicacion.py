@@ -0,0 +1,88 @@
+"""
+Deduplicacion de uplinks LoRaWAN
+Un mismo uplink llega por varios gateways y los dispositivos lo reenvian
+si no reciben confirmacion
+"""
+
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def clave_uplink(dev_eui: str, mensaje: dict) -> str:
+    """
+    Identificador del uplink: devEUI + fCnt, o devEUI + huella del payload
+    si el mensaje no trae contador de tramas
+    """
+    f_cnt = mensaje.get('fCnt')
+    if f_cnt is not None:
+        return f"{dev_eui}:{f_cnt}"
+
+    huella = hashlib.blake2b(
+        mensaje.get('data', '').encode('utf-8'),
+        digest_size=8
+    ).hexdigest()
+    return f"{dev_eui}:h{huella}"
+
+
+def clave_persistente(uplink_id: str) -> str:
+    """
+    La clave si puede registrarse en uplinks_procesados, o None si es la
+    huella del payload: dos pulsaciones distintas con el mismo payload
+    (mismo tipo y posicion) tienen la misma huella, y en BD la segunda se
+    descartaria como duplicada durante toda la ventana
+    """
+    if uplink_id is None or uplink_id.rpartition(':')[2].startswith('h'):
+        return None
+    return uplink_id
+
+
+class CacheDeduplicacion:
+    """
+    Claves de uplink vistas en los ultimos `ttl_segundos`, con un maximo
+    de `max_entradas` (se expulsan primero las mas antiguas)
+    """
+
+    def __init__(self, ttl_segundos: float = 300, max_entradas: int = 100_000):
+        self.ttl = ttl_segundos
+        self.max_entradas = max_entradas
+        self._vistas = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Metricas
+        self.duplicados = 0
+
+    def es_duplicado(self, clave: str) -> bool:
+        """Comprueba la clave y la registra si es nueva"""
+        ahora = time.monotonic()
+        with self._lock:
+            self._expirar(ahora)
+
+            if clave in self._vistas:
+                self.duplicados += 1
+                return True
+
+            self._vistas[clave] = ahora
+            if len(self._vistas) > self.max_entradas:
+                self._vistas.popitem(last=False)
+            return False
+
+    def olvidar(self, clave: str):
+        """Quita la clave: el uplink no llego a registrarse y su reenvio debe pasar"""
+        with self._lock:
+            self._vistas.pop(clave, None)
+
+    def __len__(self):
+        return len(self._vistas)
+
+    def _expirar(self, ahora: float):
+        limite = ahora - self.ttl
+        while self._vistas:
+            clave, vista = next(iter(self._vistas.items()))
+            if vista >= limite:
+                break
+            del self._vistas[clave]
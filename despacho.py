@@ -0,0 +1,340 @@
+"""
+Reparto optimo de un lote de alertas entre los recursos disponibles
+Asignacion de coste minimo (metodo hungaro) con la capacidad libre de
+cada recurso como numero de plazas
+"""
+
+import logging
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+from cache_recursos import distancia_haversine, tiempo_estimado, RADIO_TIERRA_METROS
+from metricas import METRICAS
+
+logger = logging.getLogger(__name__)
+
+VORAZ = 'voraz'
+OPTIMO = 'optimo'
+DESPACHOS = (VORAZ, OPTIMO)
+
+
+def repartir_voraz(num_alertas: int, candidatos: dict, libres: dict) -> dict:
+    """
+    Reparto en orden de llegada: cada alerta se queda con su primer
+    candidato con plazas libres
+
+    Args:
+        candidatos: {indice de alerta: filas de recurso en orden de preferencia}
+        libres: {id de recurso: plazas libres} (se descuentan las usadas)
+
+    Returns:
+        {indice de alerta: fila del recurso asignado}
+    """
+    asignaciones = {}
+    for i in range(num_alertas):
+        for recurso in candidatos.get(i, ()):
+            if libres.get(recurso['id'], 0) > 0:
+                libres[recurso['id']] -= 1
+                asignaciones[i] = recurso
+                break
+    return asignaciones
+
+
+def repartir_optimo(alertas: list, recursos: dict, candidatos: dict,
+                    max_celdas: int = 1_000_000) -> dict:
+    """
+    Reparto que cubre el maximo de alertas y, entre los que cubren las
+    mismas, el de menor tiempo estimado total.
+
+    El coste de un par alerta-recurso es el tiempo estimado del candidato
+    si lo es (distancia exacta de PostGIS o rejilla de tiempos de viaje); si
+    no, la formula sobre la distancia haversine. Solo se resuelve el
+    problema si hace falta: si el reparto voraz da a cada alerta su primer
+    candidato ya es optimo, y si la matriz alertas x plazas supera
+    `max_celdas` (demasiada latencia) se queda el voraz.
+
+    Args:
+        alertas: (tipo, latitud, longitud) de cada alerta del lote
+        recursos: {id: recurso} con tipo, lat, lon, velocidad_promedio_kmh,
+            tiempo_preparacion_segundos, libres y los campos de la fila
+            (nombre, municipio...)
+        candidatos: {indice de alerta: filas de recurso en orden de preferencia}
+
+    Returns:
+        {indice de alerta: fila del recurso asignado}
+    """
+    libres = {recurso_id: recurso['libres'] for recurso_id, recurso in recursos.items()}
+    voraz = repartir_voraz(len(alertas), candidatos, dict(libres))
+    if all(voraz.get(i) is filas[0] for i, filas in candidatos.items() if filas):
+        METRICAS.incrementar('despacho_total', modo='voraz_sin_conflicto')
+        return voraz
+
+    # Plazas: cada recurso aparece tantas veces como plazas libres (hasta una por alerta)
+    ids = [recurso_id for recurso_id, n in libres.items() if n > 0]
+    plazas = [min(libres[recurso_id], len(alertas)) for recurso_id in ids]
+    celdas = len(alertas) * sum(plazas)
+    if not celdas:
+        return voraz
+    if celdas > max_celdas:
+        METRICAS.incrementar('despacho_total', modo='voraz_limite')
+        logger.debug("Despacho voraz: %d alertas x %d plazas supera el limite", len(alertas), sum(plazas))
+        return voraz
+
+    with METRICAS.cronometro('etapa_segundos', etapa='despacho'):
+        costes, infinito = _matriz_costes(alertas, [recursos[r] for r in ids], candidatos)
+        columnas = resolver_asignacion(_repetir_columnas(costes, plazas), infinito)
+
+    # Columna de plaza -> recurso
+    recurso_de_plaza = [recurso_id for recurso_id, n in zip(ids, plazas) for _ in range(n)]
+    conocidos = {
+        (i, fila['id']): fila for i, filas in candidatos.items() for fila in filas
+    }
+    optimo = {}
+    for i, columna in enumerate(columnas):
+        if columna < 0:
+            continue
+        recurso_id = recurso_de_plaza[columna]
+        fila = conocidos.get((i, recurso_id))
+        optimo[i] = fila if fila is not None else _fila(recursos[recurso_id], alertas[i])
+
+    METRICAS.incrementar('despacho_total', modo='optimo')
+    if len(optimo) > len(voraz):
+        logger.info(f"Despacho optimo: {len(optimo)} alertas cubiertas (voraz: {len(voraz)})")
+    return optimo
+
+
+def resolver_asignacion(costes, infinito: float) -> list:
+    """
+    Asignacion de coste minimo de filas a columnas (cada columna una vez)
+
+    Args:
+        costes: matriz n x m (array de NumPy o lista de listas); los pares
+            imposibles valen `infinito`
+
+    Returns:
+        Columna de cada fila, o -1 si queda sin asignar
+    """
+    n = len(costes)
+    if not n:
+        return []
+
+    if linear_sum_assignment is not None:
+        filas, columnas = linear_sum_assignment(np.asarray(costes))
+        resultado = [-1] * n
+        for i, j in zip(filas, columnas):
+            if costes[i][j] < infinito:
+                resultado[int(i)] = int(j)
+        return resultado
+
+    m = len(costes[0])
+    if np is not None:
+        columnas = _hungaro_numpy(np.asarray(costes, dtype=float), infinito)
+    else:
+        columnas = _hungaro(costes, infinito)
+    return [j if 0 <= j < m and costes[i][j] < infinito else -1 for i, j in enumerate(columnas)]
+
+
+def _matriz_costes(alertas: list, recursos: list, candidatos: dict):
+    """
+    Tiempo estimado alerta x recurso (infinito si el tipo no coincide)
+
+    Returns:
+        (matriz, infinito): con "infinito" mayor que cualquier suma de costes
+        reales, cubrir una alerta mas siempre compensa
+    """
+    posicion = {recurso['id']: j for j, recurso in enumerate(recursos)}
+
+    if np is not None:
+        lat_a = np.radians([a[1] for a in alertas])[:, None]
+        lon_a = np.radians([a[2] for a in alertas])[:, None]
+        lat_r = np.radians([r['lat'] for r in recursos])[None, :]
+        lon_r = np.radians([r['lon'] for r in recursos])[None, :]
+        h = (np.sin((lat_r - lat_a) / 2) ** 2
+             + np.cos(lat_a) * np.cos(lat_r) * np.sin((lon_r - lon_a) / 2) ** 2)
+        distancias = 2 * RADIO_TIERRA_METROS * np.arcsin(np.sqrt(h))
+
+        velocidades = np.array([float(r['velocidad_promedio_kmh']) for r in recursos])
+        preparacion = np.array([r['tiempo_preparacion_segundos'] for r in recursos], dtype=float)
+        costes = distancias / 1000.0 / (velocidades / 60.0) * 60 + preparacion
+
+        tipos_r = np.array([r['tipo'] for r in recursos], dtype=object)
+        tipos_a = np.array([a[0] for a in alertas], dtype=object)
+        incompatibles = tipos_a[:, None] != tipos_r[None, :]
+    else:
+        costes = [
+            [
+                tiempo_estimado(
+                    distancia_haversine(lat, lon, r['lat'], r['lon']),
+                    float(r['velocidad_promedio_kmh']),
+                    r['tiempo_preparacion_segundos']
+                )
+                for r in recursos
+            ]
+            for _, lat, lon in alertas
+        ]
+
+    for i, filas in candidatos.items():
+        for fila in filas:
+            j = posicion.get(fila['id'])
+            if j is not None:
+                costes[i][j] = fila['tiempo_estimado_segundos']
+
+    if np is not None:
+        maximo = float(costes[~incompatibles].max()) if (~incompatibles).any() else 0.0
+        infinito = (maximo + 1.0) * (len(alertas) + 1)
+        costes[incompatibles] = infinito
+        return costes, infinito
+
+    maximo = max(
+        (c for (tipo, _, _), fila in zip(alertas, costes)
+         for r, c in zip(recursos, fila) if r['tipo'] == tipo),
+        default=0.0
+    )
+    infinito = (maximo + 1.0) * (len(alertas) + 1)
+    for (tipo, _, _), fila in zip(alertas, costes):
+        for j, r in enumerate(recursos):
+            if r['tipo'] != tipo:
+                fila[j] = infinito
+    return costes, infinito
+
+
+def _repetir_columnas(costes, veces: list):
+    if np is not None:
+        return np.repeat(costes, veces, axis=1)
+    return [[c for c, n in zip(fila, veces) for _ in range(n)] for fila in costes]
+
+
+def _fila(recurso: dict, alerta: tuple) -> dict:
+    """Fila de recurso para un par que no estaba entre los candidatos KNN"""
+    _, latitud, longitud = alerta
+    distancia = distancia_haversine(latitud, longitud, recurso['lat'], recurso['lon'])
+    return {
+        'id': recurso['id'],
+        'nombre': recurso['nombre'],
+        'codigo': recurso['codigo'],
+        'municipio': recurso['municipio'],
+        'telefono': recurso['telefono'],
+        'distancia_metros': distancia,
+        'tiempo_preparacion_segundos': recurso['tiempo_preparacion_segundos'],
+        'tiempo_estimado_segundos': tiempo_estimado(
+            distancia,
+            float(recurso['velocidad_promedio_kmh']),
+            recurso['tiempo_preparacion_segundos']
+        )
+    }
+
+
+def _hungaro_numpy(costes, infinito: float) -> list:
+    """Metodo hungaro con caminos de aumento (O(n^2 m)), bucles internos en NumPy"""
+    n, m = costes.shape
+    if n > m:
+        # Mas alertas que plazas: columnas ficticias de "sin asignar"
+        costes = np.hstack([costes, np.full((n, n - m), infinito)])
+        m = n
+
+    # Indices desde 1: la fila/columna 0 es el origen de cada camino
+    a = np.zeros((n + 1, m + 1))
+    a[1:, 1:] = costes
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    p = np.zeros(m + 1, dtype=int)
+    camino = np.zeros(m + 1, dtype=int)
+
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        usada = np.zeros(m + 1, dtype=bool)
+        while True:
+            usada[j0] = True
+            i0 = p[j0]
+            libres = ~usada
+            libres[0] = False
+            actual = a[i0] - u[i0] - v
+            mejora = libres & (actual < minv)
+            minv[mejora] = actual[mejora]
+            camino[mejora] = j0
+            candidatas = np.where(libres, minv, np.inf)
+            j1 = int(np.argmin(candidatas))
+            delta = candidatas[j1]
+
+            u[p[usada]] += delta
+            v[usada] -= delta
+            minv[libres] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+
+        while j0:
+            j1 = camino[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    columnas = [-1] * n
+    for j in range(1, m + 1):
+        if p[j]:
+            columnas[p[j] - 1] = j - 1
+    return columnas
+
+
+def _hungaro(costes: list, infinito: float) -> list:
+    """Metodo hungaro en Python puro (para lotes pequenos sin NumPy)"""
+    n, m = len(costes), len(costes[0])
+    if n > m:
+        costes = [fila + [infinito] * (n - m) for fila in costes]
+        m = n
+
+    u = [0.0] * (n + 1)
+    v = [0.0] * (m + 1)
+    p = [0] * (m + 1)
+    camino = [0] * (m + 1)
+
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = [math.inf] * (m + 1)
+        usada = [False] * (m + 1)
+        while True:
+            usada[j0] = True
+            i0 = p[j0]
+            fila = costes[i0 - 1]
+            delta = math.inf
+            j1 = 0
+            for j in range(1, m + 1):
+                if not usada[j]:
+                    actual = fila[j - 1] - u[i0] - v[j]
+                    if actual < minv[j]:
+                        minv[j] = actual
+                        camino[j] = j0
+                    if minv[j] < delta:
+                        delta = minv[j]
+                        j1 = j
+            for j in range(m + 1):
+                if usada[j]:
+                    u[p[j]] += delta
+                    v[j] -= delta
+                else:
+                    minv[j] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+
+        while j0:
+            j1 = camino[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    columnas = [-1] * n
+    for j in range(1, m + 1):
+        if p[j]:
+            columnas[p[j] - 1] = j - 1
+    return columnas
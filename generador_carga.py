@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+Generador de carga y benchmark extremo a extremo
+
+Publica uplinks con el formato de ChirpStack (test_alerta.crear_mensaje)
+desde miles de dispositivos simulados repartidos por Las Hurdes, a una tasa
+fija o con llegadas de Poisson (bucle abierto: no frena si el sistema se
+retrasa). Una fraccion de los mensajes se reenvia tal cual (duplicados) y
+otra va corrupta (JSON invalido o payload de longitud erronea).
+
+Al terminar espera a que el listener vacie la cola, mide en la BD la
+latencia publicacion -> fila en asignaciones y escribe un informe JSON.
+La latencia se mide contra fecha_asignacion (CURRENT_TIMESTAMP, inicio de
+la transaccion que asigna), con el reloj de la maquina que publica: broker,
+listener y BD deben compartir reloj (misma maquina o NTP).
+
+Los dispositivos de cada ejecucion comparten un prefijo aleatorio de devEUI,
+asi que varias ejecuciones no se mezclan; --limpiar borra sus alertas.
+
+Uso: python generador_carga.py --tasa 200 --duracion 60 --salida informe.json
+"""
+
+import argparse
+import heapq
+import json
+import os
+import random
+import sys
+import time
+
+import paho.mqtt.client as mqtt
+
+if sys.platform == 'win32':
+    os.environ['PGCLIENTENCODING'] = 'UTF8'
+    os.environ['PYTHONIOENCODING'] = 'utf-8'
+
+from test_alerta import BROKER, PORT, crear_mensaje, generar_payload, topic_uplink
+from deduplicacion import clave_uplink
+
+# Caja aproximada de Las Hurdes
+LON_MIN, LON_MAX = -6.45, -6.10
+LAT_MIN, LAT_MAX = 40.25, 40.50
+
+
+def percentil(valores_ordenados, p):
+    if not valores_ordenados:
+        return None
+    indice = min(len(valores_ordenados) - 1, int(round(p / 100.0 * (len(valores_ordenados) - 1))))
+    return valores_ordenados[indice]
+
+
+class GeneradorCarga:
+
+    def __init__(self, args):
+        self.args = args
+        self.prefijo = f"{random.getrandbits(32):08x}"
+        self.dispositivos = [f"{self.prefijo}{i:08x}" for i in range(args.dispositivos)]
+        self.f_cnt = {}
+
+        # uplink_id -> instante de publicacion (solo mensajes validos)
+        self.publicados = {}
+        self.por_dispositivo = {}
+
+        self.enviados = 0
+        self.validos = 0
+        self.duplicados = 0
+        self.malformados = 0
+        self.errores_publicacion = 0
+
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+
+    def _siguiente_mensaje(self):
+        """(topic, cuerpo, uplink_id o None si no debe crear alerta)"""
+        dev_eui = random.choice(self.dispositivos)
+        f_cnt = self.f_cnt.get(dev_eui, 0)
+        self.f_cnt[dev_eui] = f_cnt + 1
+
+        if random.random() < self.args.malformados:
+            self.malformados += 1
+            if random.random() < 0.5:
+                return topic_uplink(dev_eui), '{"devEUI": "' + dev_eui + '", "data": ', None
+            mensaje = crear_mensaje(dev_eui, generar_payload(1, 40.3, -6.3)[:8], f_cnt)
+            return topic_uplink(dev_eui), json.dumps(mensaje), None
+
+        payload = generar_payload(
+            random.randint(1, 4),
+            random.uniform(LAT_MIN, LAT_MAX),
+            random.uniform(LON_MIN, LON_MAX),
+            random.randint(5, 100)
+        )
+        mensaje = crear_mensaje(dev_eui, payload, f_cnt)
+        self.validos += 1
+        return topic_uplink(dev_eui), json.dumps(mensaje), clave_uplink(dev_eui, mensaje)
+
+    def _publicar(self, topic, cuerpo):
+        resultado = self.client.publish(topic, cuerpo, qos=self.args.qos)
+        self.enviados += 1
+        if resultado.rc != mqtt.MQTT_ERR_SUCCESS:
+            self.errores_publicacion += 1
+            return False
+        return True
+
+    def ejecutar(self):
+        args = self.args
+        self.client.connect(args.broker, args.port, 60)
+        self.client.loop_start()
+
+        reenvios = []
+        inicio = time.time()
+        siguiente = inicio
+        fin = inicio + args.duracion
+
+        try:
+            while siguiente < fin:
+                espera = siguiente - time.time()
+                if espera > 0:
+                    time.sleep(espera)
+
+                # Reenvios pendientes: el mismo mensaje poco despues
+                ahora = time.time()
+                while reenvios and reenvios[0][0] <= ahora:
+                    _, topic, cuerpo = heapq.heappop(reenvios)
+                    self.duplicados += 1
+                    self._publicar(topic, cuerpo)
+
+                topic, cuerpo, uplink_id = self._siguiente_mensaje()
+                publicado = time.time()
+                if self._publicar(topic, cuerpo) and uplink_id is not None:
+                    self.publicados[uplink_id] = publicado
+                    self.por_dispositivo.setdefault(uplink_id.split(':')[0], []).append(publicado)
+                    if random.random() < args.duplicados:
+                        heapq.heappush(reenvios, (publicado + random.uniform(0.05, 2.0), topic, cuerpo))
+
+                if args.llegadas == 'poisson':
+                    siguiente += random.expovariate(args.tasa)
+                else:
+                    siguiente += 1.0 / args.tasa
+
+            for _, topic, cuerpo in reenvios:
+                self.duplicados += 1
+                self._publicar(topic, cuerpo)
+        finally:
+            self.duracion_envio = time.time() - inicio
+            self.client.loop_stop()
+            self.client.disconnect()
+
+        return self.duracion_envio
+
+    def informe(self, medidas):
+        return {
+            'configuracion': {
+                'tasa': self.args.tasa,
+                'llegadas': self.args.llegadas,
+                'duracion': self.args.duracion,
+                'dispositivos': self.args.dispositivos,
+                'duplicados': self.args.duplicados,
+                'malformados': self.args.malformados,
+                'qos': self.args.qos,
+                'prefijo_dispositivos': self.prefijo
+            },
+            'envio': {
+                'enviados': self.enviados,
+                'validos': self.validos,
+                'duplicados': self.duplicados,
+                'malformados': self.malformados,
+                'errores_publicacion': self.errores_publicacion,
+                'duracion_segundos': round(self.duracion_envio, 3),
+                'tasa_real': round(self.enviados / self.duracion_envio, 1) if self.duracion_envio else 0
+            },
+            'resultados': medidas
+        }
+
+
+def medir(generador, db_config, espera_max):
+    """Espera a que dejen de llegar alertas y calcula latencias y errores"""
+    import psycopg2
+    from psycopg2.extras import RealDictCursor
+
+    conn = psycopg2.connect(
+        host=db_config['host'],
+        port=db_config.get('port', 5432),
+        database=db_config['database'],
+        user=db_config['user'],
+        password=db_config['password'],
+        options='-c client_encoding=UTF8'
+    )
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    patron = generador.prefijo + '%'
+
+    # La cola del listener puede ir por detras: esperar a que se estabilice
+    anterior = -1
+    limite = time.time() + espera_max
+    while time.time() < limite:
+        cursor.execute("""
+            SELECT
+                (SELECT COUNT(*) FROM alertas WHERE dispositivo_id LIKE %s) AS alertas,
+                (SELECT COUNT(*) FROM asignaciones asg JOIN alertas a ON a.id = asg.alerta_id
+                 WHERE a.dispositivo_id LIKE %s) AS asignaciones
+        """, (patron, patron))
+        fila = cursor.fetchone()
+        conn.rollback()
+        actual = (fila['alertas'], fila['asignaciones'])
+        if actual == anterior:
+            break
+        anterior = actual
+        time.sleep(2)
+
+    cursor.execute("""
+        SELECT
+            a.id,
+            a.dispositivo_id,
+            u.uplink_id,
+            EXTRACT(EPOCH FROM (asg.fecha_asignacion AT TIME ZONE current_setting('TimeZone'))) AS asignada
+        FROM alertas a
+        LEFT JOIN uplinks_procesados u ON u.alerta_id = a.id
+        LEFT JOIN asignaciones asg ON asg.alerta_id = a.id
+        WHERE a.dispositivo_id LIKE %s
+        ORDER BY a.id
+    """, (patron,))
+    filas = cursor.fetchall()
+    conn.rollback()
+
+    # Con dedup_persistente el uplink_id da la correspondencia exacta; sin el,
+    # las alertas de cada dispositivo se emparejan por orden de publicacion
+    latencias = []
+    asignadas = []
+    orden = {}
+    for fila in filas:
+        if fila['uplink_id'] is not None:
+            publicado = generador.publicados.get(fila['uplink_id'])
+        else:
+            n = orden.get(fila['dispositivo_id'], 0)
+            orden[fila['dispositivo_id']] = n + 1
+            tiempos = generador.por_dispositivo.get(fila['dispositivo_id'], [])
+            publicado = tiempos[n] if n < len(tiempos) else None
+
+        if fila['asignada'] is not None:
+            asignadas.append(float(fila['asignada']))
+            if publicado is not None:
+                latencias.append((float(fila['asignada']) - publicado) * 1000)
+
+    latencias.sort()
+    sostenido = None
+    if len(asignadas) > 1:
+        ventana = max(asignadas) - min(generador.publicados.values())
+        sostenido = round(len(asignadas) / ventana, 1) if ventana > 0 else None
+
+    if generador.args.limpiar:
+        cursor.execute("""
+            UPDATE alertas SET estado = 'resuelta'
+            WHERE dispositivo_id LIKE %s AND estado != 'resuelta'
+        """, (patron,))
+        cursor.execute("DELETE FROM alertas WHERE dispositivo_id LIKE %s", (patron,))
+        conn.commit()
+
+    cursor.close()
+    conn.close()
+
+    esperadas = generador.validos
+    return {
+        'alertas_registradas': len(filas),
+        'asignadas': len(asignadas),
+        'sin_asignar': len(filas) - len(asignadas),
+        'perdidas': max(esperadas - len(filas), 0),
+        'sobrantes': max(len(filas) - esperadas, 0),
+        'tasa_error': round(max(esperadas - len(filas), 0) / esperadas, 4) if esperadas else 0,
+        'throughput_sostenido': sostenido,
+        'latencia_ms': {
+            'muestras': len(latencias),
+            'media': round(sum(latencias) / len(latencias), 1) if latencias else None,
+            'p50': _redondear(percentil(latencias, 50)),
+            'p90': _redondear(percentil(latencias, 90)),
+            'p99': _redondear(percentil(latencias, 99)),
+            'max': _redondear(latencias[-1] if latencias else None)
+        }
+    }
+
+
+def _redondear(valor):
+    return round(valor, 1) if valor is not None else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generador de carga para el listener LoRaWAN")
+    parser.add_argument('--tasa', type=float, default=100, help="mensajes por segundo")
+    parser.add_argument('--duracion', type=float, default=30, help="segundos de envio")
+    parser.add_argument('--llegadas', choices=('poisson', 'constante'), default='poisson')
+    parser.add_argument('--dispositivos', type=int, default=5000)
+    parser.add_argument('--duplicados', type=float, default=0.05, help="fraccion de mensajes reenviados")
+    parser.add_argument('--malformados', type=float, default=0.01, help="fraccion de mensajes corruptos")
+    parser.add_argument('--qos', type=int, choices=(0, 1), default=0)
+    parser.add_argument('--broker', default=BROKER)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--espera', type=float, default=60, help="segundos maximos esperando al listener")
+    parser.add_argument('--sin-bd', action='store_true', help="solo publicar, sin medir en BD")
+    parser.add_argument('--limpiar', action='store_true', help="borrar las alertas de la ejecucion")
+    parser.add_argument('--salida', default='informe_carga.json')
+    parser.add_argument('--semilla', type=int)
+    args = parser.parse_args()
+
+    if args.semilla is not None:
+        random.seed(args.semilla)
+
+    generador = GeneradorCarga(args)
+
+    print("\n" + "="*60)
+    print("GENERADOR DE CARGA")
+    print("="*60)
+    print(f"  Broker: {args.broker}:{args.port}")
+    print(f"  {args.tasa:.0f} msg/s ({args.llegadas}) durante {args.duracion:.0f} s, "
+          f"{args.dispositivos} dispositivos (prefijo {generador.prefijo})")
+
+    generador.ejecutar()
+    print(f"  Enviados: {generador.enviados} ({generador.duplicados} duplicados, "
+          f"{generador.malformados} malformados) en {generador.duracion_envio:.1f} s")
+
+    medidas = None
+    if not args.sin_bd:
+        from config import DB_CONFIG
+        print("  Esperando al listener...")
+        medidas = medir(generador, DB_CONFIG, args.espera)
+        lat = medidas['latencia_ms']
+        print(f"  Alertas: {medidas['alertas_registradas']}, asignadas: {medidas['asignadas']}, "
+              f"perdidas: {medidas['perdidas']}, sobrantes: {medidas['sobrantes']}")
+        print(f"  Latencia ms: p50 {lat['p50']}  p90 {lat['p90']}  p99 {lat['p99']}  max {lat['max']}")
+        print(f"  Throughput sostenido: {medidas['throughput_sostenido']} alertas/s")
+
+    with open(args.salida, 'w', encoding='utf-8') as f:
+        json.dump(generador.informe(medidas), f, indent=2)
+    print(f"  Informe: {args.salida}")
+    print("="*60)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n\nInterrumpido")
@@ -4,11 +4,24 @@ Procesa alertas y asigna recursos
 """
 
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import psycopg2.pool
+from psycopg2.extras import RealDictCursor, execute_values
 import logging
 import os
+import random
 import sys
+import threading
+import time
+from contextlib import contextmanager
 from decoder import PayloadDecoder
+from cache_recursos import IndiceRecursos, CANAL_RECURSOS
+from coalescencia import IndiceIncidentes, indice_compartido
+from deduplicacion import clave_persistente
+from notificaciones import EscuchaNotificaciones
+from metricas import METRICAS
+from telemetria import TELEMETRIA
+from tiempos_viaje import RejillaTiempos, ordenar_por_tiempo
+from despacho import DESPACHOS, OPTIMO, VORAZ, repartir_optimo, repartir_voraz
 
 # Fix para encoding en Windows
 if sys.platform == 'win32':
@@ -17,6 +30,144 @@ if sys.platform == 'win32':
 
 logger = logging.getLogger(__name__)
 
+# Recurso mas cercano en dos fases: el operador <-> recorre el indice GIST
+# y devuelve los k candidatos mas proximos en el plano; la distancia
+# geodesica solo se calcula para esos candidatos.
+CONSULTA_CANDIDATOS = """
+    SELECT 
+        id,
+        nombre,
+        codigo,
+        municipio,
+        telefono,
+        distancia_metros,
+        tiempo_preparacion_segundos,
+        (
+            (distancia_metros / 1000.0) / 
+            (velocidad_promedio_kmh / 60.0) * 60 + 
+            tiempo_preparacion_segundos
+        )::INTEGER AS tiempo_estimado_segundos
+    FROM (
+        SELECT 
+            pe.*,
+            ST_Distance(
+                pe.ubicacion::geography,
+                ST_SetSRID(ST_MakePoint(%(longitud)s, %(latitud)s), 4326)::geography
+            ) AS distancia_metros
+        FROM (
+            SELECT *
+            FROM puntos_emergencia
+            WHERE 
+                tipo = %(tipo)s
+                AND disponible = true
+            ORDER BY ubicacion <-> ST_SetSRID(ST_MakePoint(%(longitud)s, %(latitud)s), 4326)
+            LIMIT %(candidatos)s
+        ) pe
+    ) candidatos
+    ORDER BY distancia_metros ASC
+"""
+
+CONSULTA_RECURSO_CERCANO = CONSULTA_CANDIDATOS + "    LIMIT 1\n"
+
+# Candidatos de todas las alertas de un lote en una sola consulta
+CONSULTA_CANDIDATOS_LOTE = """
+    SELECT 
+        v.n,
+        c.id,
+        c.nombre,
+        c.codigo,
+        c.municipio,
+        c.telefono,
+        c.distancia_metros,
+        c.tiempo_preparacion_segundos,
+        (
+            (c.distancia_metros / 1000.0) / 
+            (c.velocidad_promedio_kmh / 60.0) * 60 + 
+            c.tiempo_preparacion_segundos
+        )::INTEGER AS tiempo_estimado_segundos
+    FROM unnest(
+        %(tipos)s::tipo_emergencia[],
+        %(longitudes)s::DOUBLE PRECISION[],
+        %(latitudes)s::DOUBLE PRECISION[]
+    ) WITH ORDINALITY AS v(tipo, longitud, latitud, n)
+    CROSS JOIN LATERAL (
+        SELECT 
+            pe.*,
+            ST_Distance(
+                pe.ubicacion::geography,
+                ST_SetSRID(ST_MakePoint(v.longitud, v.latitud), 4326)::geography
+            ) AS distancia_metros
+        FROM (
+            SELECT *
+            FROM puntos_emergencia
+            WHERE 
+                tipo = v.tipo
+                AND disponible = true
+            ORDER BY ubicacion <-> ST_SetSRID(ST_MakePoint(v.longitud, v.latitud), 4326)
+            LIMIT %(candidatos)s
+        ) pe
+    ) c
+    ORDER BY v.n, c.distancia_metros
+"""
+
+
+class UplinkDuplicado(Exception):
+    """El uplink ya se habia registrado (otra instancia o antes de reiniciar)"""
+
+
+RESULTADO_DUPLICADO = {'exito': False, 'duplicado': True, 'error': 'Uplink duplicado'}
+
+# reasignar_alerta: la alerta sigue pendiente pero otra transaccion la tiene
+# bloqueada (otro motor asignandola, una resolucion en curso...)
+ALERTA_BLOQUEADA = 'bloqueada'
+
+
+class _SesionBD:
+    """
+    Conexion usada durante una operacion. En modo pool, si un paso falla
+    porque la conexion se ha caido, se sustituye por otra y se repite.
+    Un paso no idempotente solo se repite si se cayo antes del commit (la
+    BD deshace la transaccion): caida durante el commit, pudo confirmarse
+    aunque se perdiera la respuesta, y repetirlo lo duplicaria.
+    """
+    
+    def __init__(self, sistema, conn, cursor):
+        self.sistema = sistema
+        self.conn = conn
+        self.cursor = cursor
+    
+    def ejecutar(self, paso, *args, idempotente: bool = True, **kwargs):
+        self.cursor.commit_enviado = False
+        resultado = paso(self.cursor, *args, **kwargs)
+        
+        if not resultado and self.sistema.pool is not None and self.conn.closed:
+            if not idempotente and self.cursor.commit_enviado:
+                logger.error("Conexion a BD perdida durante el commit de una escritura, no se repite")
+                return resultado
+            logger.warning("Conexion a BD perdida, reintentando con una nueva")
+            self.sistema._devolver_conexion(self.conn, self.cursor)
+            self.conn = self.cursor = None
+            self.conn, self.cursor = self.sistema._obtener_conexion()
+            self.cursor.commit_enviado = False
+            resultado = paso(self.cursor, *args, **kwargs)
+        
+        return resultado
+
+
+class _SesionMemoria:
+    """
+    Sesion sobre AlmacenMemoria: cada paso (p.ej. _registrar_alerta) se
+    resuelve con el metodo del almacen del mismo nombre, sin cursor
+    """
+    
+    def __init__(self, almacen):
+        self.almacen = almacen
+        self.conn = None
+        self.cursor = None
+    
+    def ejecutar(self, paso, *args, idempotente: bool = True, **kwargs):
+        return getattr(self.almacen, paso.__name__.lstrip('_'))(*args, **kwargs)
+
 
 class SistemaEmergencias:
     
@@ -25,169 +176,934 @@ class SistemaEmergencias:
         self.decoder = PayloadDecoder()
         self.conn = None
         self.cursor = None
+        
+        # Modo pool: se activa con 'pool_max' en db_config
+        self.pool = None
+        self._pool_semaforo = None
+        self._ultimo_uso = {}
+        self._ping_segundos = db_config.get('pool_ping_segundos', 30)
+        
+        # Ruta rapida: registro y asignacion en una sola llamada a BD
+        self.ruta_rapida = db_config.get('ruta_rapida', False)
+        
+        # Candidatos que se traen por KNN antes de medir la distancia exacta
+        self.knn_candidatos = db_config.get('knn_candidatos', 10)
+        
+        # Registrar los uplinks en uplinks_procesados para descartar duplicados
+        # entre reinicios y entre varias instancias del listener
+        self.dedup_persistente = db_config.get('dedup_persistente', False)
+        # Un uplink registrado hace mas de la ventana ya no cuenta como
+        # duplicado: tras reiniciar un dispositivo su fCnt vuelve a empezar
+        self.dedup_ventana = db_config.get('dedup_ventana_segundos', 86400)
+        
+        # Reclamar el recurso con bloqueo de fila (varios trabajadores/procesos)
+        self.asignacion_concurrente = db_config.get('asignacion_concurrente', False)
+        self.reintentos_asignacion = db_config.get('reintentos_asignacion', 5)
+        
+        # Indice en memoria de recursos, actualizado por LISTEN/NOTIFY
+        self.indice_recursos = None
+        self._escucha_recursos = None
+        
+        # Alertas abiertas por dispositivo, para agrupar pulsaciones repetidas
+        self.incidentes = None
+        
+        # Almacen: 'postgis' (por defecto) o 'memoria' (sin BD, ver almacen_memoria.py)
+        self.almacen = None
+        
+        # Rejilla de tiempos de viaje por carretera (ver tiempos_viaje.py)
+        self.tiempos = None
+        
+        # Reparto de los lotes: 'voraz' (orden de llegada) u 'optimo' (ver despacho.py)
+        self.despacho = db_config.get('despacho', VORAZ)
+        if self.despacho not in DESPACHOS:
+            raise ValueError(f"Despacho desconocido: {self.despacho} (opciones: {', '.join(DESPACHOS)})")
+        self.despacho_max_celdas = db_config.get('despacho_max_celdas', 1_000_000)
+        
+        # Avisar de las alertas que se quedan sin recurso (NOTIFY) para que el
+        # motor de reasignacion las atienda al liberarse uno (ver reasignacion.py)
+        self.reasignacion = db_config.get('reasignacion', False)
+    
+    def _parametros_conexion(self) -> dict:
+        return {
+            'host': self.db_config['host'],
+            'port': self.db_config.get('port', 5432),
+            'database': self.db_config['database'],
+            'user': self.db_config['user'],
+            'password': self.db_config['password'],
+            'options': '-c client_encoding=UTF8'
+        }
     
     def conectar_bd(self) -> bool:
-        """Conecta a la base de datos"""
-        try:
-            self.conn = psycopg2.connect(
-                host=self.db_config['host'],
-                port=self.db_config.get('port', 5432),
-                database=self.db_config['database'],
-                user=self.db_config['user'],
-                password=self.db_config['password'],
-                options='-c client_encoding=UTF8'
-            )
-            self.cursor = self.conn.cursor(cursor_factory=RealDictCursor)
-            logger.info(f"Conectado a BD: {self.db_config['database']}")
+        """Conecta a la base de datos (conexion unica o pool)"""
+        try:
+            pool_max = self.db_config.get('pool_max', 0)
+            
+            if self.db_config.get('tiempos_viaje') and self.tiempos is None:
+                self.tiempos = RejillaTiempos(self.db_config['tiempos_viaje'])
+            
+            if self.db_config.get('almacen') == 'memoria':
+                self._iniciar_almacen_memoria()
+                if self.db_config.get('coalescencia'):
+                    self._iniciar_indice_incidentes()
+                return True
+            
+            if pool_max > 0:
+                # Las conexiones devueltas por encima de pool_min se cierran
+                pool_min = self.db_config.get('pool_min') or pool_max
+                self.pool = psycopg2.pool.ThreadedConnectionPool(
+                    pool_min, pool_max, **self._parametros_conexion()
+                )
+                # ThreadedConnectionPool falla si se agota: esperar en su lugar
+                self._pool_semaforo = threading.BoundedSemaphore(pool_max)
+                logger.info(f"Pool de conexiones a BD: {self.db_config['database']} ({pool_min}-{pool_max})")
+            else:
+                self.conn = psycopg2.connect(**self._parametros_conexion())
+                self.cursor = self.conn.cursor(cursor_factory=RealDictCursor)
+                logger.info(f"Conectado a BD: {self.db_config['database']}")
+            
+            if self.db_config.get('cache_recursos'):
+                self._iniciar_indice_recursos()
+            if self.db_config.get('coalescencia'):
+                self._iniciar_indice_incidentes()
             return True
         except Exception as e:
             logger.error(f"Error conectando a BD: {e}")
             return False
     
+    def _iniciar_indice_recursos(self):
+        self.indice_recursos = IndiceRecursos(
+            celda_grados=self.db_config.get('cache_celda_grados', 0.05)
+        )
+        self._escucha_recursos = EscuchaNotificaciones(
+            self._parametros_conexion(),
+            [CANAL_RECURSOS],
+            al_notificar=self.indice_recursos.actualizar,
+            al_conectar=self.indice_recursos.cargar
+        )
+        self._escucha_recursos.iniciar()
+    
+    def _iniciar_almacen_memoria(self):
+        from almacen_memoria import AlmacenMemoria
+        
+        self.almacen = AlmacenMemoria(
+            self.db_config.get('cache_celda_grados', 0.05),
+            tiempos=self.tiempos,
+            knn_candidatos=self.knn_candidatos,
+            despacho=self.despacho,
+            despacho_max_celdas=self.despacho_max_celdas,
+            dedup_ventana_segundos=self.dedup_ventana
+        )
+        puntos = self.db_config.get('almacen_puntos', 'sistema_emergencias.sql')
+        if isinstance(puntos, int):
+            self.almacen.generar_puntos(puntos, semilla=42)
+        else:
+            self.almacen.cargar_sql(puntos)
+    
+    def _iniciar_indice_incidentes(self):
+        radio = self.db_config.get('coalescencia_radio_metros', 500)
+        ventana = self.db_config.get('coalescencia_ventana_segundos', 900)
+        
+        # El almacen en memoria arranca vacio y es de este sistema: indice propio
+        if self.almacen is not None:
+            self.incidentes = IndiceIncidentes(radio, ventana)
+            return
+        
+        # Con PostGIS, uno por proceso para todos los trabajadores; se carga
+        # al conectar el primero (o el primero tras un fallo al cargar)
+        parametros = self._parametros_conexion()
+        self.incidentes = indice_compartido(
+            (parametros['host'], parametros['port'], parametros['database'], radio, ventana),
+            radio, ventana
+        )
+        if not self.incidentes.cargado:
+            with self._sesion() as sesion:
+                self.incidentes.cargar(sesion.cursor)
+    
+    def _indice_vigente(self) -> bool:
+        """El indice solo se usa si esta cargado y la escucha va al dia"""
+        return (
+            self.indice_recursos is not None
+            and self.indice_recursos.cargado
+            and self._escucha_recursos.al_dia(self.db_config.get('cache_max_retraso'))
+        )
+    
     def desconectar_bd(self):
         """Cierra la conexion"""
+        if self._escucha_recursos:
+            self._escucha_recursos.detener()
+            self._escucha_recursos = None
+        if self.pool:
+            self.pool.closeall()
+            self.pool = None
         if self.cursor:
             self.cursor.close()
         if self.conn:
             self.conn.close()
         logger.info("Desconectado de BD")
     
-    def procesar_alerta(self, dispositivo_id: str, payload_base64: str) -> dict:
-        """Procesa una alerta: decodifica, registra y asigna recurso"""
-        logger.info(f"Procesando alerta de dispositivo: {dispositivo_id}")
+    def _obtener_conexion(self):
+        """Saca una conexion sana del pool, reconectando si hace falta"""
+        self._pool_semaforo.acquire()
+        try:
+            while True:
+                conn = self.pool.getconn()
+                if not conn.closed and self._conexion_viva(conn):
+                    return conn, conn.cursor(cursor_factory=RealDictCursor)
+                
+                logger.warning("Descartando conexion a BD caida")
+                self._ultimo_uso.pop(id(conn), None)
+                self.pool.putconn(conn, close=True)
+        except Exception:
+            self._pool_semaforo.release()
+            raise
+    
+    def _conexion_viva(self, conn) -> bool:
+        """Comprueba con SELECT 1 las conexiones que llevan tiempo ociosas"""
+        ultimo = self._ultimo_uso.get(id(conn))
+        if ultimo is not None and time.monotonic() - ultimo < self._ping_segundos:
+            return True
+        
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+    
+    def _devolver_conexion(self, conn, cursor):
+        try:
+            cursor.close()
+        except psycopg2.Error:
+            pass
+        
+        if conn.closed:
+            self._ultimo_uso.pop(id(conn), None)
+        else:
+            self._ultimo_uso[id(conn)] = time.monotonic()
+        self.pool.putconn(conn, close=bool(conn.closed))
+        self._pool_semaforo.release()
+    
+    @contextmanager
+    def _sesion(self):
+        """Conexion para una operacion: una del pool o la compartida"""
+        if self.almacen is not None:
+            yield _SesionMemoria(self.almacen)
+            return
+        
+        if self.pool is None:
+            yield _SesionBD(self, self.conn, self.cursor)
+            return
+        
+        conn, cursor = self._obtener_conexion()
+        sesion = _SesionBD(self, conn, cursor)
+        try:
+            yield sesion
+        finally:
+            if sesion.conn is not None:
+                self._devolver_conexion(sesion.conn, sesion.cursor)
+    
+    def bd_disponible(self) -> bool:
+        """
+        False si la BD no responde (OperationalError o InterfaceError al
+        hacer SELECT 1); un error de otro tipo es de la alerta, no de la BD
+        """
+        if self.almacen is not None:
+            return True
+        if self.pool is None and self.conn is None:
+            return False
+        try:
+            with self._sesion() as sesion:
+                sesion.conn.rollback()
+                sesion.cursor.execute("SELECT 1")
+                sesion.conn.rollback()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            logger.warning(f"BD no disponible: {e}")
+            return False
+    
+    def procesar_alerta(self, dispositivo_id: str, payload_base64: str,
+                        uplink_id: str = None) -> dict:
+        """
+        Procesa una alerta: decodifica, registra y asigna recurso
+        
+        Args:
+            dispositivo_id: DevEUI del dispositivo
+            payload_base64: payload recibido de ChirpStack
+            uplink_id: identificador del uplink (ver deduplicacion.clave_uplink);
+                con dedup_persistente, un uplink ya registrado no crea alerta
+        """
+        logger.debug("Procesando alerta de dispositivo: %s", dispositivo_id)
         
         # Decodificar payload
-        datos = self.decoder.decode(payload_base64)
+        with METRICAS.cronometro('etapa_segundos', etapa='decodificacion'):
+            datos = self.decoder.decode(payload_base64)
         if not datos:
-            return {'exito': False, 'error': 'Payload invalido'}
+            return contar_resultado({'exito': False, 'error': 'Payload invalido'})
+        TELEMETRIA.registrar(dispositivo_id, datos)
         
-        # Registrar alerta
-        alerta_id = self._registrar_alerta(
-            dispositivo_id=dispositivo_id,
-            tipo=datos['tipo'],
-            latitud=datos['latitud'],
-            longitud=datos['longitud']
+        try:
+            with self._sesion() as sesion:
+                return contar_resultado(self._procesar_datos(sesion, dispositivo_id, datos, uplink_id))
+        except Exception as e:
+            logger.error(f"Error procesando alerta en BD: {e}")
+            return contar_resultado({'exito': False, 'error': 'Error en BD'})
+    
+    def procesar_lote(self, alertas: list) -> list:
+        """
+        Registra y asigna un lote de alertas ya decodificadas con un solo commit
+        
+        Args:
+            alertas: lista de (dispositivo_id, datos) o
+                (dispositivo_id, datos, uplink_id), con datos como los
+                devuelve PayloadDecoder.decode
+            
+        Returns:
+            Lista de resultados, en el mismo orden, como los de procesar_alerta
+        """
+        if not alertas:
+            return []
+        
+        alertas = [
+            (alerta[0], alerta[1], self._uplink_persistente(alerta[2] if len(alerta) > 2 else None))
+            for alerta in alertas
+        ]
+        
+        with METRICAS.cronometro('etapa_segundos', etapa='lote'):
+            resultados = self._procesar_lote_en_sesion(alertas)
+        for resultado in resultados:
+            contar_resultado(resultado)
+        return resultados
+    
+    def _procesar_lote_en_sesion(self, alertas: list) -> list:
+        try:
+            with self._sesion() as sesion:
+                agrupadas = self._agrupar_lote(sesion, alertas)
+                nuevas = [a for i, a in enumerate(alertas) if i not in agrupadas]
+                
+                # Solo se repite si todas llevan uplink_id que las deduplique
+                resultados = sesion.ejecutar(
+                    self._procesar_lote, nuevas,
+                    idempotente=all(uplink_id is not None for _, _, uplink_id in nuevas)
+                )
+                if resultados is not None:
+                    self._registrar_incidentes(nuevas, resultados)
+                elif sesion.conn is not None and sesion.conn.closed:
+                    # Caido en el commit: el lote pudo confirmarse y repetirlo
+                    # alerta a alerta lo duplicaria
+                    logger.error(f"Lote de {len(nuevas)} alertas fallido con la conexion caida, no se repite")
+                    resultados = [{'exito': False, 'error': 'Error en BD'} for _ in nuevas]
+                else:
+                    # Aislar errores: si el lote falla, cada alerta por separado
+                    logger.warning(f"Lote de {len(nuevas)} alertas fallido, procesando una a una")
+                    resultados = [
+                        self._procesar_datos(sesion, dispositivo_id, datos, uplink_id)
+                        for dispositivo_id, datos, uplink_id in nuevas
+                    ]
+                
+                resultados = iter(resultados)
+                return [
+                    agrupadas[i] if i in agrupadas else next(resultados)
+                    for i in range(len(alertas))
+                ]
+        except Exception as e:
+            logger.error(f"Error procesando lote en BD: {e}")
+            return [{'exito': False, 'error': 'Error en BD'} for _ in alertas]
+    
+    def _procesar_lote(self, cursor, todas: list) -> list:
+        if not todas:
+            return []
+        
+        try:
+            duplicadas = self._reservar_uplinks_lote(cursor, todas)
+            alertas = [a for i, a in enumerate(todas) if i not in duplicadas]
+            
+            alerta_ids = []
+            asignaciones = {}
+            if alertas:
+                filas = execute_values(
+                    cursor,
+                    "INSERT INTO alertas (dispositivo_id, tipo, ubicacion) VALUES %s RETURNING id",
+                    [
+                        (dispositivo_id, datos['tipo'], datos['longitud'], datos['latitud'])
+                        for dispositivo_id, datos, _ in alertas
+                    ],
+                    template="(%s, %s, ST_SetSRID(ST_MakePoint(%s, %s), 4326))",
+                    page_size=len(alertas),
+                    fetch=True
+                )
+                alerta_ids = [fila['id'] for fila in filas]
+                
+                uplinks = [
+                    (uplink_id, alerta_id)
+                    for (_, _, uplink_id), alerta_id in zip(alertas, alerta_ids)
+                    if uplink_id is not None
+                ]
+                if self.dedup_persistente and uplinks:
+                    execute_values(
+                        cursor,
+                        """
+                            UPDATE uplinks_procesados u
+                            SET alerta_id = v.alerta_id
+                            FROM (VALUES %s) AS v(uplink_id, alerta_id)
+                            WHERE u.uplink_id = v.uplink_id
+                        """,
+                        uplinks,
+                        page_size=len(uplinks)
+                    )
+                
+                # Candidatos por alerta (n empieza en 1), ordenados por distancia
+                cursor.execute(CONSULTA_CANDIDATOS_LOTE, {
+                    'tipos': [datos['tipo'] for _, datos, _ in alertas],
+                    'longitudes': [datos['longitud'] for _, datos, _ in alertas],
+                    'latitudes': [datos['latitud'] for _, datos, _ in alertas],
+                    'candidatos': self.knn_candidatos
+                })
+                candidatos = {}
+                for fila in cursor.fetchall():
+                    candidatos.setdefault(fila['n'] - 1, []).append(fila)
+                if self.tiempos is not None:
+                    for i, filas in candidatos.items():
+                        datos = alertas[i][1]
+                        candidatos[i] = self._ordenar_candidatos(filas, datos['latitud'], datos['longitud'])
+                
+                asignaciones = self._repartir_lote(cursor, alertas, candidatos)
+                
+                pendientes = [a for i, a in enumerate(alerta_ids) if i not in asignaciones]
+                if self.reasignacion and pendientes:
+                    cursor.execute("SELECT avisar_pendientes(%s)", (pendientes,))
+            
+            if asignaciones:
+                execute_values(
+                    cursor,
+                    """
+                        INSERT INTO asignaciones (
+                            alerta_id,
+                            punto_emergencia_id,
+                            distancia_metros,
+                            tiempo_estimado_segundos
+                        ) VALUES %s
+                    """,
+                    [
+                        (alerta_ids[i], recurso['id'], recurso['distancia_metros'],
+                         recurso['tiempo_estimado_segundos'])
+                        for i, recurso in asignaciones.items()
+                    ],
+                    page_size=len(asignaciones)
+                )
+            
+            _commit(cursor)
+            
+        except Exception as e:
+            logger.error(f"Error procesando lote: {e}")
+            _rollback(cursor)
+            return None
+        
+        logger.debug("Lote procesado: %d alertas, %d asignadas, %d duplicadas",
+                     len(alertas), len(asignaciones), len(duplicadas))
+        
+        resultados = iter(
+            self._resultado(alerta_ids[i], dispositivo_id, datos['tipo'], asignaciones.get(i))
+            for i, (dispositivo_id, datos, _) in enumerate(alertas)
         )
+        return [
+            dict(RESULTADO_DUPLICADO) if i in duplicadas else next(resultados)
+            for i in range(len(todas))
+        ]
+    
+    def _reservar_uplinks_lote(self, cursor, alertas: list) -> set:
+        """
+        Inserta los uplink_id del lote en uplinks_procesados
+        
+        Returns:
+            Indices de las alertas cuyo uplink ya estaba registrado
+            (o repetido dentro del propio lote)
+        """
+        if not self.dedup_persistente:
+            return set()
+        
+        uplink_ids = [uplink_id for _, _, uplink_id in alertas if uplink_id is not None]
+        if not uplink_ids:
+            return set()
+        
+        # DISTINCT: ON CONFLICT DO UPDATE no admite la misma clave dos veces
+        cursor.execute("""
+            INSERT INTO uplinks_procesados (uplink_id)
+            SELECT DISTINCT unnest(%s::VARCHAR[])
+            ON CONFLICT (uplink_id) DO UPDATE
+            SET alerta_id = NULL, fecha_recepcion = EXCLUDED.fecha_recepcion
+            WHERE uplinks_procesados.fecha_recepcion < CURRENT_TIMESTAMP - make_interval(secs => %s)
+            RETURNING uplink_id
+        """, (uplink_ids, self.dedup_ventana))
+        nuevos = {fila['uplink_id'] for fila in cursor.fetchall()}
+        
+        duplicadas = set()
+        for i, (_, _, uplink_id) in enumerate(alertas):
+            if uplink_id is None:
+                continue
+            if uplink_id in nuevos:
+                nuevos.discard(uplink_id)
+            else:
+                duplicadas.add(i)
+        return duplicadas
+    
+    def _repartir_lote(self, cursor, alertas: list, candidatos: dict) -> dict:
+        """
+        Reparte el lote respetando la capacidad libre: en orden de llegada
+        (voraz) o, con despacho 'optimo', cubriendo el maximo de alertas
+        con el menor tiempo total (ver despacho.py).
+        Bloquea los recursos candidatos (en orden de id, sin interbloqueos)
+        para que la capacidad leida no cambie hasta el commit.
+        
+        Returns:
+            {indice de alerta: fila del recurso asignado}
+        """
+        ids = sorted({c['id'] for filas in candidatos.values() for c in filas})
+        if not ids:
+            return {}
+        
+        cursor.execute("""
+            SELECT
+                id, nombre, codigo, municipio, telefono, tipo,
+                ST_X(ubicacion) AS lon,
+                ST_Y(ubicacion) AS lat,
+                velocidad_promedio_kmh, tiempo_preparacion_segundos,
+                capacidad_maxima - capacidad_actual AS libres
+            FROM puntos_emergencia
+            WHERE id = ANY(%s) AND disponible = true
+            ORDER BY id
+            FOR UPDATE
+        """, (ids,))
+        recursos = {fila['id']: fila for fila in cursor.fetchall()}
+        
+        if self.despacho == OPTIMO:
+            return repartir_optimo(
+                [(datos['tipo'], datos['latitud'], datos['longitud']) for _, datos, _ in alertas],
+                recursos, candidatos, self.despacho_max_celdas
+            )
+        
+        libres = {recurso_id: recurso['libres'] for recurso_id, recurso in recursos.items()}
+        return repartir_voraz(len(alertas), candidatos, libres)
+    
+    def _agrupar_lote(self, sesion, alertas: list) -> dict:
+        """
+        Agrupa en su alerta abierta las alertas del lote que lo admitan
+        
+        Returns:
+            {indice de alerta: resultado}
+        """
+        if self.incidentes is None:
+            return {}
+        
+        agrupadas = {}
+        for i, (dispositivo_id, datos, uplink_id) in enumerate(alertas):
+            resultado = self._agrupar_alerta(sesion, dispositivo_id, datos, uplink_id)
+            if resultado:
+                agrupadas[i] = resultado
+        return agrupadas
+    
+    def _registrar_incidentes(self, alertas: list, resultados: list):
+        """Anade al indice de incidentes las alertas recien creadas"""
+        if self.incidentes is None:
+            return
+        
+        for (dispositivo_id, datos, _), resultado in zip(alertas, resultados):
+            if resultado.get('alerta_id'):
+                self.incidentes.registrar(
+                    dispositivo_id, datos['tipo'],
+                    datos['latitud'], datos['longitud'], resultado
+                )
+    
+    def _uplink_persistente(self, uplink_id: str) -> str:
+        """Clave que se registra en uplinks_procesados (None = no se registra)"""
+        if not self.dedup_persistente:
+            return None
+        return clave_persistente(uplink_id)
+    
+    def _procesar_datos(self, sesion, dispositivo_id: str, datos: dict,
+                        uplink_id: str = None) -> dict:
+        uplink_id = self._uplink_persistente(uplink_id)
+        
+        resultado = self._agrupar_alerta(sesion, dispositivo_id, datos, uplink_id)
+        if resultado:
+            return resultado
+        
+        resultado = self._crear_alerta(sesion, dispositivo_id, datos, uplink_id)
+        self._registrar_incidentes([(dispositivo_id, datos, uplink_id)], [resultado])
+        return resultado
+    
+    def _agrupar_alerta(self, sesion, dispositivo_id: str, datos: dict,
+                        uplink_id: str = None) -> dict:
+        """
+        Si el dispositivo tiene una alerta abierta del mismo incidente, la
+        actualiza en lugar de crear otra. None si hay que crear alerta.
+        """
+        if self.incidentes is None:
+            return None
+        
+        abierta = self.incidentes.buscar(
+            dispositivo_id, datos['tipo'], datos['latitud'], datos['longitud']
+        )
+        if not abierta:
+            return None
+        
+        alerta_id = abierta['alerta_id']
+        try:
+            with METRICAS.cronometro('etapa_segundos', etapa='coalescencia'):
+                actualizada = sesion.ejecutar(
+                    self._actualizar_incidente,
+                    alerta_id,
+                    datos['latitud'],
+                    datos['longitud'],
+                    uplink_id,
+                    # Sin uplink_id repetirla contaria la pulsacion dos veces
+                    idempotente=uplink_id is not None
+                )
+        except UplinkDuplicado:
+            logger.debug("Uplink duplicado descartado: %s", uplink_id)
+            return dict(RESULTADO_DUPLICADO)
+        
+        if actualizada is None:
+            return None
+        
+        if not actualizada:
+            # Resuelta desde fuera del sistema: ya no agrupa
+            self.incidentes.cerrar(alerta_id)
+            return None
+        
+        self.incidentes.actualizar(alerta_id, datos['latitud'], datos['longitud'])
+        logger.debug("Alerta agrupada con la abierta: ID %s", alerta_id)
+        
+        return dict(abierta, coalescida=True)
+    
+    def _actualizar_incidente(self, cursor, alerta_id: int, latitud: float,
+                              longitud: float, uplink_id: str = None) -> bool:
+        """
+        Ultima posicion y actividad de una alerta abierta
+        
+        Returns:
+            True si se actualizo, False si ya estaba resuelta, None si hubo error
+        """
+        try:
+            if uplink_id is not None:
+                cursor.execute("""
+                    INSERT INTO uplinks_procesados (uplink_id, alerta_id)
+                    VALUES (%s, %s)
+                    ON CONFLICT (uplink_id) DO UPDATE
+                    SET alerta_id = EXCLUDED.alerta_id, fecha_recepcion = EXCLUDED.fecha_recepcion
+                    WHERE uplinks_procesados.fecha_recepcion < CURRENT_TIMESTAMP - make_interval(secs => %s)
+                    RETURNING uplink_id
+                """, (uplink_id, alerta_id, self.dedup_ventana))
+                if cursor.fetchone() is None:
+                    _rollback(cursor)
+                    raise UplinkDuplicado(uplink_id)
+            
+            cursor.execute("""
+                UPDATE alertas
+                SET ubicacion = ST_SetSRID(ST_MakePoint(%s, %s), 4326),
+                    fecha_ultima_actividad = CURRENT_TIMESTAMP,
+                    pulsaciones = pulsaciones + 1
+                WHERE id = %s AND estado != 'resuelta'
+                RETURNING id
+            """, (longitud, latitud, alerta_id))
+            
+            if cursor.fetchone() is None:
+                _rollback(cursor)
+                return False
+            
+            _commit(cursor)
+            return True
+            
+        except UplinkDuplicado:
+            raise
+        except Exception as e:
+            logger.error(f"Error actualizando alerta {alerta_id}: {e}")
+            _rollback(cursor)
+            return None
+    
+    def _crear_alerta(self, sesion, dispositivo_id: str, datos: dict,
+                      uplink_id: str = None) -> dict:
+        """Registra una alerta nueva y le asigna recurso"""
+        if self.ruta_rapida:
+            return self._procesar_rapido(sesion, dispositivo_id, datos, uplink_id)
+        
+        # Registrar alerta
+        try:
+            with METRICAS.cronometro('etapa_segundos', etapa='registro'):
+                alerta_id = sesion.ejecutar(
+                    self._registrar_alerta,
+                    dispositivo_id=dispositivo_id,
+                    tipo=datos['tipo'],
+                    latitud=datos['latitud'],
+                    longitud=datos['longitud'],
+                    uplink_id=uplink_id,
+                    # Con uplink_id, repetirla da duplicado en lugar de otra alerta
+                    idempotente=uplink_id is not None
+                )
+        except UplinkDuplicado:
+            logger.debug("Uplink duplicado descartado: %s", uplink_id)
+            return dict(RESULTADO_DUPLICADO)
         
         if not alerta_id:
             return {'exito': False, 'error': 'Error en BD'}
         
-        logger.info(f"Alerta registrada: ID {alerta_id}")
+        logger.debug("Alerta registrada: ID %s", alerta_id)
         
         # Asignar recurso
-        asignacion = self._asignar_recurso(alerta_id, datos['tipo'])
+        with METRICAS.cronometro('etapa_segundos', etapa='asignacion'):
+            # Repetir una asignacion ya confirmada ocuparia dos plazas
+            asignacion = sesion.ejecutar(
+                self._asignar_recurso,
+                alerta_id,
+                datos['tipo'],
+                datos['latitud'],
+                datos['longitud'],
+                idempotente=False
+            )
         
-        if not asignacion:
-            logger.warning(f"No hay recursos disponibles")
-            return {
-                'exito': False,
-                'alerta_id': alerta_id,
-                'error': 'Sin recursos disponibles'
-            }
+        if not asignacion and self.reasignacion and self.almacen is None:
+            sesion.ejecutar(self._avisar_pendientes, [alerta_id])
         
-        logger.info(f"Recurso asignado: {asignacion['nombre']}")
+        return self._resultado(alerta_id, dispositivo_id, datos['tipo'], asignacion)
+    
+    def _procesar_rapido(self, sesion, dispositivo_id: str, datos: dict,
+                         uplink_id: str = None) -> dict:
+        """Registra y asigna con la funcion registrar_y_asignar: un viaje y un commit"""
+        with METRICAS.cronometro('etapa_segundos', etapa='registro_y_asignacion'):
+            fila = sesion.ejecutar(
+                self._registrar_y_asignar,
+                dispositivo_id=dispositivo_id,
+                tipo=datos['tipo'],
+                latitud=datos['latitud'],
+                longitud=datos['longitud'],
+                uplink_id=uplink_id,
+                idempotente=uplink_id is not None
+            )
         
-        return {
-            'exito': True,
-            'alerta_id': alerta_id,
-            'dispositivo_id': dispositivo_id,
-            'tipo': datos['tipo'],
-            'asignacion': {
-                'recurso_id': asignacion['id'],
-                'nombre': asignacion['nombre'],
-                'municipio': asignacion['municipio'],
-                'distancia_metros': float(asignacion['distancia_metros']),
-                'tiempo_estimado_minutos': asignacion['tiempo_estimado_segundos'] // 60
-            }
-        }
+        if not fila:
+            return {'exito': False, 'error': 'Error en BD'}
+        
+        if fila['alerta_id'] is None:
+            logger.debug("Uplink duplicado descartado: %s", uplink_id)
+            return dict(RESULTADO_DUPLICADO)
+        
+        logger.debug("Alerta registrada: ID %s", fila['alerta_id'])
+        
+        asignacion = fila if fila['id'] is not None else None
+        return self._resultado(fila['alerta_id'], dispositivo_id, datos['tipo'], asignacion)
     
-    def _registrar_alerta(self, dispositivo_id: str, tipo: str, 
-                         latitud: float, longitud: float) -> int:
+    def _resultado(self, alerta_id: int, dispositivo_id: str, tipo: str,
+                   asignacion: dict) -> dict:
+        return construir_resultado(alerta_id, dispositivo_id, tipo, asignacion)
+    
+    def _registrar_alerta(self, cursor, dispositivo_id: str, tipo: str, 
+                         latitud: float, longitud: float, uplink_id: str = None) -> int:
         """Inserta una alerta en la base de datos"""
         try:
-            query = """
-                INSERT INTO alertas (dispositivo_id, tipo, ubicacion) 
-                VALUES (%s, %s, ST_SetSRID(ST_MakePoint(%s, %s), 4326))
-                RETURNING id
-            """
+            if uplink_id is None:
+                query = """
+                    INSERT INTO alertas (dispositivo_id, tipo, ubicacion) 
+                    VALUES (%s, %s, ST_SetSRID(ST_MakePoint(%s, %s), 4326))
+                    RETURNING id
+                """
+                cursor.execute(query, (dispositivo_id, tipo, longitud, latitud))
+            else:
+                # Si el uplink ya estaba registrado no se devuelve fila
+                query = """
+                    WITH nueva AS (
+                        INSERT INTO alertas (dispositivo_id, tipo, ubicacion) 
+                        VALUES (%s, %s, ST_SetSRID(ST_MakePoint(%s, %s), 4326))
+                        RETURNING id
+                    )
+                    INSERT INTO uplinks_procesados (uplink_id, alerta_id)
+                    SELECT %s, id FROM nueva
+                    ON CONFLICT (uplink_id) DO UPDATE
+                    SET alerta_id = EXCLUDED.alerta_id, fecha_recepcion = EXCLUDED.fecha_recepcion
+                    WHERE uplinks_procesados.fecha_recepcion < CURRENT_TIMESTAMP - make_interval(secs => %s)
+                    RETURNING alerta_id AS id
+                """
+                cursor.execute(query, (dispositivo_id, tipo, longitud, latitud, uplink_id, self.dedup_ventana))
             
-            self.cursor.execute(query, (dispositivo_id, tipo, longitud, latitud))
-            result = self.cursor.fetchone()
-            self.conn.commit()
+            result = cursor.fetchone()
+            if result is None and uplink_id is not None:
+                _rollback(cursor)
+                raise UplinkDuplicado(uplink_id)
+            
+            _commit(cursor)
             
             return result['id'] if result else None
             
+        except UplinkDuplicado:
+            raise
         except Exception as e:
             logger.error(f"Error registrando alerta: {e}")
-            self.conn.rollback()
+            _rollback(cursor)
             return None
     
-    def _asignar_recurso(self, alerta_id: int, tipo: str) -> dict:
-        """Busca el recurso mas cercano disponible del tipo correspondiente"""
+    def _registrar_y_asignar(self, cursor, dispositivo_id: str, tipo: str,
+                             latitud: float, longitud: float, uplink_id: str = None) -> dict:
+        """Llama a la funcion registrar_y_asignar de la BD"""
         try:
-            # Usa ST_Distance de PostGIS para calcular distancias
-            query = """
-                WITH alerta AS (
-                    SELECT id, tipo, ubicacion
-                    FROM alertas
-                    WHERE id = %s
-                )
-                SELECT 
-                    pe.id,
-                    pe.nombre,
-                    pe.codigo,
-                    pe.municipio,
-                    pe.telefono,
-                    ST_Distance(
-                        pe.ubicacion::geography,
-                        alerta.ubicacion::geography
-                    ) AS distancia_metros,
-                    (
-                        (ST_Distance(pe.ubicacion::geography, alerta.ubicacion::geography) / 1000.0) / 
-                        (pe.velocidad_promedio_kmh / 60.0) * 60 + 
-                        pe.tiempo_preparacion_segundos
-                    )::INTEGER AS tiempo_estimado_segundos
-                FROM puntos_emergencia pe
-                CROSS JOIN alerta
-                WHERE 
-                    pe.tipo = alerta.tipo
-                    AND pe.disponible = true
-                ORDER BY distancia_metros ASC
-                LIMIT 1
-            """
+            cursor.execute(
+                "SELECT * FROM registrar_y_asignar(%s, %s, %s, %s, %s, %s, make_interval(secs => %s), %s)",
+                (dispositivo_id, tipo, longitud, latitud, self.knn_candidatos, uplink_id,
+                 self.dedup_ventana, self.reasignacion)
+            )
+            fila = cursor.fetchone()
+            _commit(cursor)
             
-            self.cursor.execute(query, (alerta_id,))
-            recurso = self.cursor.fetchone()
+            return fila
             
-            if not recurso:
-                return None
+        except Exception as e:
+            logger.error(f"Error registrando alerta: {e}")
+            _rollback(cursor)
+            return None
+    
+    def _asignar_recurso(self, cursor, alerta_id: int, tipo: str,
+                         latitud: float, longitud: float) -> dict:
+        """Busca el recurso mas cercano disponible del tipo correspondiente"""
+        try:
+            recurso = self._asignar_desde_indice(cursor, alerta_id, tipo, latitud, longitud)
+            if recurso:
+                return recurso
             
-            # Crear registro de asignacion
-            query_asignar = """
-                INSERT INTO asignaciones (
-                    alerta_id,
-                    punto_emergencia_id,
-                    distancia_metros,
-                    tiempo_estimado_segundos
-                ) VALUES (%s, %s, %s, %s)
-                RETURNING id
-            """
+            if self.asignacion_concurrente:
+                return self._asignar_con_bloqueo(cursor, alerta_id, tipo, latitud, longitud)
             
-            self.cursor.execute(query_asignar, (
-                alerta_id,
-                recurso['id'],
-                recurso['distancia_metros'],
-                recurso['tiempo_estimado_segundos']
-            ))
+            # Con rejilla de tiempos hacen falta todos los candidatos para reordenarlos
+            consulta = CONSULTA_CANDIDATOS if self.tiempos is not None else CONSULTA_RECURSO_CERCANO
+            cursor.execute(consulta, {
+                'tipo': tipo,
+                'latitud': latitud,
+                'longitud': longitud,
+                'candidatos': self.knn_candidatos
+            })
+            candidatos = self._ordenar_candidatos(cursor.fetchall(), latitud, longitud)
             
-            self.conn.commit()
+            if not candidatos:
+                return None
+            recurso = candidatos[0]
+            
+            self._insertar_asignacion(cursor, alerta_id, recurso)
+            _commit(cursor)
             
             return recurso
             
         except Exception as e:
             logger.error(f"Error asignando recurso: {e}")
-            self.conn.rollback()
+            _rollback(cursor)
+            return None
+    
+    def _avisar_pendientes(self, cursor, alerta_ids: list) -> bool:
+        """NOTIFY alertas_pendientes con las alertas que siguen sin recurso"""
+        try:
+            cursor.execute("SELECT avisar_pendientes(%s)", (alerta_ids,))
+            _commit(cursor)
+            return True
+        except Exception as e:
+            logger.error(f"Error avisando de alertas pendientes: {e}")
+            _rollback(cursor)
+            return False
+    
+    def _asignar_desde_indice(self, cursor, alerta_id: int, tipo: str,
+                              latitud: float, longitud: float) -> dict:
+        """Asigna con el indice en memoria; None si hay que recurrir a la consulta SQL"""
+        if not self._indice_vigente():
+            return None
+        
+        if self.tiempos is not None:
+            candidatos = self._ordenar_candidatos(
+                self.indice_recursos.candidatos(tipo, latitud, longitud, self.knn_candidatos),
+                latitud, longitud
+            )
+            recurso = candidatos[0] if candidatos else None
+        else:
+            recurso = self.indice_recursos.mas_cercano(tipo, latitud, longitud)
+        if not recurso:
+            return None
+        
+        if self.asignacion_concurrente and not self._bloquear_recurso(cursor, recurso['id']):
+            _rollback(cursor)
             return None
+        
+        try:
+            self._insertar_asignacion(cursor, alerta_id, recurso)
+            _commit(cursor)
+        except psycopg2.IntegrityError:
+            # chk_capacidad: el indice aun no reflejaba que el recurso se lleno
+            _rollback(cursor)
+            self.indice_recursos.marcar_no_disponible(recurso['id'])
+            return None
+        
+        self.indice_recursos.ocupar(recurso['id'])
+        return recurso
+    
+    def _asignar_con_bloqueo(self, cursor, alerta_id: int, tipo: str,
+                             latitud: float, longitud: float) -> dict:
+        """
+        Reclama el candidato mas cercano con FOR UPDATE SKIP LOCKED.
+        Si esta bloqueado por otro trabajador o ya no esta disponible se pasa
+        al siguiente; si no queda ninguno libre se vuelve a consultar.
+        """
+        for intento in range(self.reintentos_asignacion):
+            cursor.execute(CONSULTA_CANDIDATOS, {
+                'tipo': tipo,
+                'latitud': latitud,
+                'longitud': longitud,
+                'candidatos': self.knn_candidatos
+            })
+            candidatos = self._ordenar_candidatos(cursor.fetchall(), latitud, longitud)
+            
+            if not candidatos:
+                return None
+            
+            for recurso in candidatos:
+                if self._bloquear_recurso(cursor, recurso['id']):
+                    self._insertar_asignacion(cursor, alerta_id, recurso)
+                    _commit(cursor)
+                    return recurso
+            
+            # Todos bloqueados por otros trabajadores: esperar a que confirmen
+            cursor.connection.rollback()
+            time.sleep(random.uniform(0, 0.01 * (intento + 1)))
+        
+        logger.warning(f"No se pudo reclamar recurso para alerta {alerta_id} tras {self.reintentos_asignacion} intentos")
+        return None
+    
+    def _ordenar_candidatos(self, candidatos: list, latitud: float, longitud: float) -> list:
+        """Candidatos en orden de preferencia: por distancia, o por tiempo de viaje con rejilla"""
+        if self.tiempos is None:
+            return candidatos
+        return ordenar_por_tiempo(self.tiempos, candidatos, latitud, longitud)
+    
+    def _bloquear_recurso(self, cursor, recurso_id: int) -> bool:
+        """Bloquea la fila del recurso si sigue disponible y nadie la tiene"""
+        cursor.execute("""
+            SELECT id
+            FROM puntos_emergencia
+            WHERE id = %s AND disponible = true
+            FOR UPDATE SKIP LOCKED
+        """, (recurso_id,))
+        return cursor.fetchone() is not None
+    
+    def _insertar_asignacion(self, cursor, alerta_id: int, recurso: dict):
+        """Crea el registro de asignacion (el trigger ocupa el recurso)"""
+        query_asignar = """
+            INSERT INTO asignaciones (
+                alerta_id,
+                punto_emergencia_id,
+                distancia_metros,
+                tiempo_estimado_segundos
+            ) VALUES (%s, %s, %s, %s)
+            RETURNING id
+        """
+        
+        cursor.execute(query_asignar, (
+            alerta_id,
+            recurso['id'],
+            recurso['distancia_metros'],
+            recurso['tiempo_estimado_segundos']
+        ))
     
     def resolver_alerta(self, alerta_id: int) -> bool:
         """
@@ -199,6 +1115,65 @@ class SistemaEmergencias:
         Returns:
             True si se resolvio correctamente
         """
+        try:
+            with self._sesion() as sesion:
+                resuelta = sesion.ejecutar(self._resolver_alerta, alerta_id)
+        except Exception as e:
+            logger.error(f"Error resolviendo alerta: {e}")
+            return False
+        
+        if resuelta and self.incidentes is not None:
+            self.incidentes.cerrar(alerta_id)
+        return resuelta
+    
+    def reasignar_alerta(self, alerta_id: int, tipo: str, latitud: float,
+                         longitud: float):
+        """
+        Asigna recurso a una alerta que se quedo pendiente (ver reasignacion.py)
+        
+        Returns:
+            Fila del recurso asignado, None si sigue sin recurso, False si la
+            alerta ya no esta pendiente (asignada o resuelta) o
+            ALERTA_BLOQUEADA si sigue pendiente pero bloqueada por otro
+        """
+        try:
+            with self._sesion() as sesion:
+                return sesion.ejecutar(self._reasignar_alerta, alerta_id, tipo, latitud, longitud)
+        except Exception as e:
+            logger.error(f"Error reasignando alerta: {e}")
+            return None
+    
+    def _reasignar_alerta(self, cursor, alerta_id: int, tipo: str,
+                          latitud: float, longitud: float):
+        # El bloqueo de la alerta se mantiene hasta el commit de la asignacion:
+        # no se puede resolver ni asignar desde otro sitio entre medias
+        try:
+            cursor.execute("""
+                SELECT id
+                FROM alertas
+                WHERE id = %s AND estado = 'pendiente'
+                FOR UPDATE SKIP LOCKED
+            """, (alerta_id,))
+            if cursor.fetchone() is None:
+                # Saltada: o ya no esta pendiente o la bloquea otro. El
+                # estado confirmado (sin bloqueo) distingue los dos casos
+                cursor.execute("SELECT estado FROM alertas WHERE id = %s", (alerta_id,))
+                fila = cursor.fetchone()
+                _rollback(cursor)
+                if fila is not None and fila['estado'] == 'pendiente':
+                    return ALERTA_BLOQUEADA
+                return False
+        except Exception as e:
+            logger.error(f"Error bloqueando alerta {alerta_id}: {e}")
+            _rollback(cursor)
+            return None
+        
+        recurso = self._asignar_recurso(cursor, alerta_id, tipo, latitud, longitud)
+        if not recurso:
+            _rollback(cursor)
+        return recurso
+    
+    def _resolver_alerta(self, cursor, alerta_id: int) -> bool:
         try:
             query = """
                 UPDATE alertas 
@@ -207,9 +1182,9 @@ class SistemaEmergencias:
                 RETURNING id
             """
             
-            self.cursor.execute(query, (alerta_id,))
-            result = self.cursor.fetchone()
-            self.conn.commit()
+            cursor.execute(query, (alerta_id,))
+            result = cursor.fetchone()
+            _commit(cursor)
             
             if result:
                 logger.info(f"Alerta {alerta_id} resuelta, recurso liberado")
@@ -220,7 +1195,7 @@ class SistemaEmergencias:
                 
         except Exception as e:
             logger.error(f"Error resolviendo alerta: {e}")
-            self.conn.rollback()
+            _rollback(cursor)
             return False
     
     def __enter__(self):
@@ -229,3 +1204,68 @@ class SistemaEmergencias:
     
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.desconectar_bd()
+
+
+def construir_resultado(alerta_id: int, dispositivo_id: str, tipo: str,
+                        asignacion) -> dict:
+    """Construye el resultado de procesar_alerta (asignacion: fila del recurso o None)"""
+    if not asignacion:
+        logger.warning("No hay recursos disponibles")
+        return {
+            'exito': False,
+            'alerta_id': alerta_id,
+            'error': 'Sin recursos disponibles'
+        }
+    
+    logger.debug("Recurso asignado: %s", asignacion['nombre'])
+    
+    return {
+        'exito': True,
+        'alerta_id': alerta_id,
+        'dispositivo_id': dispositivo_id,
+        'tipo': tipo,
+        'asignacion': {
+            'recurso_id': asignacion['id'],
+            'nombre': asignacion['nombre'],
+            'municipio': asignacion['municipio'],
+            'distancia_metros': float(asignacion['distancia_metros']),
+            'tiempo_estimado_minutos': asignacion['tiempo_estimado_segundos'] // 60
+        }
+    }
+
+
+def alerta_registrada(resultado: dict) -> bool:
+    """False si la alerta no llego a la BD (error) y hay que aceptar su reenvio"""
+    return bool(resultado.get('exito') or resultado.get('alerta_id') or resultado.get('duplicado'))
+
+
+def contar_resultado(resultado: dict) -> dict:
+    """Cuenta el resultado de procesar_alerta en las metricas y lo devuelve"""
+    if resultado.get('coalescida'):
+        clase = 'coalescida'
+    elif resultado['exito']:
+        clase = 'asignada'
+    elif resultado.get('duplicado'):
+        clase = 'duplicado'
+    else:
+        clase = {
+            'Sin recursos disponibles': 'sin_recurso',
+            'Payload invalido': 'payload_invalido'
+        }.get(resultado.get('error'), 'error_bd')
+    METRICAS.incrementar('alertas_total', resultado=clase)
+    return resultado
+
+
+def _commit(cursor):
+    # Desde aqui una caida deja en duda si la transaccion se confirmo
+    cursor.commit_enviado = True
+    with METRICAS.cronometro('etapa_segundos', etapa='commit'):
+        cursor.connection.commit()
+
+
+def _rollback(cursor):
+    """Deshace la transaccion; si la conexion esta caida no hay nada que deshacer"""
+    try:
+        cursor.connection.rollback()
+    except psycopg2.Error:
+        pass
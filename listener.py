@@ -8,7 +8,15 @@ import logging
 import signal
 import sys
 import os
-from integracion import SistemaEmergencias
+import time
+from integracion import SistemaEmergencias, alerta_registrada, contar_resultado
+from procesamiento import CARRIL_POR_TIPO, ESTRICTO, ColaAlertas, ColaPrioridades, PoolTrabajadores, clasificar
+from lotes import AcumuladorLotes
+from spool import Spool, VaciadorSpool
+from reasignacion import Reasignador
+from deduplicacion import CacheDeduplicacion, clave_uplink
+from metricas import METRICAS, ServidorMetricas, VolcadoMetricas, configurar_registro
+from telemetria import TELEMETRIA
 
 if sys.platform == 'win32':
     os.environ['PGCLIENTENCODING'] = 'UTF8'
@@ -19,11 +27,132 @@ logger = logging.getLogger(__name__)
 
 class ListenerLoRaWAN:
     
-    def __init__(self, mqtt_config: dict, db_config: dict):
+    def __init__(self, mqtt_config: dict, db_config: dict,
+                 procesamiento_config: dict = None, filtro_topic=None):
         self.mqtt_config = mqtt_config
+        self.db_config = db_config
         self.sistema = SistemaEmergencias(db_config)
         
-        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        # filtro_topic(topic) -> bool: los mensajes que no pasan se ignoran
+        # (reparto por dispositivo entre procesos, ver supervisor.py)
+        self.filtro_topic = filtro_topic
+        
+        # Pool de trabajadores: si no se configura, se procesa en el hilo MQTT
+        self.cola = None
+        self.carril_por_tipo = None
+        self.pool = None
+        self.acumulador = None
+        procesamiento_config = procesamiento_config or {}
+        
+        # Descarte de uplinks repetidos (varios gateways, reintentos)
+        self.dedup = CacheDeduplicacion(
+            ttl_segundos=procesamiento_config.get('dedup_ttl_segundos', 300),
+            max_entradas=procesamiento_config.get('dedup_max_entradas', 100_000)
+        )
+        
+        # Spool en disco: la alerta decodificada se guarda y se responde al
+        # broker sin esperar a la BD; el vaciador la registra por lotes
+        self.spool = None
+        self.vaciador = None
+        if procesamiento_config.get('spool_directorio'):
+            self.spool = Spool(
+                procesamiento_config['spool_directorio'],
+                fsync_ms=procesamiento_config.get('spool_fsync_ms', 50),
+                max_segmento_bytes=procesamiento_config.get('spool_segmento_mb', 16) * 1024 * 1024
+            )
+            self.vaciador = VaciadorSpool(
+                self.spool,
+                self.sistema,
+                procesar_resultado=self._registrar_resultado,
+                max_lote=procesamiento_config.get('spool_lote', 100)
+            )
+            METRICAS.medidor('spool_pendientes', lambda: self.spool.metricas()['pendientes'])
+            if procesamiento_config.get('trabajadores', 0) > 0:
+                logger.info("Spool activo: el vaciador sustituye a la cola de trabajadores")
+            if procesamiento_config.get('carriles'):
+                logger.info("Spool activo: los carriles de prioridad no se usan (el spool es FIFO)")
+        
+        elif procesamiento_config.get('trabajadores', 0) > 0:
+            # Con pool de conexiones todos los trabajadores comparten el sistema
+            # (el almacen en memoria tambien se comparte: es uno por sistema)
+            compartir = db_config.get('pool_max') or db_config.get('almacen') == 'memoria'
+            sistema_compartido = self.sistema if compartir else None
+            
+            if procesamiento_config.get('carriles'):
+                # Un carril por prioridad en lugar de la cola FIFO
+                self.cola = ColaPrioridades(
+                    procesamiento_config['carriles'],
+                    despacho=procesamiento_config.get('despacho_carriles', ESTRICTO)
+                )
+                self.carril_por_tipo = procesamiento_config.get('carril_por_tipo', CARRIL_POR_TIPO)
+                for carril in self.cola.carriles:
+                    METRICAS.medidor(
+                        f'cola_profundidad_{carril}',
+                        lambda carril=carril: self.cola.metricas()['carriles'][carril]['profundidad']
+                    )
+            else:
+                self.cola = ColaAlertas(
+                    capacidad=procesamiento_config.get('capacidad_cola', 1000),
+                    politica=procesamiento_config.get('politica_cola', 'bloquear'),
+                    ruta_desborde=procesamiento_config.get('ruta_desborde', 'cola_desborde.jsonl')
+                )
+            
+            num_trabajadores = procesamiento_config['trabajadores']
+            if procesamiento_config.get('lote_max', 0) > 0:
+                # Micro-lotes: el acumulador lee la cola el mismo (una sola
+                # conexion) y los lotes llegan a lote_max aunque haya pocos
+                # hilos. El pool queda sin trabajadores, solo para el informe
+                self.acumulador = AcumuladorLotes(
+                    self.sistema,
+                    max_lote=procesamiento_config['lote_max'],
+                    espera_ms=procesamiento_config.get('lote_espera_ms', 20),
+                    espera_por_tipo=procesamiento_config.get('lote_espera_por_tipo'),
+                    cola=self.cola,
+                    procesar_resultado=self._registrar_resultado
+                )
+                num_trabajadores = 0
+                sistema_compartido = self.sistema
+            
+            self.pool = PoolTrabajadores(
+                self.cola,
+                crear_sistema=lambda: SistemaEmergencias(self.db_config),
+                procesar_resultado=self._registrar_resultado,
+                num_trabajadores=num_trabajadores,
+                intervalo_metricas=procesamiento_config.get('intervalo_metricas', 60.0),
+                sistema_compartido=sistema_compartido
+            )
+        
+        # Motor de reasignacion de alertas pendientes en este proceso
+        self.reasignador = None
+        if procesamiento_config.get('motor_reasignacion'):
+            self.reasignador = Reasignador(
+                db_config,
+                ventana_segundos=procesamiento_config.get('reasignacion_ventana_segundos', 30.0)
+            )
+        
+        # Telemetria de bateria y registro de dispositivos (volcado por lotes)
+        self.telemetria = procesamiento_config.get('telemetria', False)
+        self.telemetria_config = {
+            'capacidad': procesamiento_config.get('telemetria_buffer', 100_000),
+            'intervalo': procesamiento_config.get('telemetria_intervalo', 5.0),
+            'umbral_bateria': procesamiento_config.get('bateria_baja', 20)
+        }
+        
+        # Metricas: endpoint Prometheus y/o resumen periodico en el log
+        self.servidor_metricas = None
+        self.volcado_metricas = None
+        if procesamiento_config.get('puerto_metricas'):
+            self.servidor_metricas = ServidorMetricas(puerto=procesamiento_config['puerto_metricas'])
+        if procesamiento_config.get('volcado_metricas'):
+            self.volcado_metricas = VolcadoMetricas(intervalo=procesamiento_config['volcado_metricas'])
+        if self.cola is not None:
+            METRICAS.medidor('cola_profundidad', lambda: self.cola.metricas()['profundidad'])
+            METRICAS.medidor('cola_descartadas', lambda: self.cola.metricas()['descartadas'])
+        
+        self.client = mqtt.Client(
+            mqtt.CallbackAPIVersion.VERSION2,
+            client_id=mqtt_config.get('client_id', '')
+        )
         self.client.on_connect = self._on_connect
         self.client.on_message = self._on_message
         self.client.on_disconnect = self._on_disconnect
@@ -49,32 +178,104 @@ class ListenerLoRaWAN:
     
     def _on_message(self, client, userdata, msg):
         """Procesa mensajes recibidos"""
+        if self.filtro_topic is not None and not self.filtro_topic(msg.topic):
+            return
+        
+        with METRICAS.cronometro('etapa_segundos', etapa='recepcion'):
+            self._recibir(msg)
+    
+    def _recibir(self, msg):
+        uplink_id = None
         try:
-            logger.info("Mensaje recibido")
+            METRICAS.incrementar('mensajes_total')
             
-            payload = json.loads(msg.payload.decode('utf-8'))
+            with METRICAS.cronometro('etapa_segundos', etapa='json'):
+                payload = json.loads(msg.payload.decode('utf-8'))
             
             # Extraer datos de ChirpStack
             dev_eui = payload.get('devEUI', payload.get('deviceName', 'unknown'))
             payload_base64 = payload.get('data', '')
             
-            logger.info(f"DevEUI: {dev_eui}")
+            logger.debug("Mensaje recibido de %s", dev_eui)
             
-            resultado = self.sistema.procesar_alerta(dev_eui, payload_base64)
+            uplink_id = clave_uplink(dev_eui, payload)
+            if self.dedup.es_duplicado(uplink_id):
+                METRICAS.incrementar('mensajes_descartados_total', motivo='duplicado')
+                logger.debug("Uplink duplicado descartado: %s", uplink_id)
+                return
             
-            if resultado['exito']:
-                logger.info("Alerta procesada correctamente")
-                asig = resultado['asignacion']
-                logger.info(f"Alerta ID: {resultado['alerta_id']}")
-                logger.info(f"Recurso: {asig['nombre']} ({asig['municipio']})")
-                logger.info(f"Distancia: {asig['distancia_metros']:.0f}m, Tiempo: {asig['tiempo_estimado_minutos']}min")
-            else:
-                logger.error(f"Error: {resultado.get('error')}")
+            if self.spool is not None:
+                self._guardar_en_spool(dev_eui, payload_base64, uplink_id)
+                return
+            
+            if self.cola is not None:
+                # Encolar y liberar el hilo MQTT cuanto antes
+                elemento = {
+                    'dispositivo_id': dev_eui,
+                    'payload': payload_base64,
+                    'uplink_id': uplink_id,
+                    'recibido': time.time()
+                }
+                if self.carril_por_tipo is not None:
+                    elemento['carril'] = clasificar(
+                        self.sistema.decoder.cabecera(payload_base64), self.carril_por_tipo
+                    )
+                self.cola.poner(elemento)
+                return
+            
+            resultado = self.sistema.procesar_alerta(dev_eui, payload_base64, uplink_id)
+            self._registrar_resultado(resultado, uplink_id)
                 
         except json.JSONDecodeError:
+            METRICAS.incrementar('mensajes_descartados_total', motivo='json')
             logger.error("JSON invalido")
         except Exception as e:
+            METRICAS.incrementar('mensajes_descartados_total', motivo='error')
             logger.error(f"Error procesando mensaje: {e}")
+            if uplink_id is not None:
+                self.dedup.olvidar(uplink_id)
+    
+    def _guardar_en_spool(self, dev_eui: str, payload_base64: str, uplink_id: str):
+        with METRICAS.cronometro('etapa_segundos', etapa='decodificacion'):
+            datos = self.sistema.decoder.decode(payload_base64)
+        if not datos:
+            self._registrar_resultado(contar_resultado({'exito': False, 'error': 'Payload invalido'}))
+            return
+        TELEMETRIA.registrar(dev_eui, datos)
+        
+        with METRICAS.cronometro('etapa_segundos', etapa='spool'):
+            self.spool.escribir({
+                'dispositivo_id': dev_eui,
+                'datos': datos,
+                'uplink_id': uplink_id,
+                'recibido': time.time()
+            })
+    
+    def _registrar_resultado(self, resultado: dict, uplink_id: str = None):
+        # Marcado como visto al recibirlo: si no llego a la BD, el reenvio
+        # del dispositivo (mismo fCnt) no debe descartarse como duplicado
+        if uplink_id is not None and not alerta_registrada(resultado):
+            self.dedup.olvidar(uplink_id)
+        
+        if resultado['exito']:
+            if logger.isEnabledFor(logging.DEBUG):
+                asig = resultado['asignacion']
+                logger.debug(
+                    f"Alerta {resultado['alerta_id']}: {asig['nombre']} ({asig['municipio']}), "
+                    f"{asig['distancia_metros']:.0f}m, {asig['tiempo_estimado_minutos']}min"
+                )
+        elif resultado.get('duplicado'):
+            logger.debug("Uplink ya registrado por otra instancia, descartado")
+        else:
+            logger.error(f"Error: {resultado.get('error')}")
+    
+    def metricas(self) -> dict:
+        """Metricas de la cola de procesamiento y de deduplicacion"""
+        metricas = self.cola.metricas() if self.cola is not None else {}
+        if self.spool is not None:
+            metricas.update({f"spool_{k}": v for k, v in self.spool.metricas().items()})
+        metricas['duplicados'] = self.dedup.duplicados
+        return metricas
     
     def iniciar(self):
         """Inicia el listener"""
@@ -83,10 +284,33 @@ class ListenerLoRaWAN:
             logger.info(f"Broker MQTT: {self.mqtt_config['broker']}:{self.mqtt_config['port']}")
             logger.info(f"Topic: {self.mqtt_config['topic']}")
             
-            if not self.sistema.conectar_bd():
-                logger.error("No se pudo conectar a BD")
+            if self.vaciador is not None:
+                # Con spool se escucha aunque la BD no este disponible
+                self.vaciador.iniciar()
+            elif self.pool is None or self.pool.sistema_compartido is not None:
+                if not self.sistema.conectar_bd():
+                    logger.error("No se pudo conectar a BD")
+                    return False
+            
+            if self.reasignador is not None and not self.reasignador.iniciar():
+                logger.error("No se pudo iniciar el motor de reasignacion")
                 return False
             
+            if self.telemetria:
+                TELEMETRIA.iniciar(self.db_config, **self.telemetria_config)
+            
+            if self.servidor_metricas is not None:
+                self.servidor_metricas.iniciar()
+            if self.volcado_metricas is not None:
+                self.volcado_metricas.iniciar()
+            
+            if self.acumulador is not None:
+                self.acumulador.iniciar()
+            
+            if self.pool is not None:
+                # Sin pool de conexiones, cada trabajador abre la suya
+                self.pool.iniciar()
+            
             self.client.connect(
                 self.mqtt_config['broker'],
                 self.mqtt_config['port'],
@@ -106,30 +330,48 @@ class ListenerLoRaWAN:
     def detener(self):
         logger.info("Deteniendo listener")
         self.client.disconnect()
+        # El acumulador primero: cierra la cola y registra lo que quede en ella
+        if self.acumulador is not None:
+            self.acumulador.detener()
+        if self.pool is not None:
+            self.pool.detener()
+        if self.vaciador is not None:
+            self.vaciador.detener()
+            self.spool.cerrar()
+        if self.reasignador is not None:
+            self.reasignador.detener()
+        TELEMETRIA.detener()
+        if self.volcado_metricas is not None:
+            self.volcado_metricas.detener()
+        if self.servidor_metricas is not None:
+            self.servidor_metricas.detener()
         self.sistema.desconectar_bd()
 
 
 def signal_handler(sig, frame):
-    sys.exit(0)
+    # iniciar() la recoge y llama a detener(): se vacian la cola, el
+    # acumulador y el spool antes de salir
+    raise KeyboardInterrupt
 
 
 if __name__ == "__main__":
     signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
     
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.StreamHandler(),
-            logging.FileHandler('sistema_emergencias.log')
-        ]
-    )
+    # Los hilos de procesamiento solo encolan los registros de log
+    escucha_log = configurar_registro(logging.INFO, 'sistema_emergencias.log')
     
     try:
+        import config
         from config import DB_CONFIG, MQTT_CONFIG
     except ImportError:
         print("Error: No se encontro config.py")
         sys.exit(1)
     
-    listener = ListenerLoRaWAN(MQTT_CONFIG, DB_CONFIG)
-    listener.iniciar()
+    PROCESAMIENTO_CONFIG = getattr(config, 'PROCESAMIENTO_CONFIG', None)
+    
+    listener = ListenerLoRaWAN(MQTT_CONFIG, DB_CONFIG, PROCESAMIENTO_CONFIG)
+    try:
+        listener.iniciar()
+    finally:
+        escucha_log.stop()
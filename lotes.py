@@ -0,0 +1,220 @@
+"""
+Micro-lotes de alertas
+Agrupa las alertas que llegan en rafaga para registrarlas con un solo commit
+"""
+
+import logging
+import threading
+import time
+
+from integracion import contar_resultado
+from metricas import METRICAS
+from procesamiento import observar_extremo
+from telemetria import TELEMETRIA
+
+logger = logging.getLogger(__name__)
+
+
+class _AlertaPendiente:
+
+    def __init__(self, dispositivo_id: str, datos: dict, uplink_id: str, plazo: float,
+                 elemento: dict = None):
+        self.dispositivo_id = dispositivo_id
+        self.datos = datos
+        self.uplink_id = uplink_id
+        self.plazo = plazo
+        # Elemento de la cola (modo drenaje)
+        self.elemento = elemento
+        self.resultado = None
+        self.lista = threading.Event()
+
+
+class AcumuladorLotes:
+    """
+    Recoge alertas hasta `max_lote` o hasta que vence el plazo de la mas
+    urgente, y las procesa con SistemaEmergencias.procesar_lote.
+
+    El plazo de cada alerta es `espera_ms`, o el de su tipo en
+    `espera_por_tipo` (p.ej. {'medica': 5}): ninguna alerta espera en el
+    acumulador mas de lo que marque su tipo.
+
+    Dos formas de alimentarlo:
+
+        - con `cola` (ColaAlertas o ColaPrioridades), su hilo lee la cola
+          directamente y entrega cada resultado a
+          `procesar_resultado(resultado, uplink_id)`. Es
+          la del listener: el lote no depende de cuantos hilos esperan.
+        - procesar_alerta, con la misma firma que la de SistemaEmergencias,
+          bloquea hasta tener el resultado. Un lote nunca junta mas alertas
+          que hilos llamando a la vez.
+    """
+
+    def __init__(self, sistema, max_lote: int = 100, espera_ms: float = 20,
+                 espera_por_tipo: dict = None, cola=None, procesar_resultado=None):
+        self.sistema = sistema
+        self.cola = cola
+        self.procesar_resultado = procesar_resultado
+        self.max_lote = max_lote
+        self.espera = espera_ms / 1000.0
+        self.espera_por_tipo = {
+            tipo: ms / 1000.0 for tipo, ms in (espera_por_tipo or {}).items()
+        }
+
+        self._pendientes = []
+        self._cond = threading.Condition()
+        self._parar = False
+        self._hilo = None
+
+        # Metricas
+        self.lotes = 0
+        self.alertas = 0
+        self.lote_maximo = 0
+
+    def iniciar(self):
+        objetivo = self._drenar if self.cola is not None else self._ejecutar
+        self._hilo = threading.Thread(target=objetivo, name="acumulador-lotes", daemon=True)
+        self._hilo.start()
+
+    def detener(self, timeout: float = 5.0):
+        """Procesa lo que quede (tambien en la cola) y para"""
+        with self._cond:
+            self._parar = True
+            self._cond.notify_all()
+        if self.cola is not None:
+            self.cola.cerrar()
+        if self._hilo:
+            self._hilo.join(timeout)
+
+    def procesar_alerta(self, dispositivo_id: str, payload_base64: str,
+                        uplink_id: str = None) -> dict:
+        """Decodifica, encola en el lote en curso y espera el resultado"""
+        with METRICAS.cronometro('etapa_segundos', etapa='decodificacion'):
+            datos = self.sistema.decoder.decode(payload_base64)
+        if not datos:
+            return contar_resultado({'exito': False, 'error': 'Payload invalido'})
+        TELEMETRIA.registrar(dispositivo_id, datos)
+
+        espera = self.espera_por_tipo.get(datos['tipo'], self.espera)
+        pendiente = _AlertaPendiente(dispositivo_id, datos, uplink_id, time.monotonic() + espera)
+
+        with self._cond:
+            if self._parar:
+                return {'exito': False, 'error': 'Acumulador detenido'}
+            self._pendientes.append(pendiente)
+            self._cond.notify_all()
+
+        pendiente.lista.wait()
+        return pendiente.resultado
+
+    def _ejecutar(self):
+        while True:
+            lote = self._siguiente_lote()
+            if lote is None:
+                return
+            self._procesar(lote)
+            for pendiente in lote:
+                pendiente.lista.set()
+
+    def _drenar(self):
+        while True:
+            lote = self._leer_cola()
+            if lote is None:
+                return
+            self._procesar(lote)
+
+            ahora = time.time()
+            for pendiente in lote:
+                recibido = pendiente.elemento.get('recibido')
+                if recibido is not None:
+                    observar_extremo(self.cola, pendiente.elemento, ahora - recibido)
+                self._entregar(pendiente.resultado, pendiente.uplink_id)
+
+    def _procesar(self, lote: list):
+        METRICAS.incrementar('lotes_total')
+        METRICAS.incrementar('lotes_alertas_total', len(lote))
+
+        try:
+            resultados = self.sistema.procesar_lote(
+                [(p.dispositivo_id, p.datos, p.uplink_id) for p in lote]
+            )
+        except Exception as e:
+            logger.error(f"Error procesando lote: {e}")
+            resultados = [{'exito': False, 'error': 'Error en BD'} for _ in lote]
+
+        self.lotes += 1
+        self.alertas += len(lote)
+        self.lote_maximo = max(self.lote_maximo, len(lote))
+
+        for pendiente, resultado in zip(lote, resultados):
+            pendiente.resultado = resultado
+
+    def _entregar(self, resultado: dict, uplink_id: str = None):
+        try:
+            self.procesar_resultado(resultado, uplink_id)
+        except Exception as e:
+            logger.error(f"Error procesando resultado: {e}")
+        finally:
+            self.cola.marcar_procesada()
+
+    def _leer_cola(self) -> list:
+        """
+        Saca de la cola hasta `max_lote` alertas o hasta que vence el plazo
+        de la mas urgente (contado desde su recepcion). Vencido el plazo se
+        sigue sacando lo que ya este en cola sin esperar: con la cola atrasada
+        los lotes salen llenos. None al cerrar la cola sin nada pendiente.
+        """
+        lote = []
+        plazo = None
+        while len(lote) < self.max_lote:
+            if plazo is None:
+                espera = 1.0
+            else:
+                espera = max(plazo - time.monotonic(), 0)
+
+            elemento = self.cola.obtener(timeout=espera)
+            if elemento is None:
+                if self._parar or plazo is not None:
+                    break
+                continue
+
+            recibido = elemento.get('recibido')
+            if recibido is not None:
+                METRICAS.observar('etapa_segundos', time.time() - recibido, etapa='cola')
+
+            with METRICAS.cronometro('etapa_segundos', etapa='decodificacion'):
+                datos = self.sistema.decoder.decode(elemento['payload'])
+            if not datos:
+                self._entregar(contar_resultado({'exito': False, 'error': 'Payload invalido'}))
+                continue
+            TELEMETRIA.registrar(elemento['dispositivo_id'], datos)
+
+            espera_tipo = self.espera_por_tipo.get(datos['tipo'], self.espera)
+            if recibido is not None:
+                espera_tipo -= time.time() - recibido
+            pendiente = _AlertaPendiente(
+                elemento['dispositivo_id'], datos, elemento.get('uplink_id'),
+                time.monotonic() + espera_tipo, elemento
+            )
+            lote.append(pendiente)
+            plazo = pendiente.plazo if plazo is None else min(plazo, pendiente.plazo)
+
+        if not lote and self._parar:
+            return None
+        return lote
+
+    def _siguiente_lote(self) -> list:
+        """Espera hasta que el lote este lleno o venza el primer plazo"""
+        with self._cond:
+            while True:
+                if self._pendientes:
+                    plazo = min(p.plazo for p in self._pendientes)
+                    restante = plazo - time.monotonic()
+                    if len(self._pendientes) >= self.max_lote or restante <= 0 or self._parar:
+                        lote = self._pendientes[:self.max_lote]
+                        del self._pendientes[:self.max_lote]
+                        return lote
+                    self._cond.wait(restante)
+                elif self._parar:
+                    return None
+                else:
+                    self._cond.wait()
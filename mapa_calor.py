@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Mapa de calor del historico de alertas
+
+Lee la tabla resumen mapa_alertas (alertas por celda de 0.01 grados, hora
+y tipo), que el trigger acumular_mapa mantiene al insertar alertas. Una
+consulta de cualquier rectangulo y periodo suma filas del resumen, no
+recorre alertas: tarda milisegundos aunque el historico sea de anos.
+
+Las teselas salen como GeoJSON (un poligono por tesela, con su total)
+para pintarlas en un mapa. Con --agrupar N cada tesela junta NxN celdas
+(zoom alejado).
+
+En una base de datos anterior al mapa, rellenarlo una vez:
+    python mapa_calor.py --recalcular --desde 2025-01-01
+
+Uso:
+    python mapa_calor.py --desde 2026-01-01 --hasta 2026-02-01
+    python mapa_calor.py --desde 2026-01-01 --tipo medica --agrupar 2 > medica.geojson
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import sys
+import time
+
+import psycopg2
+
+if sys.platform == 'win32':
+    os.environ['PGCLIENTENCODING'] = 'UTF8'
+    os.environ['PYTHONIOENCODING'] = 'utf-8'
+
+logger = logging.getLogger(__name__)
+
+# Caja aproximada de Las Hurdes (oeste, sur, este, norte)
+LAS_HURDES = (-6.45, 40.25, -6.10, 40.50)
+
+
+class MapaCalor:
+    """Consultas de teselas sobre mapa_alertas"""
+
+    def __init__(self, db_config: dict):
+        self.db_config = db_config
+        self.conn = None
+
+    def conectar(self):
+        self.conn = psycopg2.connect(
+            host=self.db_config['host'],
+            port=self.db_config.get('port', 5432),
+            database=self.db_config['database'],
+            user=self.db_config['user'],
+            password=self.db_config['password'],
+            options='-c client_encoding=UTF8'
+        )
+        self.conn.autocommit = True
+
+    def desconectar(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def teselas(self, desde: datetime.datetime, hasta: datetime.datetime, caja: tuple = LAS_HURDES,
+                tipo: str = None, agrupar: int = 1) -> list:
+        """
+        Alertas por tesela dentro de `caja` (oeste, sur, este, norte) entre
+        `desde` y `hasta` (por horas completas)
+
+        Returns:
+            Lista de dicts con oeste, sur, este, norte y total
+        """
+        inicio = time.perf_counter()
+        with self.conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT oeste, sur, este, norte, total FROM mapa_calor(%s, %s, %s, %s, %s, %s, %s, %s)",
+                (*caja, desde, hasta, tipo, max(agrupar, 1))
+            )
+            columnas = [c.name for c in cursor.description]
+            teselas = [dict(zip(columnas, fila)) for fila in cursor.fetchall()]
+
+        logger.info(f"{len(teselas)} teselas en {(time.perf_counter() - inicio) * 1000:.1f} ms")
+        return teselas
+
+    def recalcular(self, desde: datetime.datetime, hasta: datetime.datetime) -> int:
+        """Rehace el resumen del periodo desde alertas (recalcular_mapa)"""
+        with self.conn.cursor() as cursor:
+            cursor.execute("SELECT recalcular_mapa(%s, %s)", (desde, hasta))
+            return cursor.fetchone()[0]
+
+
+def geojson(teselas: list) -> dict:
+    """FeatureCollection con un rectangulo por tesela"""
+    return {
+        'type': 'FeatureCollection',
+        'features': [
+            {
+                'type': 'Feature',
+                'geometry': {
+                    'type': 'Polygon',
+                    'coordinates': [[
+                        [t['oeste'], t['sur']],
+                        [t['este'], t['sur']],
+                        [t['este'], t['norte']],
+                        [t['oeste'], t['norte']],
+                        [t['oeste'], t['sur']]
+                    ]]
+                },
+                'properties': {'total': t['total']}
+            }
+            for t in teselas
+        ]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mapa de calor del historico de alertas (GeoJSON)")
+    parser.add_argument('--desde', type=datetime.datetime.fromisoformat, required=True,
+                        help="fecha u hora inicial (ISO 8601)")
+    parser.add_argument('--hasta', type=datetime.datetime.fromisoformat,
+                        help="fecha u hora final, excluida (por defecto, ahora)")
+    parser.add_argument('--caja', type=lambda s: tuple(float(v) for v in s.split(',')), default=LAS_HURDES,
+                        metavar='OESTE,SUR,ESTE,NORTE')
+    parser.add_argument('--tipo', choices=['medica', 'policial', 'bomberos', 'rescate'])
+    parser.add_argument('--agrupar', type=int, default=1, help="celdas por lado de cada tesela")
+    parser.add_argument('--recalcular', action='store_true',
+                        help="rehacer el resumen del periodo desde alertas en lugar de consultarlo")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if len(args.caja) != 4:
+        parser.error("--caja necesita cuatro valores")
+    hasta = args.hasta or datetime.datetime.now()
+
+    from config import DB_CONFIG
+
+    mapa = MapaCalor(DB_CONFIG)
+    mapa.conectar()
+    try:
+        if args.recalcular:
+            celdas = mapa.recalcular(args.desde, hasta)
+            logger.info(f"Mapa recalculado: {celdas} celdas")
+        else:
+            teselas = mapa.teselas(args.desde, hasta, args.caja, args.tipo, args.agrupar)
+            json.dump(geojson(teselas), sys.stdout, default=float)
+            sys.stdout.write('\n')
+    finally:
+        mapa.desconectar()
+
+
+if __name__ == "__main__":
+    main()
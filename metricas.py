@@ -0,0 +1,258 @@
+"""
+Metricas del procesamiento de alertas
+Histogramas de tiempos por etapa y contadores de resultados, expuestos en
+formato Prometheus por HTTP o volcados periodicamente al log
+"""
+
+import bisect
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Limites de los cubos en segundos: de 0.1 ms a 10 s
+LIMITES_SEGUNDOS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+PREFIJO = 'emergencias_'
+
+
+class Histograma:
+    """Histograma de cubos fijos (acumulables como los de Prometheus)"""
+
+    def __init__(self, limites: tuple = LIMITES_SEGUNDOS):
+        self.limites = limites
+        self.cubos = [0] * (len(limites) + 1)
+        self.suma = 0.0
+        self.total = 0
+
+    def observar(self, valor: float):
+        self.cubos[bisect.bisect_left(self.limites, valor)] += 1
+        self.suma += valor
+        self.total += 1
+
+    def percentil(self, p: float) -> float:
+        """Limite superior del cubo donde cae el percentil p (0-100)"""
+        if not self.total:
+            return None
+        objetivo = p / 100.0 * self.total
+        acumulado = 0
+        for i, n in enumerate(self.cubos):
+            acumulado += n
+            if acumulado >= objetivo:
+                return self.limites[i] if i < len(self.limites) else float('inf')
+        return float('inf')
+
+
+class RegistroMetricas:
+    """
+    Histogramas y contadores con etiquetas, seguros entre hilos.
+
+    Las etiquetas se pasan como argumentos con nombre:
+        METRICAS.incrementar('alertas_total', resultado='asignada')
+        with METRICAS.cronometro('etapa_segundos', etapa='decodificacion'): ...
+    """
+
+    def __init__(self):
+        self._histogramas = {}
+        self._contadores = {}
+        self._medidores = {}
+        self._lock = threading.Lock()
+
+    def observar(self, nombre: str, valor: float, **etiquetas):
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        with self._lock:
+            histograma = self._histogramas.get(clave)
+            if histograma is None:
+                histograma = self._histogramas[clave] = Histograma()
+            histograma.observar(valor)
+
+    def incrementar(self, nombre: str, n: int = 1, **etiquetas):
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        with self._lock:
+            self._contadores[clave] = self._contadores.get(clave, 0) + n
+
+    def medidor(self, nombre: str, funcion):
+        """Valor instantaneo que se lee al exportar (p.ej. profundidad de cola)"""
+        with self._lock:
+            self._medidores[nombre] = funcion
+
+    @contextmanager
+    def cronometro(self, nombre: str, **etiquetas):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(nombre, time.perf_counter() - inicio, **etiquetas)
+
+    def histograma(self, nombre: str, **etiquetas) -> Histograma:
+        return self._histogramas.get((nombre, tuple(sorted(etiquetas.items()))))
+
+    def contador(self, nombre: str, **etiquetas) -> int:
+        return self._contadores.get((nombre, tuple(sorted(etiquetas.items()))), 0)
+
+    def texto_prometheus(self) -> str:
+        """Exposicion en formato de texto de Prometheus (version 0.0.4)"""
+        lineas = []
+        with self._lock:
+            histogramas = sorted(self._histogramas.items())
+            contadores = sorted(self._contadores.items())
+            medidores = sorted(self._medidores.items())
+
+            declarados = set()
+            for (nombre, etiquetas), h in histogramas:
+                metrica = PREFIJO + nombre
+                if metrica not in declarados:
+                    lineas.append(f"# TYPE {metrica} histogram")
+                    declarados.add(metrica)
+                acumulado = 0
+                for limite, n in zip(h.limites + (float('inf'),), h.cubos):
+                    acumulado += n
+                    le = '+Inf' if limite == float('inf') else repr(limite)
+                    lineas.append(f"{metrica}_bucket{_etiquetas(etiquetas, le=le)} {acumulado}")
+                lineas.append(f"{metrica}_sum{_etiquetas(etiquetas)} {h.suma}")
+                lineas.append(f"{metrica}_count{_etiquetas(etiquetas)} {h.total}")
+
+            for (nombre, etiquetas), valor in contadores:
+                metrica = PREFIJO + nombre
+                if metrica not in declarados:
+                    lineas.append(f"# TYPE {metrica} counter")
+                    declarados.add(metrica)
+                lineas.append(f"{metrica}{_etiquetas(etiquetas)} {valor}")
+
+        for nombre, funcion in medidores:
+            try:
+                valor = funcion()
+            except Exception as e:
+                logger.debug("Medidor %s fallido: %s", nombre, e)
+                continue
+            lineas.append(f"# TYPE {PREFIJO}{nombre} gauge")
+            lineas.append(f"{PREFIJO}{nombre} {valor}")
+
+        return "\n".join(lineas) + "\n"
+
+    def resumen(self) -> str:
+        """Una linea legible: p50/p99 por histograma y contadores"""
+        partes = []
+        with self._lock:
+            for (nombre, etiquetas), h in sorted(self._histogramas.items()):
+                if not h.total:
+                    continue
+                nombre_completo = nombre + ''.join(f"[{v}]" for _, v in etiquetas)
+                partes.append(
+                    f"{nombre_completo} n={h.total} p50={_ms(h.percentil(50))} p99={_ms(h.percentil(99))}"
+                )
+            for (nombre, etiquetas), valor in sorted(self._contadores.items()):
+                nombre_completo = nombre + ''.join(f"[{v}]" for _, v in etiquetas)
+                partes.append(f"{nombre_completo}={valor}")
+        return "; ".join(partes)
+
+
+def _etiquetas(etiquetas: tuple, **extra) -> str:
+    pares = list(etiquetas) + list(extra.items())
+    if not pares:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pares) + "}"
+
+
+def _ms(segundos: float) -> str:
+    if segundos is None:
+        return "-"
+    if segundos == float('inf'):
+        return ">10s"
+    return f"{segundos * 1000:g}ms"
+
+
+# Registro compartido por todo el proceso
+METRICAS = RegistroMetricas()
+
+
+class ServidorMetricas:
+    """Servidor HTTP local con /metrics en formato Prometheus"""
+
+    def __init__(self, registro: RegistroMetricas = METRICAS, puerto: int = 9108,
+                 host: str = '127.0.0.1'):
+        registro_servido = registro
+
+        class _Manejador(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                cuerpo = registro_servido.texto_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(cuerpo)))
+                self.end_headers()
+                self.wfile.write(cuerpo)
+
+            def log_message(self, formato, *args):
+                pass
+
+        self.servidor = ThreadingHTTPServer((host, puerto), _Manejador)
+        self.servidor.daemon_threads = True
+        self._hilo = None
+
+    def iniciar(self):
+        self._hilo = threading.Thread(target=self.servidor.serve_forever, name="metricas-http", daemon=True)
+        self._hilo.start()
+        host, puerto = self.servidor.server_address[:2]
+        logger.info(f"Metricas en http://{host}:{puerto}/metrics")
+
+    def detener(self):
+        self.servidor.shutdown()
+        self.servidor.server_close()
+
+
+class VolcadoMetricas:
+    """Escribe METRICAS.resumen() en el log cada `intervalo` segundos"""
+
+    def __init__(self, registro: RegistroMetricas = METRICAS, intervalo: float = 60.0):
+        self.registro = registro
+        self.intervalo = intervalo
+        self._parar = threading.Event()
+
+    def iniciar(self):
+        threading.Thread(target=self._ejecutar, name="metricas-volcado", daemon=True).start()
+
+    def detener(self):
+        self._parar.set()
+
+    def _ejecutar(self):
+        while not self._parar.wait(self.intervalo):
+            resumen = self.registro.resumen()
+            if resumen:
+                logger.info(f"Metricas: {resumen}")
+
+
+def configurar_registro(nivel=logging.INFO, ruta: str = 'sistema_emergencias.log',
+                        formato: str = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'):
+    """
+    Logging no bloqueante: los hilos de procesamiento solo encolan el
+    registro; un hilo aparte lo formatea y lo escribe en consola y fichero.
+
+    Returns:
+        El QueueListener (detener con .stop() al salir para vaciar la cola)
+    """
+    formateador = logging.Formatter(formato)
+    manejadores = [logging.StreamHandler()]
+    if ruta:
+        manejadores.append(logging.FileHandler(ruta))
+    for manejador in manejadores:
+        manejador.setFormatter(formateador)
+
+    cola = queue.SimpleQueue()
+    escucha = logging.handlers.QueueListener(cola, *manejadores, respect_handler_level=True)
+    raiz = logging.getLogger()
+    raiz.handlers[:] = [logging.handlers.QueueHandler(cola)]
+    raiz.setLevel(nivel)
+    escucha.start()
+    return escucha
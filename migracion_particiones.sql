@@ -0,0 +1,201 @@
+-- Migracion de una base de datos existente a alertas y asignaciones
+-- particionadas por mes (ver sistema_emergencias.sql)
+--
+-- Copia las tablas completas dentro de una transaccion: durante la copia
+-- no se pueden registrar alertas. Parar los listeners antes de lanzarla:
+--     psql -d sistema_emergencias -f migracion_particiones.sql
+-- Al final ejecuta actualizar_esquema.sql (triggers, tablas y funciones
+-- posteriores, que no se recrean aqui). Despues, programar retencion.py
+-- (crea tambien los meses siguientes)
+
+BEGIN;
+
+-- Bases de datos anteriores a la coalescencia
+ALTER TABLE alertas ADD COLUMN IF NOT EXISTS fecha_ultima_actividad TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL;
+ALTER TABLE alertas ADD COLUMN IF NOT EXISTS pulsaciones INTEGER DEFAULT 1 NOT NULL;
+
+ALTER TABLE asignaciones RENAME TO asignaciones_antigua;
+ALTER TABLE alertas RENAME TO alertas_antigua;
+ALTER INDEX alertas_pkey RENAME TO alertas_antigua_pkey;
+ALTER INDEX asignaciones_pkey RENAME TO asignaciones_antigua_pkey;
+ALTER INDEX idx_asignaciones_alerta RENAME TO idx_asignaciones_alerta_antigua;
+ALTER INDEX idx_asignaciones_punto RENAME TO idx_asignaciones_punto_antigua;
+
+-- Las secuencias se conservan: los id siguen donde estaban
+CREATE TABLE alertas (
+    id INTEGER NOT NULL DEFAULT nextval('alertas_id_seq'),
+    dispositivo_id VARCHAR(50) NOT NULL,
+    tipo tipo_emergencia NOT NULL,
+    ubicacion GEOMETRY(Point, 4326) NOT NULL,
+    estado estado_alerta DEFAULT 'pendiente' NOT NULL,
+    fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    fecha_ultima_actividad TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    pulsaciones INTEGER DEFAULT 1 NOT NULL,
+    PRIMARY KEY (id, fecha_creacion),
+    CONSTRAINT chk_ubicacion CHECK (ST_SRID(ubicacion) = 4326)
+) PARTITION BY RANGE (fecha_creacion);
+
+CREATE TABLE alertas_default PARTITION OF alertas DEFAULT;
+
+CREATE TABLE asignaciones (
+    id INTEGER NOT NULL DEFAULT nextval('asignaciones_id_seq'),
+    alerta_id INTEGER NOT NULL,
+    punto_emergencia_id INTEGER NOT NULL REFERENCES puntos_emergencia(id),
+    distancia_metros NUMERIC(10,2) NOT NULL,
+    tiempo_estimado_segundos INTEGER NOT NULL,
+    fecha_asignacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    PRIMARY KEY (id, fecha_asignacion),
+    CONSTRAINT chk_distancia CHECK (distancia_metros >= 0),
+    CONSTRAINT chk_tiempo CHECK (tiempo_estimado_segundos > 0)
+) PARTITION BY RANGE (fecha_asignacion);
+
+CREATE TABLE asignaciones_default PARTITION OF asignaciones DEFAULT;
+
+CREATE OR REPLACE FUNCTION crear_particiones(p_desde DATE, p_hasta DATE)
+RETURNS INTEGER AS $$
+DECLARE
+    v_mes DATE := date_trunc('month', p_desde);
+    v_tabla TEXT;
+    v_particion TEXT;
+    v_creadas INTEGER := 0;
+BEGIN
+    WHILE v_mes <= p_hasta LOOP
+        FOREACH v_tabla IN ARRAY ARRAY['alertas', 'asignaciones'] LOOP
+            v_particion := v_tabla || '_' || to_char(v_mes, 'YYYY_MM');
+            IF to_regclass(v_particion) IS NULL THEN
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                    v_particion, v_tabla, v_mes, (v_mes + INTERVAL '1 month')::DATE
+                );
+                v_creadas := v_creadas + 1;
+            END IF;
+        END LOOP;
+        v_mes := v_mes + INTERVAL '1 month';
+    END LOOP;
+    RETURN v_creadas;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Un mes por particion desde la alerta mas antigua hasta tres meses vista
+SELECT crear_particiones(
+    LEAST(
+        COALESCE((SELECT MIN(fecha_creacion) FROM alertas_antigua)::DATE, CURRENT_DATE),
+        COALESCE((SELECT MIN(fecha_asignacion) FROM asignaciones_antigua)::DATE, CURRENT_DATE)
+    ),
+    (CURRENT_DATE + INTERVAL '3 months')::DATE
+);
+
+-- Copia con los indices aun sin crear (mas rapida)
+INSERT INTO alertas (
+    id, dispositivo_id, tipo, ubicacion, estado,
+    fecha_creacion, fecha_ultima_actividad, pulsaciones
+)
+SELECT
+    id, dispositivo_id, tipo, ubicacion, estado,
+    fecha_creacion, fecha_ultima_actividad, pulsaciones
+FROM alertas_antigua;
+
+INSERT INTO asignaciones (
+    id, alerta_id, punto_emergencia_id, distancia_metros,
+    tiempo_estimado_segundos, fecha_asignacion
+)
+SELECT
+    id, alerta_id, punto_emergencia_id, distancia_metros,
+    tiempo_estimado_segundos, fecha_asignacion
+FROM asignaciones_antigua;
+
+ALTER SEQUENCE alertas_id_seq OWNED BY alertas.id;
+ALTER SEQUENCE asignaciones_id_seq OWNED BY asignaciones.id;
+DROP TABLE asignaciones_antigua;
+DROP TABLE alertas_antigua;
+
+CREATE INDEX idx_alertas_abiertas ON alertas(estado) WHERE estado <> 'resuelta';
+CREATE INDEX idx_alertas_abiertas_ubicacion ON alertas USING GIST(ubicacion) WHERE estado <> 'resuelta';
+CREATE INDEX idx_asignaciones_alerta ON asignaciones(alerta_id);
+CREATE INDEX idx_asignaciones_punto ON asignaciones(punto_emergencia_id);
+
+-- Triggers: mismas definiciones que en sistema_emergencias.sql
+CREATE OR REPLACE FUNCTION ocupar_recurso()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE puntos_emergencia
+    SET capacidad_actual = capacidad_actual + 1,
+        disponible = (capacidad_actual + 1 < capacidad_maxima)
+    WHERE id = NEW.punto_emergencia_id;
+
+    UPDATE alertas
+    SET estado = 'asignada'
+    WHERE id = NEW.alerta_id;
+
+    -- En lugar de la clave ajena (ver asignaciones)
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'La alerta % no existe', NEW.alerta_id
+            USING ERRCODE = 'foreign_key_violation';
+    END IF;
+
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_ocupar_recurso
+    AFTER INSERT ON asignaciones
+    FOR EACH ROW EXECUTE FUNCTION ocupar_recurso();
+
+CREATE OR REPLACE FUNCTION liberar_recurso()
+RETURNS TRIGGER AS $$
+DECLARE
+    r RECORD;
+BEGIN
+    FOR r IN
+        UPDATE puntos_emergencia pe
+        SET capacidad_actual = GREATEST(capacidad_actual - 1, 0),
+            disponible = (GREATEST(capacidad_actual - 1, 0) < capacidad_maxima)
+        WHERE pe.id IN (
+            -- La asignacion es posterior a la alerta: solo sus particiones
+            SELECT punto_emergencia_id
+            FROM asignaciones
+            WHERE alerta_id = NEW.id AND fecha_asignacion >= NEW.fecha_creacion
+        )
+        RETURNING pe.id, pe.tipo, ST_X(pe.ubicacion) AS lon, ST_Y(pe.ubicacion) AS lat,
+                  pe.capacidad_maxima - pe.capacidad_actual AS libres
+    LOOP
+        PERFORM pg_notify('recursos_liberados', json_build_object(
+            'id', r.id,
+            'tipo', r.tipo,
+            'lon', r.lon,
+            'lat', r.lat,
+            'libres', r.libres
+        )::text);
+    END LOOP;
+
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_liberar_recurso
+    AFTER UPDATE OF estado ON alertas
+    FOR EACH ROW
+    WHEN (NEW.estado = 'resuelta' AND OLD.estado <> 'resuelta')
+    EXECUTE FUNCTION liberar_recurso();
+
+CREATE OR REPLACE FUNCTION borrar_asignaciones()
+RETURNS TRIGGER AS $$
+BEGIN
+    DELETE FROM asignaciones
+    WHERE alerta_id = OLD.id AND fecha_asignacion >= OLD.fecha_creacion;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_borrar_asignaciones
+    AFTER DELETE ON alertas
+    FOR EACH ROW EXECUTE FUNCTION borrar_asignaciones();
+
+COMMIT;
+
+ANALYZE alertas;
+ANALYZE asignaciones;
+
+-- Notificaciones, mapa de calor, telemetria, ruta rapida... (idempotente)
+\ir actualizar_esquema.sql
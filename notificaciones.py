@@ -0,0 +1,109 @@
+"""
+Escucha de notificaciones de PostgreSQL (LISTEN/NOTIFY)
+"""
+
+import json
+import logging
+import select
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+logger = logging.getLogger(__name__)
+
+LATIDO = 'latido'
+
+
+class EscuchaNotificaciones:
+    """
+    Hilo con una conexion dedicada que escucha uno o varios canales.
+
+    Cada cierto tiempo se envia a si mismo un latido por el primer canal:
+    si el latido no vuelve, la escucha se considera retrasada y quien la use
+    debe dejar de fiarse de la informacion recibida.
+    """
+
+    def __init__(self, parametros_conexion: dict, canales: list, al_notificar,
+                 al_conectar=None, intervalo_latido: float = 5.0):
+        self.parametros_conexion = parametros_conexion
+        self.canales = canales
+        self.al_notificar = al_notificar
+        self.al_conectar = al_conectar
+        self.intervalo_latido = intervalo_latido
+
+        self.conectada = False
+        self.ultimo_latido = 0.0
+
+        self._parar = threading.Event()
+        self._hilo = None
+
+    def iniciar(self):
+        self._hilo = threading.Thread(target=self._ejecutar, name="escucha-bd", daemon=True)
+        self._hilo.start()
+
+    def detener(self, timeout: float = 5.0):
+        self._parar.set()
+        if self._hilo:
+            self._hilo.join(timeout)
+
+    def al_dia(self, max_retraso: float = None) -> bool:
+        """True si la escucha esta conectada y el ultimo latido es reciente"""
+        if max_retraso is None:
+            max_retraso = 3 * self.intervalo_latido
+        return self.conectada and time.monotonic() - self.ultimo_latido < max_retraso
+
+    def _ejecutar(self):
+        espera = 1.0
+        while not self._parar.is_set():
+            try:
+                self._escuchar()
+                espera = 1.0
+            except Exception as e:
+                logger.warning(f"Escucha de BD interrumpida: {e}")
+            finally:
+                self.conectada = False
+
+            if self._parar.wait(espera):
+                break
+            espera = min(espera * 2, 30.0)
+
+    def _escuchar(self):
+        conn = psycopg2.connect(**self.parametros_conexion)
+        try:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cursor = conn.cursor()
+
+            for canal in self.canales:
+                cursor.execute(f"LISTEN {canal}")
+
+            # Recargar el estado despues del LISTEN para no perder cambios
+            if self.al_conectar:
+                self.al_conectar(conn)
+
+            self.conectada = True
+            self.ultimo_latido = time.monotonic()
+            logger.info(f"Escuchando canales de BD: {', '.join(self.canales)}")
+
+            proximo_latido = time.monotonic()
+            while not self._parar.is_set():
+                if time.monotonic() >= proximo_latido:
+                    cursor.execute("SELECT pg_notify(%s, %s)", (self.canales[0], LATIDO))
+                    proximo_latido = time.monotonic() + self.intervalo_latido
+
+                if select.select([conn], [], [], 1.0) == ([], [], []):
+                    continue
+
+                conn.poll()
+                while conn.notifies:
+                    notificacion = conn.notifies.pop(0)
+                    if notificacion.payload == LATIDO:
+                        self.ultimo_latido = time.monotonic()
+                        continue
+                    try:
+                        self.al_notificar(notificacion.channel, json.loads(notificacion.payload))
+                    except Exception as e:
+                        logger.error(f"Error procesando notificacion: {e}")
+        finally:
+            conn.close()
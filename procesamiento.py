@@ -0,0 +1,503 @@
+"""
+Cola de alertas y pool de trabajadores
+Desacopla el callback MQTT del procesamiento en BD. Con carriles de
+prioridad (ColaPrioridades) las alertas criticas no esperan detras de
+reintentos y latidos encolados
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from decoder import FLAG_LATIDO, FLAG_REINTENTO
+from metricas import METRICAS
+
+logger = logging.getLogger(__name__)
+
+# Politicas de contrapresion cuando la cola esta llena
+BLOQUEAR = 'bloquear'
+DESCARTAR_ANTIGUO = 'descartar_antiguo'
+DISCO = 'disco'
+
+POLITICAS = (BLOQUEAR, DESCARTAR_ANTIGUO, DISCO)
+
+# Carriles de prioridad, del mas urgente al menos
+CRITICA = 'critica'
+NORMAL = 'normal'
+BAJA = 'baja'
+CARRILES = (CRITICA, NORMAL, BAJA)
+
+# Reparto entre carriles: siempre el mas urgente con alertas, o turnos
+# ponderados por 'peso' (los carriles bajos nunca se quedan sin servicio)
+ESTRICTO = 'estricto'
+PONDERADO = 'ponderado'
+
+CARRIL_POR_TIPO = {
+    'medica': CRITICA,
+    'rescate': CRITICA,
+    'bomberos': CRITICA,
+    'policial': NORMAL
+}
+
+# Toda alerta real bloquea al llenarse su carril: descartarla seria perderla.
+# Solo el carril bajo (latidos y payloads invalidos) descarta los mas
+# antiguos. El normal tiene mas capacidad para que un pico de alertas no
+# criticas tarde en bloquear el hilo MQTT (y con el a las criticas)
+CARRILES_DEFECTO = {
+    CRITICA: {'capacidad': 1000, 'politica': BLOQUEAR, 'peso': 8, 'slo_ms': 250},
+    NORMAL: {'capacidad': 5000, 'politica': BLOQUEAR, 'peso': 3, 'slo_ms': 2000},
+    BAJA: {'capacidad': 5000, 'politica': DESCARTAR_ANTIGUO, 'peso': 1, 'slo_ms': 30000}
+}
+
+
+def clasificar(cabecera: tuple, carril_por_tipo: dict = CARRIL_POR_TIPO) -> str:
+    """
+    Carril de un uplink a partir de PayloadDecoder.cabecera: solo los
+    latidos y los payloads invalidos van al carril bajo. Un reintento baja
+    de critico a normal, nunca al bajo: si la alerta original se perdio,
+    el reintento es la alerta
+    """
+    if cabecera is None:
+        return BAJA
+    tipo, flags = cabecera
+    if flags & FLAG_LATIDO:
+        return BAJA
+    carril = carril_por_tipo.get(tipo, NORMAL)
+    if flags & FLAG_REINTENTO and carril == CRITICA:
+        return NORMAL
+    return carril
+
+
+class ColaAlertas:
+    """Cola acotada entre el hilo MQTT y los trabajadores"""
+
+    def __init__(self, capacidad: int = 1000, politica: str = BLOQUEAR,
+                 ruta_desborde: str = 'cola_desborde.jsonl'):
+        if politica not in POLITICAS:
+            raise ValueError(f"Politica de cola desconocida: {politica}")
+
+        self.capacidad = capacidad
+        self.politica = politica
+        self.ruta_desborde = ruta_desborde
+
+        self._cola = deque()
+        self._cond = threading.Condition()
+        self._cerrada = False
+
+        # Desborde a disco: fichero FIFO con offset de lectura, guardado en
+        # <ruta>.offset para no repetir al reiniciar las ya leidas
+        self._ruta_offset = ruta_desborde + '.offset'
+        self._desborde_pendientes = 0
+        self._desborde_offset = 0
+        if politica == DISCO and os.path.exists(ruta_desborde):
+            # Alertas desbordadas en una ejecucion anterior y aun no leidas
+            self._desborde_offset = self._cargar_offset()
+            with open(ruta_desborde, 'r', encoding='utf-8') as f:
+                f.seek(self._desborde_offset)
+                self._desborde_pendientes = sum(1 for _ in f)
+            logger.info(f"Recuperadas {self._desborde_pendientes} alertas de {ruta_desborde}")
+
+        # Metricas
+        self.encoladas = 0
+        self.descartadas = 0
+        self.desbordadas = 0
+        self.procesadas = 0
+        self.profundidad_maxima = 0
+
+    def poner(self, elemento: dict) -> bool:
+        """
+        Encola un elemento aplicando la politica de contrapresion
+
+        Returns:
+            True si el elemento se acepto (en memoria o en disco)
+        """
+        with self._cond:
+            if self._cerrada:
+                return False
+
+            if self.politica == DISCO and self._desborde_pendientes:
+                # Mantener el orden FIFO mientras haya elementos en disco
+                self._desbordar(elemento)
+            elif len(self._cola) >= self.capacidad:
+                if self.politica == BLOQUEAR:
+                    while len(self._cola) >= self.capacidad and not self._cerrada:
+                        self._cond.wait()
+                    if self._cerrada:
+                        return False
+                    self._cola.append(elemento)
+                elif self.politica == DESCARTAR_ANTIGUO:
+                    descartado = self._cola.popleft()
+                    self.descartadas += 1
+                    logger.warning(f"Cola llena, descartada alerta de {descartado.get('dispositivo_id')}")
+                    self._cola.append(elemento)
+                else:
+                    self._desbordar(elemento)
+            else:
+                self._cola.append(elemento)
+
+            self.encoladas += 1
+            self.profundidad_maxima = max(self.profundidad_maxima, self._profundidad())
+            self._cond.notify_all()
+            return True
+
+    def obtener(self, timeout: float = None) -> dict:
+        """Extrae el siguiente elemento, o None si vence el timeout o se cierra"""
+        with self._cond:
+            limite = None if timeout is None else time.monotonic() + timeout
+
+            while not self._cola and not self._desborde_pendientes:
+                if self._cerrada:
+                    return None
+                restante = None if limite is None else limite - time.monotonic()
+                if restante is not None and restante <= 0:
+                    return None
+                self._cond.wait(restante)
+
+            if self._cola:
+                elemento = self._cola.popleft()
+            else:
+                elemento = self._leer_desborde()
+
+            self._cond.notify_all()
+            return elemento
+
+    def marcar_procesada(self):
+        with self._cond:
+            self.procesadas += 1
+
+    def cerrar(self):
+        """Despierta a productores y consumidores bloqueados"""
+        with self._cond:
+            self._cerrada = True
+            self._cond.notify_all()
+
+    def _profundidad(self) -> int:
+        return len(self._cola) + self._desborde_pendientes
+
+    def _desbordar(self, elemento: dict):
+        with open(self.ruta_desborde, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(elemento) + '\n')
+        self._desborde_pendientes += 1
+        self.desbordadas += 1
+
+    def _leer_desborde(self) -> dict:
+        with open(self.ruta_desborde, 'r', encoding='utf-8') as f:
+            f.seek(self._desborde_offset)
+            linea = f.readline()
+            self._desborde_offset = f.tell()
+
+        self._desborde_pendientes -= 1
+        if not self._desborde_pendientes:
+            # Fichero consumido por completo: empezar de cero
+            os.remove(self.ruta_desborde)
+            if os.path.exists(self._ruta_offset):
+                os.remove(self._ruta_offset)
+            self._desborde_offset = 0
+        else:
+            self._guardar_offset()
+
+        return json.loads(linea)
+
+    def _cargar_offset(self) -> int:
+        try:
+            with open(self._ruta_offset, 'r', encoding='utf-8') as f:
+                offset = int(f.read())
+        except (OSError, ValueError):
+            return 0
+        # Un offset de otro fichero (mas largo que este) no vale
+        return offset if offset <= os.path.getsize(self.ruta_desborde) else 0
+
+    def _guardar_offset(self):
+        """Escritura atomica: un corte a medias deja el offset anterior"""
+        temporal = self._ruta_offset + '.tmp'
+        with open(temporal, 'w', encoding='utf-8') as f:
+            f.write(str(self._desborde_offset))
+        os.replace(temporal, self._ruta_offset)
+
+    def metricas(self) -> dict:
+        with self._cond:
+            return {
+                'profundidad': self._profundidad(),
+                'profundidad_memoria': len(self._cola),
+                'profundidad_disco': self._desborde_pendientes,
+                'profundidad_maxima': self.profundidad_maxima,
+                'capacidad': self.capacidad,
+                'encoladas': self.encoladas,
+                'procesadas': self.procesadas,
+                'descartadas': self.descartadas,
+                'desbordadas': self.desbordadas
+            }
+
+
+def observar_extremo(cola, elemento: dict, segundos: float):
+    """Latencia desde la recepcion, por carril y contra su SLO si lo tiene"""
+    METRICAS.observar('extremo_segundos', segundos)
+    carril = elemento.get('carril')
+    if carril is not None:
+        METRICAS.observar('carril_extremo_segundos', segundos, carril=carril)
+        if segundos > cola.slo_segundos(carril):
+            METRICAS.incrementar('carril_slo_incumplido_total', carril=carril)
+
+
+class ColaPrioridades:
+    """
+    Cola acotada con un carril por prioridad y la misma interfaz que
+    ColaAlertas. Cada carril tiene su capacidad y politica (bloquear o
+    descartar_antiguo) y un SLO de latencia extremo a extremo que vigila
+    PoolTrabajadores. Los elementos llevan el carril en 'carril'.
+    """
+
+    def __init__(self, carriles: dict = None, despacho: str = ESTRICTO):
+        if despacho not in (ESTRICTO, PONDERADO):
+            raise ValueError(f"Despacho de carriles desconocido: {despacho}")
+        carriles = carriles or CARRILES_DEFECTO
+        for nombre, carril in carriles.items():
+            if nombre not in CARRILES:
+                raise ValueError(f"Carril desconocido: {nombre}")
+            if carril.get('politica', BLOQUEAR) not in (BLOQUEAR, DESCARTAR_ANTIGUO):
+                raise ValueError(f"Politica de carril no admitida: {carril['politica']}")
+
+        # Del mas urgente al menos
+        self.carriles = [c for c in CARRILES if c in carriles]
+        self.despacho = despacho
+        self.capacidad = {c: carriles[c].get('capacidad', 1000) for c in self.carriles}
+        self.politica = {c: carriles[c].get('politica', BLOQUEAR) for c in self.carriles}
+        self.peso = {c: carriles[c].get('peso', 1) for c in self.carriles}
+        self.slo = {c: carriles[c].get('slo_ms', 1000) / 1000.0 for c in self.carriles}
+
+        for carril in (CRITICA, NORMAL):
+            if self.politica.get(carril) == DESCARTAR_ANTIGUO:
+                logger.warning(f"El carril {carril} descarta alertas reales al llenarse")
+
+        self._colas = {c: deque() for c in self.carriles}
+        self._credito = dict.fromkeys(self.carriles, 0)
+        self._cond = threading.Condition()
+        self._cerrada = False
+
+        # Metricas
+        self.encoladas = dict.fromkeys(self.carriles, 0)
+        self.descartadas = dict.fromkeys(self.carriles, 0)
+        self.procesadas = 0
+        self.profundidad_maxima = 0
+
+    def poner(self, elemento: dict) -> bool:
+        """
+        Encola en el carril del elemento. Sin carril va al menos urgente; si
+        su carril no esta configurado, al siguiente mas urgente que lo este
+        (o al inmediato inferior si no hay ninguno)
+        """
+        carril = elemento.get('carril')
+        if carril not in self._colas:
+            carril = elemento['carril'] = self._carril_configurado(carril)
+        cola = self._colas[carril]
+
+        with self._cond:
+            if self._cerrada:
+                return False
+
+            if len(cola) >= self.capacidad[carril]:
+                if self.politica[carril] == BLOQUEAR:
+                    while len(cola) >= self.capacidad[carril] and not self._cerrada:
+                        self._cond.wait()
+                    if self._cerrada:
+                        return False
+                else:
+                    descartado = cola.popleft()
+                    self.descartadas[carril] += 1
+                    METRICAS.incrementar('carril_descartadas_total', carril=carril)
+                    logger.debug("Carril %s lleno, descartada alerta de %s", carril, descartado.get('dispositivo_id'))
+
+            cola.append(elemento)
+            self.encoladas[carril] += 1
+            self.profundidad_maxima = max(self.profundidad_maxima, self._profundidad())
+            self._cond.notify_all()
+            return True
+
+    def obtener(self, timeout: float = None) -> dict:
+        """Extrae el siguiente elemento segun el despacho, o None si vence el timeout o se cierra"""
+        with self._cond:
+            limite = None if timeout is None else time.monotonic() + timeout
+
+            while not self._profundidad():
+                if self._cerrada:
+                    return None
+                restante = None if limite is None else limite - time.monotonic()
+                if restante is not None and restante <= 0:
+                    return None
+                self._cond.wait(restante)
+
+            elemento = self._colas[self._elegir()].popleft()
+            self._cond.notify_all()
+            return elemento
+
+    def _carril_configurado(self, carril: str) -> str:
+        if carril not in CARRILES:
+            return self.carriles[-1]
+        indice = CARRILES.index(carril)
+        superiores = [c for c in self.carriles if CARRILES.index(c) < indice]
+        if superiores:
+            return superiores[-1]
+        return self.carriles[0]
+
+    def _elegir(self) -> str:
+        activos = [c for c in self.carriles if self._colas[c]]
+        if self.despacho == ESTRICTO or len(activos) == 1:
+            return activos[0]
+
+        # Turnos ponderados suaves (como nginx): reparto proporcional al
+        # peso sin rafagas de un mismo carril
+        total = 0
+        for carril in activos:
+            self._credito[carril] += self.peso[carril]
+            total += self.peso[carril]
+        elegido = max(activos, key=lambda c: self._credito[c])
+        self._credito[elegido] -= total
+        return elegido
+
+    def slo_segundos(self, carril: str) -> float:
+        return self.slo.get(carril, float('inf'))
+
+    def marcar_procesada(self):
+        with self._cond:
+            self.procesadas += 1
+
+    def cerrar(self):
+        """Despierta a productores y consumidores bloqueados"""
+        with self._cond:
+            self._cerrada = True
+            self._cond.notify_all()
+
+    def _profundidad(self) -> int:
+        return sum(len(cola) for cola in self._colas.values())
+
+    def metricas(self) -> dict:
+        with self._cond:
+            return {
+                'profundidad': self._profundidad(),
+                'profundidad_memoria': self._profundidad(),
+                'profundidad_disco': 0,
+                'profundidad_maxima': self.profundidad_maxima,
+                'capacidad': sum(self.capacidad.values()),
+                'encoladas': sum(self.encoladas.values()),
+                'procesadas': self.procesadas,
+                'descartadas': sum(self.descartadas.values()),
+                'desbordadas': 0,
+                'carriles': {
+                    carril: {
+                        'profundidad': len(self._colas[carril]),
+                        'encoladas': self.encoladas[carril],
+                        'descartadas': self.descartadas[carril]
+                    }
+                    for carril in self.carriles
+                }
+            }
+
+
+class PoolTrabajadores:
+    """
+    Hilos que consumen la cola y procesan alertas.
+    Cada trabajador crea su propio sistema (y su propia conexion a BD),
+    salvo que se pase un sistema compartido con pool de conexiones.
+    Cada resultado se entrega a procesar_resultado(resultado, uplink_id).
+    """
+
+    def __init__(self, cola: ColaAlertas, crear_sistema, procesar_resultado,
+                 num_trabajadores: int = 4, intervalo_metricas: float = 60.0,
+                 sistema_compartido=None):
+        self.cola = cola
+        self.crear_sistema = crear_sistema
+        self.sistema_compartido = sistema_compartido
+        self.procesar_resultado = procesar_resultado
+        self.num_trabajadores = num_trabajadores
+        self.intervalo_metricas = intervalo_metricas
+
+        self._hilos = []
+        self._parar = threading.Event()
+
+    def iniciar(self):
+        for i in range(self.num_trabajadores):
+            hilo = threading.Thread(
+                target=self._trabajar,
+                name=f"trabajador-{i}",
+                daemon=True
+            )
+            hilo.start()
+            self._hilos.append(hilo)
+
+        if self.intervalo_metricas:
+            hilo = threading.Thread(target=self._informar, name="metricas-cola", daemon=True)
+            hilo.start()
+
+        logger.info(f"Pool iniciado con {self.num_trabajadores} trabajadores")
+
+    def detener(self, timeout: float = 10.0):
+        """Deja de aceptar alertas y espera a que se vacie la cola"""
+        self._parar.set()
+        self.cola.cerrar()
+        for hilo in self._hilos:
+            hilo.join(timeout)
+        self._hilos = []
+
+    def _trabajar(self):
+        if self.sistema_compartido is not None:
+            sistema = self.sistema_compartido
+        else:
+            sistema = self.crear_sistema()
+            espera = 1.0
+            while not sistema.conectar_bd():
+                if self._parar.wait(espera):
+                    return
+                espera = min(espera * 2, 30.0)
+
+        try:
+            while True:
+                elemento = self.cola.obtener(timeout=1.0)
+                if elemento is None:
+                    if self._parar.is_set():
+                        break
+                    continue
+
+                recibido = elemento.get('recibido')
+                if recibido is not None:
+                    METRICAS.observar('etapa_segundos', time.time() - recibido, etapa='cola')
+
+                try:
+                    resultado = sistema.procesar_alerta(
+                        elemento['dispositivo_id'],
+                        elemento['payload'],
+                        elemento.get('uplink_id')
+                    )
+                    if recibido is not None:
+                        observar_extremo(self.cola, elemento, time.time() - recibido)
+                    self.procesar_resultado(resultado, elemento.get('uplink_id'))
+                except Exception as e:
+                    logger.error(f"Error procesando alerta: {e}")
+                finally:
+                    self.cola.marcar_procesada()
+        finally:
+            if sistema is not self.sistema_compartido:
+                sistema.desconectar_bd()
+
+    def _informar(self):
+        while not self._parar.wait(self.intervalo_metricas):
+            m = self.cola.metricas()
+            logger.info(
+                f"Cola: profundidad={m['profundidad']} (max {m['profundidad_maxima']}), "
+                f"procesadas={m['procesadas']}, descartadas={m['descartadas']}, "
+                f"desbordadas={m['desbordadas']}"
+            )
+            for carril, c in m.get('carriles', {}).items():
+                histograma = METRICAS.histograma('carril_extremo_segundos', carril=carril)
+                p99 = histograma.percentil(99) if histograma is not None else None
+                slo = self.cola.slo_segundos(carril)
+                incumplidas = METRICAS.contador('carril_slo_incumplido_total', carril=carril)
+                nivel = logging.WARNING if p99 is not None and p99 > slo else logging.INFO
+                logger.log(
+                    nivel,
+                    f"Carril {carril}: profundidad={c['profundidad']}, descartadas={c['descartadas']}, "
+                    f"p99={'-' if p99 is None else f'{p99 * 1000:g}ms'} (SLO {slo * 1000:g}ms, "
+                    f"{incumplidas} fuera de SLO)"
+                )
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Prueba de estres de asignacion concurrente
+
+Lanza N trabajadores en paralelo, cada uno con su propia conexion, que
+procesan tantas alertas de un mismo tipo como plazas libres quedan.
+Comprueba que ningun recurso supera su capacidad y que ninguna alerta se
+queda sin recurso mientras habia plazas. Al terminar resuelve y borra las
+alertas de prueba, dejando la base de datos como estaba.
+
+Uso: python prueba_concurrencia.py [trabajadores] [tipo]
+"""
+
+import sys
+import os
+import threading
+import time
+
+if sys.platform == 'win32':
+    os.environ['PGCLIENTENCODING'] = 'UTF8'
+    os.environ['PYTHONIOENCODING'] = 'utf-8'
+
+from integracion import SistemaEmergencias
+from prueba_sistema import crear_payload
+from config import DB_CONFIG
+
+CODIGOS_TIPO = {'medica': 1, 'policial': 2, 'bomberos': 3, 'rescate': 4}
+PREFIJO_DISPOSITIVO = 'prueba-concurrencia'
+
+# Todas las alertas caen en el mismo punto para competir por el mismo recurso
+LATITUD = 40.3645
+LONGITUD = -6.2900
+
+
+def plazas_libres(sistema, tipo):
+    sistema.cursor.execute("""
+        SELECT COALESCE(SUM(capacidad_maxima - capacidad_actual), 0) AS libres
+        FROM puntos_emergencia
+        WHERE tipo = %s
+    """, (tipo,))
+    return sistema.cursor.fetchone()['libres']
+
+
+def sobreasignaciones(sistema, tipo):
+    """Recursos con mas asignaciones activas que capacidad maxima"""
+    sistema.cursor.execute("""
+        SELECT pe.codigo, pe.capacidad_maxima, COUNT(a.id) AS activas
+        FROM puntos_emergencia pe
+        JOIN asignaciones asg ON asg.punto_emergencia_id = pe.id
+        JOIN alertas a ON a.id = asg.alerta_id AND a.estado != 'resuelta'
+        WHERE pe.tipo = %s
+        GROUP BY pe.id
+        HAVING COUNT(a.id) > pe.capacidad_maxima
+    """, (tipo,))
+    return sistema.cursor.fetchall()
+
+
+def limpiar(sistema, alertas):
+    for alerta_id in alertas:
+        sistema.resolver_alerta(alerta_id)
+    sistema.cursor.execute(
+        "DELETE FROM alertas WHERE dispositivo_id LIKE %s",
+        (PREFIJO_DISPOSITIVO + '%',)
+    )
+    sistema.conn.commit()
+
+
+def ejecutar_ronda(concurrente, trabajadores, tipo):
+    config = dict(
+        DB_CONFIG,
+        asignacion_concurrente=concurrente,
+        ruta_rapida=False,
+        cache_recursos=False,
+        pool_max=0
+    )
+
+    control = SistemaEmergencias(config)
+    if not control.conectar_bd():
+        print("ERROR: No se pudo conectar a la base de datos")
+        sys.exit(1)
+
+    libres = plazas_libres(control, tipo)
+    payload = crear_payload(CODIGOS_TIPO[tipo], LATITUD, LONGITUD)
+
+    resultados = []
+    lock = threading.Lock()
+    barrera = threading.Barrier(trabajadores)
+
+    def trabajar(indice):
+        sistema = SistemaEmergencias(config)
+        sistema.conectar_bd()
+        barrera.wait()
+        for n in range(indice, libres, trabajadores):
+            resultado = sistema.procesar_alerta(f"{PREFIJO_DISPOSITIVO}-{n}", payload)
+            with lock:
+                resultados.append(resultado)
+        sistema.desconectar_bd()
+
+    inicio = time.perf_counter()
+    hilos = [threading.Thread(target=trabajar, args=(i,)) for i in range(trabajadores)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    duracion = time.perf_counter() - inicio
+
+    asignadas = sum(1 for r in resultados if r['exito'])
+    sin_recurso = sum(1 for r in resultados if r.get('error') == 'Sin recursos disponibles')
+    excedidos = sobreasignaciones(control, tipo)
+
+    print(f"\nMODO: {'bloqueo de fila' if concurrente else 'sin bloqueo'}")
+    print("-"*60)
+    print(f"  Plazas libres iniciales: {libres}")
+    print(f"  Alertas enviadas: {len(resultados)} ({trabajadores} trabajadores)")
+    print(f"  Asignadas: {asignadas}")
+    print(f"  Sin recurso: {sin_recurso}")
+    print(f"  Recursos sobreasignados: {len(excedidos)}")
+    print(f"  Duracion: {duracion:.2f} s")
+
+    limpiar(control, [r['alerta_id'] for r in resultados if r.get('alerta_id')])
+    control.desconectar_bd()
+
+    return asignadas == libres and not excedidos
+
+
+def main():
+    trabajadores = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    tipo = sys.argv[2] if len(sys.argv) > 2 else 'rescate'
+
+    print("\n" + "="*60)
+    print("PRUEBA DE ASIGNACION CONCURRENTE")
+    print("="*60)
+
+    ejecutar_ronda(False, trabajadores, tipo)
+    correcto = ejecutar_ronda(True, trabajadores, tipo)
+
+    print("\n" + "="*60)
+    if correcto:
+        print("CON BLOQUEO: todas las plazas asignadas, sin sobreasignacion")
+    else:
+        print("CON BLOQUEO: LA PRUEBA FALLO")
+    print("="*60)
+
+    sys.exit(0 if correcto else 1)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n\nInterrumpido")
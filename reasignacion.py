@@ -0,0 +1,262 @@
+"""
+Motor de reasignacion de alertas pendientes
+
+Una alerta que no encuentra recurso queda 'pendiente'. El motor la atiende
+en cuanto se libera un recurso de su tipo, sin consultar la BD
+periodicamente:
+
+    - alertas_pendientes: SistemaEmergencias (con 'reasignacion' en
+      db_config) y la funcion registrar_y_asignar avisan de cada alerta que
+      se queda sin recurso.
+    - recursos_liberados: el trigger liberar_recurso avisa de cada plaza
+      que libera resolver_alerta.
+
+Las pendientes se guardan por tipo, de la mas antigua a la mas reciente;
+la plaza liberada es para la mas antigua de su tipo (entre las que llevan
+esperando casi lo mismo, la mas cercana). Un tipo que se quedo sin
+recurso no se vuelve a intentar con cada alerta pendiente nueva, solo
+cuando se libera una plaza suya. Al conectar (y al reconectar) se
+recargan de la BD las alertas pendientes, por si se perdio algun aviso.
+
+Solo con almacen PostGIS. Basta un motor: con varios, el bloqueo de la
+alerta (FOR UPDATE SKIP LOCKED) evita asignarla dos veces.
+
+Uso: python reasignacion.py
+"""
+
+import heapq
+import logging
+import signal
+import sys
+import threading
+import time
+
+from cache_recursos import distancia_haversine
+from integracion import ALERTA_BLOQUEADA, SistemaEmergencias
+from metricas import METRICAS
+from notificaciones import EscuchaNotificaciones
+
+logger = logging.getLogger(__name__)
+
+CANAL_LIBERADOS = 'recursos_liberados'
+CANAL_PENDIENTES = 'alertas_pendientes'
+
+CONSULTA_PENDIENTES = """
+    SELECT
+        id,
+        tipo,
+        ST_X(ubicacion) AS lon,
+        ST_Y(ubicacion) AS lat,
+        EXTRACT(EPOCH FROM fecha_creacion::TIMESTAMPTZ) AS fecha
+    FROM alertas
+    WHERE estado = 'pendiente'
+"""
+
+
+class ColaPendientes:
+    """
+    Alertas sin recurso por tipo, en un monticulo por antiguedad.
+    Las que se quitan se descartan al llegar a la cabeza.
+    """
+
+    def __init__(self, ventana_segundos: float = 30.0):
+        self.ventana_segundos = ventana_segundos
+        self._colas = {}
+        self._alertas = {}
+
+    def __len__(self):
+        return len(self._alertas)
+
+    def poner(self, alerta: dict):
+        """alerta: id, tipo, lat, lon y fecha (epoch de creacion)"""
+        if alerta['id'] in self._alertas:
+            return
+        self._alertas[alerta['id']] = alerta
+        heapq.heappush(self._colas.setdefault(alerta['tipo'], []), (alerta['fecha'], alerta['id']))
+
+    def quitar(self, alerta_id: int):
+        self._alertas.pop(alerta_id, None)
+
+    def tipos(self) -> list:
+        return [tipo for tipo in self._colas if self._limpiar(tipo)]
+
+    def elegir(self, tipo: str, latitud: float = None, longitud: float = None,
+               excluir: set = None) -> dict:
+        """
+        La alerta pendiente mas antigua del tipo o, entre las creadas hasta
+        `ventana_segundos` despues de ella, la mas cercana al punto dado.
+        Las de `excluir` siguen en la cola pero no se eligen.
+        """
+        if not self._limpiar(tipo):
+            return None
+
+        cola = self._colas[tipo]
+        if excluir:
+            candidatas = sorted(
+                (fecha, i) for fecha, i in cola if i in self._alertas and i not in excluir
+            )
+            if not candidatas:
+                return None
+        else:
+            candidatas = cola
+        primera = self._alertas[candidatas[0][1]]
+        if latitud is None or self.ventana_segundos <= 0:
+            return primera
+
+        limite = primera['fecha'] + self.ventana_segundos
+        return min(
+            (
+                self._alertas[i] for fecha, i in candidatas
+                if fecha <= limite and i in self._alertas and not (excluir and i in excluir)
+            ),
+            key=lambda a: (distancia_haversine(latitud, longitud, a['lat'], a['lon']), a['fecha'])
+        )
+
+    def _limpiar(self, tipo: str) -> bool:
+        cola = self._colas.get(tipo)
+        while cola and cola[0][1] not in self._alertas:
+            heapq.heappop(cola)
+        return bool(cola)
+
+
+class Reasignador:
+    """
+    Hilo de escucha (EscuchaNotificaciones) que asigna las alertas
+    pendientes con SistemaEmergencias.reasignar_alerta. Usa una conexion
+    para escuchar y otra para asignar.
+    """
+
+    def __init__(self, db_config: dict, ventana_segundos: float = 30.0):
+        # Sin cache ni coalescencia: solo se asigna. Sin asignacion_concurrente,
+        # cuyos reintentos harian rollback y soltarian el bloqueo de la alerta
+        # (con otro proceso ocupando el recurso, chk_capacidad lo impide)
+        self.sistema = SistemaEmergencias(dict(
+            db_config,
+            almacen='postgis',
+            pool_max=0,
+            cache_recursos=False,
+            coalescencia=False,
+            asignacion_concurrente=False
+        ))
+        self.cola = ColaPendientes(ventana_segundos)
+        self.escucha = None
+        # Tipos cuyo ultimo intento acabo sin recurso, hasta que se libere uno
+        self._agotados = set()
+
+        # Metricas
+        self.reasignadas = 0
+
+    def iniciar(self) -> bool:
+        if not self.sistema.conectar_bd():
+            return False
+
+        self.escucha = EscuchaNotificaciones(
+            self.sistema._parametros_conexion(),
+            [CANAL_LIBERADOS, CANAL_PENDIENTES],
+            al_notificar=self._al_notificar,
+            al_conectar=self._cargar
+        )
+        METRICAS.medidor('alertas_pendientes', lambda: len(self.cola))
+        self.escucha.iniciar()
+        return True
+
+    def detener(self):
+        if self.escucha is not None:
+            self.escucha.detener()
+            self.escucha = None
+        self.sistema.desconectar_bd()
+
+    def _cargar(self, conn):
+        """Recarga las pendientes tras el LISTEN y reparte lo que ya este libre"""
+        with conn.cursor() as cursor:
+            cursor.execute(CONSULTA_PENDIENTES)
+            columnas = [c.name for c in cursor.description]
+            filas = [dict(zip(columnas, fila)) for fila in cursor.fetchall()]
+
+        self.cola = ColaPendientes(self.cola.ventana_segundos)
+        self._agotados = set()
+        for fila in filas:
+            fila['fecha'] = float(fila['fecha'])
+            self.cola.poner(fila)
+        logger.info(f"Motor de reasignacion: {len(filas)} alertas pendientes")
+
+        for tipo in self.cola.tipos():
+            self._despachar(tipo)
+
+    def _al_notificar(self, canal: str, datos: dict):
+        if canal == CANAL_PENDIENTES:
+            self.cola.poner(datos)
+            # Por si la plaza se libero antes de que llegara el aviso; si el
+            # tipo sigue agotado esperara al siguiente recursos_liberados
+            if datos['tipo'] not in self._agotados:
+                self._despachar(datos['tipo'])
+        elif canal == CANAL_LIBERADOS:
+            logger.debug("Recurso %s liberado (%s plazas libres)", datos['id'], datos['libres'])
+            self._agotados.discard(datos['tipo'])
+            self._despachar(datos['tipo'], datos['lat'], datos['lon'])
+
+    def _despachar(self, tipo: str, latitud: float = None, longitud: float = None):
+        """Asigna pendientes del tipo mientras haya alguna y quede recurso"""
+        bloqueadas = set()
+        while True:
+            alerta = self.cola.elegir(tipo, latitud, longitud, bloqueadas)
+            if alerta is None:
+                return
+
+            with METRICAS.cronometro('etapa_segundos', etapa='reasignacion'):
+                recurso = self.sistema.reasignar_alerta(
+                    alerta['id'], alerta['tipo'], alerta['lat'], alerta['lon']
+                )
+
+            if recurso is None:
+                METRICAS.incrementar('reasignaciones_total', resultado='sin_recurso')
+                self._agotados.add(tipo)
+                return
+
+            if recurso == ALERTA_BLOQUEADA:
+                # Sigue pendiente: se queda en la cola para el siguiente aviso
+                METRICAS.incrementar('reasignaciones_total', resultado='bloqueada')
+                bloqueadas.add(alerta['id'])
+                continue
+
+            self.cola.quitar(alerta['id'])
+            if recurso is False:
+                # Ya asignada o resuelta
+                METRICAS.incrementar('reasignaciones_total', resultado='descartada')
+                continue
+
+            self.reasignadas += 1
+            espera = time.time() - alerta['fecha']
+            METRICAS.incrementar('reasignaciones_total', resultado='asignada')
+            METRICAS.observar('reasignacion_espera_segundos', espera)
+            logger.info(
+                f"Alerta {alerta['id']} reasignada a {recurso['nombre']} "
+                f"tras {espera:.0f}s pendiente"
+            )
+
+
+def signal_handler(sig, frame):
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    from metricas import configurar_registro
+
+    signal.signal(signal.SIGINT, signal_handler)
+    escucha_log = configurar_registro(logging.INFO, 'reasignacion.log')
+
+    try:
+        from config import DB_CONFIG
+    except ImportError:
+        print("Error: No se encontro config.py")
+        sys.exit(1)
+
+    reasignador = Reasignador(DB_CONFIG)
+    try:
+        if not reasignador.iniciar():
+            logger.error("No se pudo conectar a BD")
+            sys.exit(1)
+        threading.Event().wait()
+    finally:
+        reasignador.detener()
+        escucha_log.stop()
@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+"""
+Reimportacion masiva de uplinks de ChirpStack desde un fichero JSONL
+
+Lee el fichero linea a linea (sin cargarlo en memoria; admite .gz y '-'
+para la entrada estandar), decodifica los payloads por lotes con
+PayloadDecoder.decode_batch y los registra en BD. Un uplink ya registrado
+(uplinks_procesados) no se vuelve a importar, asi que la reimportacion se
+puede repetir o reanudar sin duplicar alertas mientras siga dentro de
+dedup_ventana_segundos: retencion.py borra los uplinks mas antiguos y
+repetirla despues duplicaria las alertas. Los uplinks sin fCnt (clave por
+huella del payload, ver deduplicacion.clave_persistente) no se registran
+y entran siempre.
+
+Modos:
+    en vivo (por defecto): tras una caida, las alertas perdidas pasan por
+        SistemaEmergencias.procesar_lote, como las del listener: se
+        registran ahora y se asignan respetando la capacidad.
+    --historico: carga con COPY a una tabla temporal y de ahi a alertas,
+        con la fecha del uplink en lugar de CURRENT_TIMESTAMP y en estado
+        'resuelta'. Con --asignar cada alerta recibe el recurso de su tipo
+        mas cercano (sin mirar disponibilidad, que en el pasado no se
+        conoce) con los triggers desactivados (session_replication_role),
+        para no ocupar la capacidad actual de los recursos: requiere un
+        usuario con permiso para cambiarlo (superusuario). Siempre
+        'resuelta': una alerta historica abierta la recogeria el motor de
+        reasignacion, y al resolverla liberar_recurso devolveria una plaza
+        que nunca se ocupo.
+
+Uso:
+    python reimportar.py eventos.jsonl
+    python reimportar.py eventos.jsonl.gz --historico --asignar --lote 50000
+"""
+
+import argparse
+import gzip
+import io
+import itertools
+import json
+import os
+import sys
+import time
+
+if sys.platform == 'win32':
+    os.environ['PGCLIENTENCODING'] = 'UTF8'
+    os.environ['PYTHONIOENCODING'] = 'utf-8'
+
+from decoder import PayloadDecoder
+from deduplicacion import clave_persistente, clave_uplink
+
+# Tabla temporal de paso para COPY (se vacia en cada commit)
+CREAR_TABLA_PASO = """
+    CREATE TEMP TABLE IF NOT EXISTS reimportacion (
+        uplink_id VARCHAR(100),
+        dispositivo_id VARCHAR(50) NOT NULL,
+        tipo tipo_emergencia NOT NULL,
+        longitud DOUBLE PRECISION NOT NULL,
+        latitud DOUBLE PRECISION NOT NULL,
+        fecha TIMESTAMPTZ
+    ) ON COMMIT DELETE ROWS
+"""
+
+# Uplinks nuevos -> alertas, en una sola sentencia. El id de la alerta se
+# reserva al registrar el uplink para poder enlazar ambas tablas; los que no
+# tienen clave persistente (uplink_id NULL) van directos a alertas
+CONSULTA_HISTORICO = """
+    WITH nuevos AS (
+        INSERT INTO uplinks_procesados (uplink_id, alerta_id)
+        SELECT uplink_id, nextval(%(secuencia)s::regclass)
+        FROM reimportacion
+        WHERE uplink_id IS NOT NULL
+        ON CONFLICT (uplink_id) DO NOTHING
+        RETURNING uplink_id, alerta_id
+    ),
+    insertadas AS (
+        INSERT INTO alertas (
+            id, dispositivo_id, tipo, ubicacion, estado,
+            fecha_creacion, fecha_ultima_actividad
+        )
+        SELECT
+            COALESCE(n.alerta_id, nextval(%(secuencia)s::regclass)),
+            r.dispositivo_id,
+            r.tipo,
+            ST_SetSRID(ST_MakePoint(r.longitud, r.latitud), 4326),
+            'resuelta',
+            COALESCE(r.fecha::TIMESTAMP, CURRENT_TIMESTAMP),
+            COALESCE(r.fecha::TIMESTAMP, CURRENT_TIMESTAMP)
+        FROM reimportacion r
+        LEFT JOIN nuevos n ON n.uplink_id = r.uplink_id
+        WHERE r.uplink_id IS NULL OR n.uplink_id IS NOT NULL
+        RETURNING id, tipo, ubicacion, fecha_creacion
+    )
+"""
+
+# Recurso del tipo mas cercano a cada alerta insertada (KNN + distancia exacta)
+ASIGNAR_HISTORICO = """
+    ,
+    asignadas AS (
+        INSERT INTO asignaciones (
+            alerta_id,
+            punto_emergencia_id,
+            distancia_metros,
+            tiempo_estimado_segundos,
+            fecha_asignacion
+        )
+        SELECT a.id, c.id, c.distancia_metros, c.tiempo_estimado_segundos, a.fecha_creacion
+        FROM insertadas a
+        CROSS JOIN LATERAL (
+            SELECT
+                id,
+                distancia_metros,
+                (
+                    (distancia_metros / 1000.0) /
+                    (velocidad_promedio_kmh / 60.0) * 60 +
+                    tiempo_preparacion_segundos
+                )::INTEGER AS tiempo_estimado_segundos
+            FROM (
+                SELECT
+                    pe.*,
+                    ST_Distance(pe.ubicacion::geography, a.ubicacion::geography) AS distancia_metros
+                FROM (
+                    SELECT *
+                    FROM puntos_emergencia
+                    WHERE tipo = a.tipo
+                    ORDER BY ubicacion <-> a.ubicacion
+                    LIMIT %(candidatos)s
+                ) pe
+            ) candidatos
+            ORDER BY distancia_metros
+            LIMIT 1
+        ) c
+        RETURNING 1
+    ),
+    -- Sin triggers tampoco se suma al mapa de calor (acumular_mapa)
+    mapa AS (
+        INSERT INTO mapa_alertas (hora, tipo, x, y, total)
+        SELECT
+            date_trunc('hour', fecha_creacion),
+            tipo,
+            celda_mapa(ST_X(ubicacion)),
+            celda_mapa(ST_Y(ubicacion)),
+            COUNT(*)
+        FROM insertadas
+        GROUP BY 1, 2, 3, 4
+        ORDER BY 1, 2, 3, 4
+        ON CONFLICT (hora, tipo, x, y) DO UPDATE
+        SET total = mapa_alertas.total + EXCLUDED.total
+    )
+    SELECT
+        (SELECT COUNT(*) FROM insertadas) AS alertas,
+        (SELECT COUNT(*) FROM asignadas) AS asignadas
+"""
+
+SIN_ASIGNAR = """
+    SELECT (SELECT COUNT(*) FROM insertadas) AS alertas, 0 AS asignadas
+"""
+
+
+def leer_lineas(ruta: str):
+    """Lineas del fichero, de una en una ('-' = entrada estandar)"""
+    if ruta == '-':
+        yield from sys.stdin.buffer
+        return
+    abrir = gzip.open if ruta.endswith('.gz') else open
+    with abrir(ruta, 'rb') as f:
+        yield from f
+
+
+def campos_evento(evento: dict) -> tuple:
+    """
+    (devEUI, payload, uplink_id, fecha) de un evento de uplink de ChirpStack
+    (formato v3 o v4). uplink_id es None si no hay clave persistente (sin
+    fCnt); la fecha es el texto ISO 8601 tal cual, o None.
+    """
+    dispositivo = evento.get('deviceInfo') or {}
+    dev_eui = evento.get('devEUI') or dispositivo.get('devEui') or evento.get('deviceName', 'unknown')
+
+    fecha = evento.get('time') or evento.get('publishedAt')
+    if not fecha:
+        for rx in evento.get('rxInfo') or ():
+            fecha = rx.get('time') or rx.get('gwTime')
+            if fecha:
+                break
+
+    return dev_eui, evento.get('data', ''), clave_persistente(clave_uplink(dev_eui, evento)), fecha
+
+
+def _copiar(valor) -> str:
+    """Valor en el formato de texto de COPY"""
+    if valor is None:
+        return '\\N'
+    return str(valor).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class Reimportador:
+    """Decodifica y registra trozos de `lote` eventos, con contadores de progreso"""
+
+    def __init__(self, db_config: dict, historico: bool = False, asignar: bool = False,
+                 lote: int = 10000):
+        self.db_config = db_config
+        self.historico = historico
+        self.asignar = asignar
+        self.lote = lote
+        self.decoder = PayloadDecoder()
+        self.conn = None
+        self.sistema = None
+
+        # Contadores
+        self.eventos = 0
+        self.invalidos = 0
+        self.duplicados = 0
+        self.alertas = 0
+        self.asignadas = 0
+
+    def conectar(self):
+        if self.historico:
+            import psycopg2
+
+            self.conn = psycopg2.connect(
+                host=self.db_config['host'],
+                port=self.db_config.get('port', 5432),
+                database=self.db_config['database'],
+                user=self.db_config['user'],
+                password=self.db_config['password'],
+                options='-c client_encoding=UTF8'
+            )
+            with self.conn.cursor() as cursor:
+                cursor.execute(CREAR_TABLA_PASO)
+                cursor.execute("SELECT pg_get_serial_sequence('alertas', 'id')")
+                self.secuencia = cursor.fetchone()[0]
+            self.conn.commit()
+        else:
+            from integracion import SistemaEmergencias
+
+            # dedup_persistente: volver a importar el fichero no duplica alertas
+            self.sistema = SistemaEmergencias(dict(self.db_config, dedup_persistente=True))
+            if not self.sistema.conectar_bd():
+                raise RuntimeError("No se pudo conectar a BD")
+
+    def desconectar(self):
+        if self.conn is not None:
+            if self.historico and self.alertas:
+                # Estadisticas al dia tras una carga grande
+                self.conn.autocommit = True
+                with self.conn.cursor() as cursor:
+                    cursor.execute("ANALYZE alertas")
+                    if self.asignadas:
+                        cursor.execute("ANALYZE asignaciones")
+            self.conn.close()
+        if self.sistema is not None:
+            self.sistema.desconectar_bd()
+
+    def importar(self, lineas, progreso=None):
+        """Procesa las lineas por trozos; progreso(self) tras cada trozo"""
+        lineas = iter(lineas)
+        while True:
+            trozo = list(itertools.islice(lineas, self.lote))
+            if not trozo:
+                break
+            self._importar_trozo(trozo)
+            if progreso is not None:
+                progreso(self)
+
+    def _importar_trozo(self, lineas: list):
+        self.eventos += len(lineas)
+
+        eventos = []
+        for linea in lineas:
+            try:
+                eventos.append(campos_evento(json.loads(linea)))
+            except (ValueError, AttributeError):
+                # JSON invalido o que no es un objeto
+                self.invalidos += 1
+
+        lote = self.decoder.decode_batch([data for _, data, _, _ in eventos])
+        tipos = lote.tipos()
+
+        # Uplinks repetidos dentro del trozo (varios gateways): el primero
+        validos = []
+        vistos = set()
+        for i, (dev_eui, _, uplink_id, fecha) in enumerate(eventos):
+            if not lote.valido[i]:
+                self.invalidos += 1
+            elif uplink_id is not None and uplink_id in vistos:
+                self.duplicados += 1
+            else:
+                vistos.add(uplink_id)
+                validos.append(i)
+
+        if self.historico:
+            self._copiar_historico(eventos, lote, tipos, validos)
+        else:
+            self._procesar_en_vivo(eventos, lote, validos)
+
+    def _copiar_historico(self, eventos, lote, tipos, validos):
+        buffer = io.StringIO()
+        for i in validos:
+            dev_eui, _, uplink_id, fecha = eventos[i]
+            buffer.write(
+                f"{_copiar(uplink_id)}\t{_copiar(dev_eui)}\t{tipos[i]}\t"
+                f"{float(lote.longitud[i])!r}\t{float(lote.latitud[i])!r}\t{_copiar(fecha)}\n"
+            )
+        buffer.seek(0)
+
+        with self.conn.cursor() as cursor:
+            try:
+                if self.asignar:
+                    # Las asignaciones historicas no ocupan recursos hoy: sin triggers
+                    cursor.execute("SET LOCAL session_replication_role = replica")
+                cursor.copy_expert(
+                    "COPY reimportacion (uplink_id, dispositivo_id, tipo, longitud, latitud, fecha) FROM STDIN",
+                    buffer
+                )
+                # Particiones mensuales de las fechas importadas (si faltan)
+                cursor.execute("""
+                    SELECT crear_particiones(MIN(fecha::TIMESTAMP)::DATE, MAX(fecha::TIMESTAMP)::DATE)
+                    FROM reimportacion
+                """)
+                cursor.execute(
+                    CONSULTA_HISTORICO + (ASIGNAR_HISTORICO if self.asignar else SIN_ASIGNAR),
+                    {
+                        'secuencia': self.secuencia,
+                        'candidatos': self.db_config.get('knn_candidatos', 10)
+                    }
+                )
+                alertas, asignadas = cursor.fetchone()
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+        self.alertas += alertas
+        self.asignadas += asignadas
+        self.duplicados += len(validos) - alertas
+
+    def _procesar_en_vivo(self, eventos, lote, validos):
+        resultados = self.sistema.procesar_lote([
+            (eventos[i][0], lote.fila(i), eventos[i][2]) for i in validos
+        ])
+        for resultado in resultados:
+            if resultado.get('duplicado'):
+                self.duplicados += 1
+            elif resultado.get('alerta_id'):
+                self.alertas += 1
+                if resultado['exito']:
+                    self.asignadas += 1
+            else:
+                raise RuntimeError(f"Error registrando el lote: {resultado.get('error')}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reimportacion masiva de uplinks de ChirpStack (JSONL)")
+    parser.add_argument('ruta', help="fichero JSONL de eventos de uplink (.gz admitido, '-' = stdin)")
+    parser.add_argument('--historico', action='store_true',
+                        help="fecha del uplink, estado resuelta y carga con COPY")
+    parser.add_argument('--asignar', action='store_true',
+                        help="en modo historico, asignar el recurso mas cercano de cada tipo")
+    parser.add_argument('--lote', type=int, default=None,
+                        help="eventos por transaccion (50000 historico, 2000 en vivo)")
+    parser.add_argument('--intervalo', type=float, default=2.0, help="segundos entre lineas de progreso")
+    args = parser.parse_args()
+
+    if args.asignar and not args.historico:
+        parser.error("--asignar solo aplica con --historico (en vivo siempre se asigna)")
+
+    from config import DB_CONFIG
+
+    reimportador = Reimportador(
+        DB_CONFIG,
+        historico=args.historico,
+        asignar=args.asignar,
+        lote=args.lote or (50000 if args.historico else 2000)
+    )
+
+    print("\n" + "="*60)
+    print(f"REIMPORTACION {'HISTORICA' if args.historico else 'EN VIVO'}: {args.ruta}")
+    print("="*60)
+
+    inicio = time.monotonic()
+    ultimo = [inicio]
+
+    def progreso(r):
+        ahora = time.monotonic()
+        if ahora - ultimo[0] < args.intervalo:
+            return
+        ultimo[0] = ahora
+        print(f"  {r.eventos:>12,} eventos  {r.eventos / (ahora - inicio):>9,.0f} ev/s  "
+              f"alertas {r.alertas:,}  duplicados {r.duplicados:,}  invalidos {r.invalidos:,}",
+              flush=True)
+
+    reimportador.conectar()
+    try:
+        reimportador.importar(leer_lineas(args.ruta), progreso)
+    finally:
+        reimportador.desconectar()
+
+    segundos = time.monotonic() - inicio
+    r = reimportador
+    print(f"  Eventos: {r.eventos:,} en {segundos:.1f} s ({r.eventos / max(segundos, 1e-9):,.0f} ev/s)")
+    print(f"  Alertas: {r.alertas:,} (asignadas {r.asignadas:,}), duplicados: {r.duplicados:,}, "
+          f"invalidos: {r.invalidos:,}")
+    print("="*60)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n\nInterrumpido (lo ya confirmado queda en BD; volver a lanzar dentro de la "
+              "ventana de deduplicacion continua sin duplicar)")
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Mantenimiento de las particiones mensuales de alertas, asignaciones y
+telemetria
+
+Pensado para lanzarse a diario (cron o temporizador):
+
+    1. Crea por adelantado las particiones de los proximos meses, para que
+       las alertas nuevas no caigan en la particion por defecto.
+    2. Retira (DETACH) las particiones de los meses anteriores a la
+       ventana de retencion. Un mes con alertas abiertas, o con
+       asignaciones de alertas abiertas, se deja para la siguiente pasada:
+       liberar_recurso necesita la asignacion para devolver la plaza.
+       Las particiones retiradas se archivan en el esquema 'archivo'
+       (siguen consultables), se vuelcan a fichero y se borran, o solo se
+       borran.
+    3. Borra de uplinks_procesados (purgar_uplinks) los uplinks fuera de
+       la ventana de deduplicacion: ya no cuentan como duplicados.
+
+DETACH bloquea la tabla padre un instante: se usa lock_timeout para no
+dejar en espera las inserciones si hay una consulta larga; el mes que no
+se pueda retirar se reintenta en la siguiente pasada.
+
+Uso:
+    python retencion.py --conservar-meses 12
+    python retencion.py --conservar-meses 6 --volcar /var/backups/alertas
+
+La ventana de uplinks es dedup_ventana_segundos de DB_CONFIG.
+"""
+
+import argparse
+import datetime
+import gzip
+import logging
+import os
+import re
+import sys
+
+import psycopg2
+import psycopg2.errors
+from psycopg2 import sql
+
+if sys.platform == 'win32':
+    os.environ['PGCLIENTENCODING'] = 'UTF8'
+    os.environ['PYTHONIOENCODING'] = 'utf-8'
+
+logger = logging.getLogger(__name__)
+
+TABLAS = ('alertas', 'asignaciones', 'telemetria')
+ESQUEMA_ARCHIVO = 'archivo'
+
+_PARTICION = re.compile(r'^(alertas|asignaciones|telemetria)_(\d{4})_(\d{2})$')
+
+CONSULTA_PARTICIONES = """
+    SELECT c.relname
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = to_regclass(%s)
+"""
+
+# Alertas abiertas de la particion o con asignacion en ella (la telemetria no bloquea)
+CONSULTA_ABIERTAS = {
+    'alertas': "SELECT 1 FROM {particion} WHERE estado <> 'resuelta' LIMIT 1",
+    'asignaciones': """
+        SELECT 1
+        FROM alertas a
+        JOIN {particion} asg ON asg.alerta_id = a.id
+        WHERE a.estado <> 'resuelta'
+        LIMIT 1
+    """,
+    'telemetria': None
+}
+
+
+def restar_meses(fecha: datetime.date, meses: int) -> datetime.date:
+    """Primer dia del mes `meses` antes que el de `fecha`"""
+    total = fecha.year * 12 + fecha.month - 1 - meses
+    return datetime.date(total // 12, total % 12 + 1, 1)
+
+
+class Retencion:
+    """Crea las particiones proximas y retira las anteriores a `conservar_meses`"""
+
+    def __init__(self, db_config: dict, conservar_meses: int = 12, adelantar_meses: int = 3,
+                 volcar: str = None, borrar: bool = False, lock_timeout_ms: int = 5000):
+        self.db_config = db_config
+        self.ventana_uplinks = db_config.get('dedup_ventana_segundos', 86400)
+        self.conservar_meses = conservar_meses
+        self.adelantar_meses = adelantar_meses
+        self.volcar = volcar
+        self.borrar = borrar
+        self.lock_timeout_ms = lock_timeout_ms
+        self.conn = None
+
+        # Contadores
+        self.creadas = 0
+        self.retiradas = []
+        self.aplazadas = []
+        self.uplinks_purgados = 0
+
+    def conectar(self):
+        self.conn = psycopg2.connect(
+            host=self.db_config['host'],
+            port=self.db_config.get('port', 5432),
+            database=self.db_config['database'],
+            user=self.db_config['user'],
+            password=self.db_config['password'],
+            options='-c client_encoding=UTF8'
+        )
+        # Cada DETACH en su propia transaccion: el bloqueo dura lo minimo
+        self.conn.autocommit = True
+
+    def desconectar(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def ejecutar(self, hoy: datetime.date = None):
+        hoy = hoy or datetime.date.today()
+        with self.conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT crear_particiones(%s, %s)",
+                (hoy, restar_meses(hoy, -self.adelantar_meses))
+            )
+            self.creadas = cursor.fetchone()[0]
+        if self.creadas:
+            logger.info(f"Particiones creadas: {self.creadas}")
+
+        limite = restar_meses(hoy, self.conservar_meses)
+        for mes in self._meses_antiguos(limite):
+            self._retirar_mes(mes)
+
+        with self.conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT purgar_uplinks(make_interval(secs => %s))",
+                (self.ventana_uplinks,)
+            )
+            self.uplinks_purgados = cursor.fetchone()[0]
+        if self.uplinks_purgados:
+            logger.info(f"Uplinks purgados: {self.uplinks_purgados}")
+
+    def _meses_antiguos(self, limite: datetime.date) -> list:
+        """Meses con alguna particion anterior a `limite`, del mas antiguo al mas reciente"""
+        meses = set()
+        with self.conn.cursor() as cursor:
+            for tabla in TABLAS:
+                cursor.execute(CONSULTA_PARTICIONES, (tabla,))
+                for (particion,) in cursor.fetchall():
+                    encontrado = _PARTICION.match(particion)
+                    if encontrado:
+                        mes = datetime.date(int(encontrado.group(2)), int(encontrado.group(3)), 1)
+                        if mes < limite:
+                            meses.add(mes)
+        return sorted(meses)
+
+    def _retirar_mes(self, mes: datetime.date):
+        sufijo = mes.strftime('%Y_%m')
+        particiones = [(tabla, f"{tabla}_{sufijo}") for tabla in TABLAS]
+
+        with self.conn.cursor() as cursor:
+            for tabla, particion in particiones:
+                if CONSULTA_ABIERTAS[tabla] is None or not self._existe(cursor, particion, tabla):
+                    continue
+                cursor.execute(sql.SQL(CONSULTA_ABIERTAS[tabla]).format(particion=sql.Identifier(particion)))
+                if cursor.fetchone() is not None:
+                    logger.warning(f"{sufijo}: hay alertas abiertas, no se retira")
+                    self.aplazadas.append(sufijo)
+                    return
+
+            for tabla, particion in particiones:
+                if not self._existe(cursor, particion, tabla):
+                    continue
+                try:
+                    cursor.execute("SET lock_timeout = %s", (self.lock_timeout_ms,))
+                    cursor.execute(sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(
+                        sql.Identifier(tabla), sql.Identifier(particion)
+                    ))
+                except psycopg2.errors.LockNotAvailable:
+                    logger.warning(f"{particion}: {tabla} ocupada, se reintentara en la siguiente pasada")
+                    self.aplazadas.append(sufijo)
+                    return
+                finally:
+                    cursor.execute("RESET lock_timeout")
+
+                self._archivar(cursor, particion)
+                self.retiradas.append(particion)
+
+    def _existe(self, cursor, particion: str, tabla: str) -> bool:
+        """La particion existe y sigue colgando de la tabla"""
+        cursor.execute("""
+            SELECT 1
+            FROM pg_inherits
+            WHERE inhrelid = to_regclass(%s) AND inhparent = %s::regclass
+        """, (particion, tabla))
+        return cursor.fetchone() is not None
+
+    def _archivar(self, cursor, particion: str):
+        tabla = sql.Identifier(particion)
+
+        if self.volcar:
+            ruta = os.path.join(self.volcar, f"{particion}.copy.gz")
+            with gzip.open(ruta, 'wb') as f:
+                cursor.copy_expert(sql.SQL("COPY {} TO STDOUT").format(tabla).as_string(self.conn), f)
+            logger.info(f"{particion}: volcada en {ruta}")
+
+        if self.volcar or self.borrar:
+            cursor.execute(sql.SQL("DROP TABLE {}").format(tabla))
+            logger.info(f"{particion}: retirada y borrada")
+        else:
+            cursor.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {}").format(sql.Identifier(ESQUEMA_ARCHIVO)))
+            cursor.execute(sql.SQL("ALTER TABLE {} SET SCHEMA {}").format(tabla, sql.Identifier(ESQUEMA_ARCHIVO)))
+            logger.info(f"{particion}: retirada al esquema {ESQUEMA_ARCHIVO}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Particiones mensuales de alertas, asignaciones y telemetria")
+    parser.add_argument('--conservar-meses', type=int, default=12,
+                        help="meses completos que se mantienen ademas del actual")
+    parser.add_argument('--adelantar-meses', type=int, default=3,
+                        help="meses futuros con particion ya creada")
+    parser.add_argument('--volcar', metavar='DIRECTORIO',
+                        help="volcar cada particion retirada (COPY, gzip) y borrarla")
+    parser.add_argument('--borrar', action='store_true',
+                        help="borrar las particiones retiradas sin volcarlas")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.volcar:
+        os.makedirs(args.volcar, exist_ok=True)
+
+    from config import DB_CONFIG
+
+    retencion = Retencion(
+        DB_CONFIG,
+        conservar_meses=args.conservar_meses,
+        adelantar_meses=args.adelantar_meses,
+        volcar=args.volcar,
+        borrar=args.borrar
+    )
+    retencion.conectar()
+    try:
+        retencion.ejecutar()
+    finally:
+        retencion.desconectar()
+
+    print(f"Particiones creadas: {retencion.creadas}, retiradas: {len(retencion.retiradas)}, "
+          f"meses aplazados: {len(set(retencion.aplazadas))}, uplinks purgados: {retencion.uplinks_purgados}")
+
+
+if __name__ == "__main__":
+    main()
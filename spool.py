@@ -0,0 +1,410 @@
+"""
+Spool de alertas en disco
+Cada alerta decodificada se escribe primero en un fichero de solo anexado;
+un hilo aparte la registra en BD por lotes cuando la BD esta disponible.
+La recepcion no depende de que la BD responda.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+from metricas import METRICAS
+
+logger = logging.getLogger(__name__)
+
+EXTENSION = '.spool'
+CONFIRMADO = 'confirmado'
+RECHAZADOS = 'rechazados.jsonl'
+
+
+def _nombre_segmento(numero: int) -> str:
+    return f"{numero:012d}{EXTENSION}"
+
+
+class Spool:
+    """
+    Registro de alertas en segmentos de solo anexado (una linea JSON por
+    alerta) dentro de `directorio`.
+
+    Cada alerta se escribe con una sola llamada a os.write, asi que tras
+    escribir() sobrevive a una caida del proceso; la sincronizacion con el
+    disco (fsync) se agrupa cada `fsync_ms` para no pagarla por alerta.
+    Un corte de luz puede perder como mucho esa ventana.
+
+    El lector (un solo hilo, ver VaciadorSpool) avanza por los segmentos y
+    guarda su posicion en el fichero `confirmado`; los segmentos ya
+    confirmados se borran.
+    """
+
+    def __init__(self, directorio: str, fsync_ms: float = 50,
+                 max_segmento_bytes: int = 16 * 1024 * 1024):
+        self.directorio = directorio
+        self.fsync = fsync_ms / 1000.0
+        self.max_segmento_bytes = max_segmento_bytes
+        os.makedirs(directorio, exist_ok=True)
+
+        self._cond = threading.Condition()
+        self._cerrado = False
+
+        # Posicion confirmada (lo anterior ya esta en BD)
+        segmentos = self._segmentos()
+        self._confirmado = self._leer_confirmado(segmentos)
+        for numero in segmentos:
+            if numero < self._confirmado[0]:
+                os.remove(self._ruta(numero))
+
+        # Lectura: desde la posicion confirmada
+        self._leido = self._confirmado
+        self._lector = None
+        self._lector_numero = None
+        self._corruptas = set()
+
+        # Escritura: siempre en un segmento nuevo (el ultimo de la ejecucion
+        # anterior puede acabar en una linea a medias)
+        self._numero = max(segmentos + [self._confirmado[0]]) + 1
+        self._fd = None
+        self._escrito = 0
+        self._abrir_segmento(self._numero)
+        self._sucio = False
+        self._hilo_fsync = threading.Thread(target=self._sincronizar, name="spool-fsync", daemon=True)
+        self._hilo_fsync.start()
+
+        # Metricas
+        self.escritas = 0
+        self.confirmadas = 0
+        self.pendientes = sum(
+            1 for _ in self._recorrer_pendientes()
+        ) if segmentos else 0
+        if self.pendientes:
+            logger.info(f"Spool: {self.pendientes} alertas pendientes de una ejecucion anterior")
+
+    # Escritura
+
+    def escribir(self, registro: dict):
+        """Anade una alerta al spool (dict serializable a JSON)"""
+        linea = (json.dumps(registro, separators=(',', ':')) + '\n').encode('utf-8')
+        with self._cond:
+            if self._cerrado:
+                raise RuntimeError("Spool cerrado")
+            if self._escrito + len(linea) > self.max_segmento_bytes and self._escrito:
+                self._rotar()
+            os.write(self._fd, linea)
+            self._escrito += len(linea)
+            self._sucio = True
+            self.escritas += 1
+            self.pendientes += 1
+            self._cond.notify_all()
+
+    def cerrar(self):
+        with self._cond:
+            self._cerrado = True
+            self._cond.notify_all()
+        self._hilo_fsync.join()
+        with self._cond:
+            os.fsync(self._fd)
+            os.close(self._fd)
+            if self._lector is not None:
+                self._lector.close()
+
+    def _abrir_segmento(self, numero: int):
+        self._fd = os.open(self._ruta(numero), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._escrito = 0
+
+    def _rotar(self):
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._numero += 1
+        self._abrir_segmento(self._numero)
+
+    def _sincronizar(self):
+        """fsync agrupado: una llamada cada `fsync` segundos si hubo escrituras"""
+        while True:
+            with self._cond:
+                if self._cerrado:
+                    return
+                self._cond.wait(self.fsync)
+                if not self._sucio:
+                    continue
+                fd = self._fd
+                self._sucio = False
+            with METRICAS.cronometro('etapa_segundos', etapa='spool_fsync'):
+                try:
+                    os.fsync(fd)
+                except OSError:
+                    # Segmento rotado y cerrado entretanto (la rotacion ya hace fsync)
+                    pass
+
+    # Lectura
+
+    def leer(self, max_registros: int, timeout: float = None) -> tuple:
+        """
+        Siguientes registros sin confirmar, esperando hasta `timeout` si no hay
+
+        Returns:
+            (registros, posicion): la posicion se pasa a confirmar() cuando
+            los registros esten en BD. Registros vacio si vence el timeout
+        """
+        with self._cond:
+            limite = None if timeout is None else time.monotonic() + timeout
+            while not self._hay_pendientes():
+                restante = None if limite is None else limite - time.monotonic()
+                if self._cerrado or (restante is not None and restante <= 0):
+                    return [], self._leido
+                self._cond.wait(restante)
+            # Hasta donde hay lineas completas; se lee sin bloquear al escritor
+            ultimo, escrito = self._numero, self._escrito
+
+        registros = []
+        numero, offset = self._leido
+        while len(registros) < max_registros:
+            linea = self._leer_linea(numero, offset, escrito if numero == ultimo else None)
+            if linea is None:
+                if numero >= ultimo:
+                    break
+                # Segmento agotado: pasar al siguiente
+                numero, offset = numero + 1, 0
+                continue
+            try:
+                registros.append(json.loads(linea))
+            except ValueError:
+                self._descartar_corrupta(numero, offset)
+            offset += len(linea)
+
+        self._leido = (numero, offset)
+        return registros, self._leido
+
+    def releer(self):
+        """Vuelve a la posicion confirmada (tras un fallo al registrar)"""
+        self._leido = self._confirmado
+
+    def confirmar(self, posicion: tuple, n: int):
+        """Marca como registrado todo lo anterior a `posicion` (n registros)"""
+        anterior = self._confirmado[0]
+        self._confirmado = posicion
+        with self._cond:
+            self.confirmadas += n
+            self.pendientes -= n
+
+        # Escritura atomica de la posicion: un fallo deja la anterior.
+        # Sin fsync: si se pierde, se repiten alertas que la BD descarta
+        temporal = os.path.join(self.directorio, CONFIRMADO + '.tmp')
+        with open(temporal, 'w', encoding='utf-8') as f:
+            f.write(f"{posicion[0]} {posicion[1]}\n")
+        os.replace(temporal, os.path.join(self.directorio, CONFIRMADO))
+
+        for numero in range(anterior, posicion[0]):
+            if numero == self._lector_numero:
+                self._lector.close()
+                self._lector = self._lector_numero = None
+            try:
+                os.remove(self._ruta(numero))
+            except FileNotFoundError:
+                pass
+
+    def rechazar(self, registro: dict, motivo: str):
+        """Aparta un registro que la BD no acepta, para revisarlo a mano"""
+        with open(os.path.join(self.directorio, RECHAZADOS), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(dict(registro, motivo=motivo)) + '\n')
+        logger.error(f"Spool: alerta de {registro.get('dispositivo_id')} apartada en {RECHAZADOS} ({motivo})")
+
+    def metricas(self) -> dict:
+        with self._cond:
+            return {
+                'pendientes': self.pendientes,
+                'escritas': self.escritas,
+                'confirmadas': self.confirmadas,
+                'segmentos': self._numero - self._confirmado[0] + 1
+            }
+
+    def _descartar_corrupta(self, numero: int, offset: int):
+        # Una linea a medias tras un corte de luz: se cuenta una sola vez
+        # aunque se vuelva a leer tras un fallo
+        if (numero, offset) in self._corruptas:
+            return
+        self._corruptas.add((numero, offset))
+        with self._cond:
+            self.pendientes -= 1
+        logger.warning(f"Spool: linea corrupta en {_nombre_segmento(numero)}, ignorada")
+
+    def _hay_pendientes(self) -> bool:
+        numero, offset = self._leido
+        return numero < self._numero or offset < self._escrito
+
+    def _leer_linea(self, numero: int, offset: int, fin: int = None) -> bytes:
+        """Linea completa en `offset`, o None al final del segmento"""
+        if fin is not None and offset >= fin:
+            return None
+        if self._lector_numero != numero:
+            if self._lector is not None:
+                self._lector.close()
+            try:
+                self._lector = open(self._ruta(numero), 'rb')
+            except FileNotFoundError:
+                self._lector = self._lector_numero = None
+                return None
+            self._lector_numero = numero
+        self._lector.seek(offset)
+        linea = self._lector.readline()
+        if not linea.endswith(b'\n'):
+            # Final del segmento (o linea a medias tras un corte)
+            return None
+        return linea
+
+    def _recorrer_pendientes(self):
+        numero, offset = self._confirmado
+        while numero < self._numero:
+            linea = self._leer_linea(numero, offset)
+            if linea is None:
+                numero, offset = numero + 1, 0
+                continue
+            offset += len(linea)
+            yield linea
+
+    def _segmentos(self) -> list:
+        return sorted(
+            int(nombre[:-len(EXTENSION)])
+            for nombre in os.listdir(self.directorio)
+            if nombre.endswith(EXTENSION) and nombre[:-len(EXTENSION)].isdigit()
+        )
+
+    def _leer_confirmado(self, segmentos: list) -> tuple:
+        try:
+            with open(os.path.join(self.directorio, CONFIRMADO), encoding='utf-8') as f:
+                numero, offset = f.read().split()
+            return int(numero), int(offset)
+        except (FileNotFoundError, ValueError):
+            return (segmentos[0] if segmentos else 0), 0
+
+    def _ruta(self, numero: int) -> str:
+        return os.path.join(self.directorio, _nombre_segmento(numero))
+
+
+class VaciadorSpool:
+    """
+    Hilo que registra en BD las alertas del spool con
+    SistemaEmergencias.procesar_lote y confirma las que quedan registradas.
+
+    Exactamente una vez: cada alerta lleva su uplink_id y, con
+    dedup_persistente, una alerta que se repite tras un fallo (registrada
+    en BD pero aun no confirmada en el spool) se descarta como duplicada.
+
+    Si la BD no responde (SistemaEmergencias.bd_disponible) se reintenta
+    con espera exponencial, reconectando; mientras tanto el spool sigue
+    creciendo en disco. Si responde, el fallo es de la alerta de cabeza:
+    tras `max_reintentos` se aparta con Spool.rechazar.
+    """
+
+    def __init__(self, spool: Spool, sistema, procesar_resultado=None,
+                 max_lote: int = 100, max_reintentos: int = 10):
+        self.spool = spool
+        self.sistema = sistema
+        self.procesar_resultado = procesar_resultado
+        self.max_lote = max_lote
+        self.max_reintentos = max_reintentos
+
+        self.conectado = False
+        self._parar = threading.Event()
+        self._hilo = None
+        self._fallos_cabeza = 0
+
+        if not sistema.dedup_persistente:
+            logger.warning("Spool sin dedup_persistente: una alerta registrada justo antes "
+                           "de una caida puede registrarse dos veces al reanudar")
+
+    def iniciar(self):
+        self._hilo = threading.Thread(target=self._ejecutar, name="vaciador-spool", daemon=True)
+        self._hilo.start()
+
+    def detener(self, timeout: float = 10.0):
+        self._parar.set()
+        if self._hilo:
+            self._hilo.join(timeout)
+
+    def _conectar(self) -> bool:
+        espera = 1.0
+        while not self._parar.is_set():
+            if self.sistema.conectar_bd():
+                logger.info("Spool: BD disponible, registrando alertas pendientes")
+                return True
+            logger.warning(f"Spool: BD no disponible, reintento en {espera:.0f}s "
+                           f"({self.spool.pendientes} alertas en disco)")
+            self._parar.wait(espera)
+            espera = min(espera * 2, 30.0)
+        return False
+
+    def _ejecutar(self):
+        espera = 1.0
+        while not self._parar.is_set():
+            if not self.conectado:
+                self.conectado = self._conectar()
+                if not self.conectado:
+                    return
+
+            registros, posicion = self.spool.leer(self.max_lote, timeout=0.5)
+            if not registros:
+                continue
+
+            if self._registrar(registros, posicion):
+                espera = 1.0
+                continue
+
+            # Fallo: volver a leer desde lo confirmado tras esperar
+            self.spool.releer()
+            self._parar.wait(espera)
+            espera = min(espera * 2, 30.0)
+
+    def _registrar(self, registros: list, posicion: tuple) -> bool:
+        """Registra el lote; False si hay que reintentar desde lo confirmado"""
+        with METRICAS.cronometro('etapa_segundos', etapa='spool_lote'):
+            resultados = self.sistema.procesar_lote([
+                (r['dispositivo_id'], r['datos'], r.get('uplink_id')) for r in registros
+            ])
+
+        fallidos = [i for i, r in enumerate(resultados) if _fallo_bd(r)]
+        if fallidos and not self.sistema.bd_disponible():
+            # La BD no responde: reconectar antes de reintentar (no es
+            # culpa de la alerta de cabeza, no cuenta como fallo suyo)
+            logger.error(f"Spool: {len(fallidos)} de {len(registros)} alertas no registradas, BD caida")
+            self.sistema.desconectar_bd()
+            self.conectado = False
+            return False
+
+        ahora = time.time()
+        hasta = fallidos[0] if fallidos else len(registros)
+        for registro, resultado in zip(registros[:hasta], resultados[:hasta]):
+            if registro.get('recibido') is not None:
+                METRICAS.observar('extremo_segundos', ahora - registro['recibido'])
+            if self.procesar_resultado is not None:
+                self.procesar_resultado(resultado)
+
+        if not fallidos:
+            self._fallos_cabeza = 0
+            self.spool.confirmar(posicion, len(registros))
+            return True
+
+        # Con la BD respondiendo, el fallo es de la alerta: confirmar hasta
+        # el primer fallo y reintentar desde ahi. Si la misma alerta falla
+        # una y otra vez (aunque sea la unica del lote) se aparta para no
+        # bloquear las demas
+        self._confirmar_hasta(registros, hasta)
+        self._fallos_cabeza += 1
+        if self._fallos_cabeza >= self.max_reintentos:
+            self.spool.rechazar(registros[hasta], resultados[hasta].get('error'))
+            self._confirmar_hasta(registros, hasta + 1, desde=hasta)
+            self._fallos_cabeza = 0
+        return False
+
+    def _confirmar_hasta(self, registros: list, n: int, desde: int = 0):
+        """Confirma los n primeros registros leidos desde la posicion confirmada"""
+        if n <= desde:
+            return
+        self.spool.releer()
+        _, posicion = self.spool.leer(n - desde, timeout=0)
+        self.spool.confirmar(posicion, n - desde)
+
+
+def _fallo_bd(resultado: dict) -> bool:
+    return not resultado['exito'] and not resultado.get('alerta_id') and not resultado.get('duplicado')
@@ -0,0 +1,267 @@
+"""
+Supervisor de listeners en varios procesos
+Reparte el topic de uplinks entre N procesos ListenerLoRaWAN, cada uno con
+su pool de BD y su deduplicacion, y reinicia los que caen.
+
+Reparto:
+    compartida: suscripcion compartida MQTT ($share/<grupo>/<topic>); el
+        broker reparte los mensajes. No garantiza el orden por dispositivo
+        y los reenvios de un uplink pueden llegar a procesos distintos
+        (conviene dedup_persistente).
+    hash: todos los procesos se suscriben al topic y cada uno procesa solo
+        los dispositivos cuyo devEUI (sacado del topic) le corresponde. Los
+        mensajes de un dispositivo van siempre al mismo proceso. Dentro del
+        proceso, varios trabajadores o los carriles de prioridad los
+        reordenarian: con orden_por_dispositivo (por defecto) cada proceso
+        los atiende con un solo consumidor (el hilo MQTT, el acumulador de
+        micro-lotes o el vaciador del spool) y sin carriles. El paralelismo
+        lo dan los procesos.
+"""
+
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import zlib
+
+if sys.platform == 'win32':
+    os.environ['PGCLIENTENCODING'] = 'UTF8'
+    os.environ['PYTHONIOENCODING'] = 'utf-8'
+
+logger = logging.getLogger(__name__)
+
+COMPARTIDA = 'compartida'
+HASH = 'hash'
+REPARTOS = (COMPARTIDA, HASH)
+
+# Un proceso que cae antes de este tiempo cuenta como fallo seguido
+ESTABLE_SEGUNDOS = 60
+ESPERA_MAX = 60
+
+
+def dispositivo_de_topic(topic: str) -> str:
+    """devEUI de un topic de ChirpStack (application/<app>/device/<devEUI>/event/up)"""
+    partes = topic.split('/')
+    try:
+        return partes[partes.index('device') + 1]
+    except (ValueError, IndexError):
+        return topic
+
+
+def fragmento(topic: str, num_fragmentos: int) -> int:
+    """Proceso al que corresponde el dispositivo del topic (estable entre procesos)"""
+    return zlib.crc32(dispositivo_de_topic(topic).encode('utf-8')) % num_fragmentos
+
+
+class _FiltroFragmento:
+    """Filtro de topic para ListenerLoRaWAN (serializable para multiprocessing)"""
+
+    def __init__(self, indice: int, num_fragmentos: int):
+        self.indice = indice
+        self.num_fragmentos = num_fragmentos
+
+    def __call__(self, topic: str) -> bool:
+        return fragmento(topic, self.num_fragmentos) == self.indice
+
+
+def config_ordenada(procesamiento_config: dict) -> dict:
+    """
+    Copia de la configuracion con un solo consumidor por proceso, para que
+    los uplinks de cada dispositivo se atiendan en orden de llegada
+    """
+    config = dict(procesamiento_config or {})
+    if config.get('spool_directorio'):
+        # Un solo vaciador, en el orden del spool
+        return config
+    if config.get('carriles'):
+        logger.warning("Orden por dispositivo: carriles de prioridad desactivados")
+        config['carriles'] = None
+    if config.get('trabajadores', 0) > 0 and not config.get('lote_max'):
+        logger.warning(f"Orden por dispositivo: {config['trabajadores']} trabajadores por proceso "
+                       f"reordenarian los uplinks, se procesan en el hilo MQTT")
+        config['trabajadores'] = 0
+    return config
+
+
+def _interrumpir(sig, frame):
+    raise KeyboardInterrupt
+
+
+def _ejecutar_trabajador(indice, mqtt_config, db_config, procesamiento_config, filtro):
+    """Punto de entrada de cada proceso"""
+    from listener import ListenerLoRaWAN
+    from metricas import configurar_registro
+
+    escucha_log = configurar_registro(
+        logging.INFO,
+        f'sistema_emergencias.{indice}.log',
+        '%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    # El supervisor detiene con SIGTERM: cerrar igual que con Ctrl+C
+    signal.signal(signal.SIGTERM, _interrumpir)
+
+    # Cada proceso expone sus metricas en su propio puerto (base + indice)
+    # y tiene su propio spool; el motor de reasignacion solo va en el primero
+    procesamiento_config = dict(procesamiento_config or {})
+    if indice > 0:
+        procesamiento_config['motor_reasignacion'] = False
+    if procesamiento_config.get('puerto_metricas'):
+        procesamiento_config['puerto_metricas'] += indice
+    if procesamiento_config.get('spool_directorio'):
+        procesamiento_config['spool_directorio'] = os.path.join(
+            procesamiento_config['spool_directorio'], str(indice)
+        )
+
+    listener = ListenerLoRaWAN(mqtt_config, db_config, procesamiento_config, filtro)
+    try:
+        if listener.iniciar() is False:
+            sys.exit(1)
+    finally:
+        escucha_log.stop()
+
+
+class Supervisor:
+    """
+    Arranca `num_procesos` listeners y los mantiene vivos. Un proceso que
+    cae se reinicia con espera exponencial (1s, 2s, 4s... hasta 60s) si
+    vuelve a caer antes de ESTABLE_SEGUNDOS.
+    """
+
+    def __init__(self, mqtt_config: dict, db_config: dict,
+                 procesamiento_config: dict = None, num_procesos: int = None,
+                 reparto: str = HASH, grupo: str = 'sistema_emergencias'):
+        if reparto not in REPARTOS:
+            raise ValueError(f"Reparto desconocido: {reparto} (opciones: {', '.join(REPARTOS)})")
+
+        self.mqtt_config = mqtt_config
+        self.db_config = db_config
+        self.procesamiento_config = procesamiento_config
+        if reparto == HASH and (procesamiento_config or {}).get('orden_por_dispositivo', True):
+            self.procesamiento_config = config_ordenada(procesamiento_config)
+        self.num_procesos = num_procesos or os.cpu_count() or 1
+        self.reparto = reparto
+        self.grupo = grupo
+
+        # spawn: los procesos no heredan hilos ni conexiones del supervisor
+        self._contexto = multiprocessing.get_context('spawn')
+        self._procesos = [None] * self.num_procesos
+        self._arranques = [0.0] * self.num_procesos
+        self._esperas = [1.0] * self.num_procesos
+        self._reinicio = [0.0] * self.num_procesos
+        self._parar = False
+
+        # Metricas
+        self.reinicios = 0
+
+        if reparto == COMPARTIDA and not db_config.get('dedup_persistente'):
+            logger.warning("Reparto compartido sin dedup_persistente: un uplink reenviado "
+                           "puede procesarse en dos procesos")
+
+    def _config_trabajador(self, indice: int):
+        mqtt_config = dict(self.mqtt_config)
+        base = mqtt_config.get('client_id') or 'sistema_emergencias'
+        mqtt_config['client_id'] = f"{base}-{indice}"
+
+        if self.reparto == COMPARTIDA:
+            mqtt_config['topic'] = f"$share/{self.grupo}/{self.mqtt_config['topic']}"
+            filtro = None
+        else:
+            filtro = _FiltroFragmento(indice, self.num_procesos)
+
+        return mqtt_config, filtro
+
+    def _arrancar(self, indice: int):
+        mqtt_config, filtro = self._config_trabajador(indice)
+        proceso = self._contexto.Process(
+            target=_ejecutar_trabajador,
+            args=(indice, mqtt_config, self.db_config, self.procesamiento_config, filtro),
+            name=f"listener-{indice}"
+        )
+        proceso.start()
+        self._procesos[indice] = proceso
+        self._arranques[indice] = time.monotonic()
+        logger.info(f"Proceso listener-{indice} iniciado (pid {proceso.pid})")
+
+    def iniciar(self):
+        """Arranca los procesos y los vigila hasta detener()"""
+        logger.info(f"Supervisor: {self.num_procesos} procesos, reparto {self.reparto}")
+        for indice in range(self.num_procesos):
+            self._arrancar(indice)
+
+        try:
+            while not self._parar:
+                self._vigilar()
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            logger.info("Interrupcion recibida")
+        finally:
+            self.detener()
+
+    def _vigilar(self):
+        ahora = time.monotonic()
+        for indice, proceso in enumerate(self._procesos):
+            if proceso is not None and proceso.is_alive():
+                continue
+
+            if proceso is not None:
+                # Recien caido: programar el reinicio
+                vivo = ahora - self._arranques[indice]
+                if vivo >= ESTABLE_SEGUNDOS:
+                    self._esperas[indice] = 1.0
+                espera = self._esperas[indice]
+                self._esperas[indice] = min(espera * 2, ESPERA_MAX)
+                self._reinicio[indice] = ahora + espera
+                self._procesos[indice] = None
+                logger.error(f"Proceso listener-{indice} terminado (codigo {proceso.exitcode}) "
+                             f"tras {vivo:.0f}s, reinicio en {espera:.0f}s")
+                continue
+
+            if ahora >= self._reinicio[indice]:
+                self.reinicios += 1
+                self._arrancar(indice)
+
+    def detener(self, timeout: float = 10.0):
+        """Detiene los procesos (SIGTERM, y SIGKILL si no terminan a tiempo)"""
+        self._parar = True
+        vivos = [p for p in self._procesos if p is not None and p.is_alive()]
+        for proceso in vivos:
+            proceso.terminate()
+
+        limite = time.monotonic() + timeout
+        for proceso in vivos:
+            proceso.join(max(0.0, limite - time.monotonic()))
+            if proceso.is_alive():
+                logger.warning(f"Proceso {proceso.name} no termina, forzando")
+                proceso.kill()
+                proceso.join()
+
+        logger.info("Supervisor detenido")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    try:
+        import config
+        from config import DB_CONFIG, MQTT_CONFIG
+    except ImportError:
+        print("Error: No se encontro config.py")
+        sys.exit(1)
+
+    PROCESAMIENTO_CONFIG = getattr(config, 'PROCESAMIENTO_CONFIG', None) or {}
+
+    supervisor = Supervisor(
+        MQTT_CONFIG,
+        DB_CONFIG,
+        PROCESAMIENTO_CONFIG,
+        num_procesos=PROCESAMIENTO_CONFIG.get('procesos'),
+        reparto=PROCESAMIENTO_CONFIG.get('reparto', HASH),
+        grupo=PROCESAMIENTO_CONFIG.get('grupo_compartido', 'sistema_emergencias')
+    )
+    signal.signal(signal.SIGTERM, _interrumpir)
+    supervisor.iniciar()
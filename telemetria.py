@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+"""
+Registro de dispositivos y telemetria de bateria
+
+Cada uplink decodificado deja en memoria su bateria, flags y posicion:
+
+    - un buffer circular columnar (array.array por columna) que un hilo
+      vuelca cada pocos segundos a la tabla particionada telemetria con un
+      solo COPY
+    - el registro de dispositivos (ultimo uplink de cada devEUI), que se
+      guarda en la tabla dispositivos con un upsert por volcado
+
+Registrar es anadir una fila al buffer bajo un lock: la alerta no espera
+a la BD. Si la BD no responde el buffer se sigue llenando; al dar la
+vuelta se pierden las filas mas antiguas (telemetria_perdida_total). El
+registro de dispositivos no se pierde: se reintenta en el siguiente volcado.
+
+Esta inactivo hasta TELEMETRIA.iniciar(db_config) (ver 'telemetria' en
+PROCESAMIENTO_CONFIG); hasta entonces registrar no hace nada.
+
+Uso: python telemetria.py --bateria-baja 20
+"""
+
+import argparse
+import datetime
+import io
+import logging
+import os
+import sys
+import threading
+import time
+from array import array
+
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+
+from metricas import METRICAS
+
+if sys.platform == 'win32':
+    os.environ['PGCLIENTENCODING'] = 'UTF8'
+    os.environ['PYTHONIOENCODING'] = 'utf-8'
+
+logger = logging.getLogger(__name__)
+
+UPSERT_DISPOSITIVOS = """
+    INSERT INTO dispositivos (
+        dispositivo_id, primera_actividad, ultima_actividad,
+        ubicacion, bateria, flags, uplinks
+    )
+    SELECT
+        d.dispositivo_id,
+        d.primera_actividad,
+        d.ultima_actividad,
+        ST_SetSRID(ST_MakePoint(d.longitud, d.latitud), 4326),
+        d.bateria,
+        d.flags,
+        d.uplinks
+    FROM (VALUES %s) AS d (
+        dispositivo_id, primera_actividad, ultima_actividad,
+        latitud, longitud, bateria, flags, uplinks
+    )
+    ON CONFLICT (dispositivo_id) DO UPDATE SET
+        primera_actividad = LEAST(dispositivos.primera_actividad, EXCLUDED.primera_actividad),
+        uplinks = dispositivos.uplinks + EXCLUDED.uplinks,
+        -- Con varios procesos, el ultimo uplink gana
+        ultima_actividad = GREATEST(dispositivos.ultima_actividad, EXCLUDED.ultima_actividad),
+        ubicacion = CASE WHEN EXCLUDED.ultima_actividad >= dispositivos.ultima_actividad
+                         THEN EXCLUDED.ubicacion ELSE dispositivos.ubicacion END,
+        bateria = CASE WHEN EXCLUDED.ultima_actividad >= dispositivos.ultima_actividad
+                       THEN EXCLUDED.bateria ELSE dispositivos.bateria END,
+        flags = CASE WHEN EXCLUDED.ultima_actividad >= dispositivos.ultima_actividad
+                     THEN EXCLUDED.flags ELSE dispositivos.flags END
+"""
+
+CONSULTA_BATERIA_BAJA = """
+    SELECT
+        dispositivo_id,
+        bateria,
+        ultima_actividad,
+        ST_Y(ubicacion) AS latitud,
+        ST_X(ubicacion) AS longitud,
+        uplinks
+    FROM dispositivos
+    WHERE bateria <= %s
+    ORDER BY bateria, ultima_actividad
+"""
+
+
+class BufferCircular:
+    """
+    Filas de telemetria en columnas de tamano fijo. Las posiciones se
+    cuentan desde el arranque (escritas, confirmadas): leer no saca filas,
+    solo confirmar, para no perderlas si falla el volcado.
+    """
+
+    def __init__(self, capacidad: int):
+        self.capacidad = capacidad
+        self.dispositivo = [None] * capacidad
+        self.fecha = array('d', bytes(8 * capacidad))
+        self.latitud = array('d', bytes(8 * capacidad))
+        self.longitud = array('d', bytes(8 * capacidad))
+        self.bateria = array('B', bytes(capacidad))
+        self.flags = array('B', bytes(capacidad))
+
+        self.escritas = 0
+        self.confirmadas = 0
+        self.perdidas = 0
+
+    def __len__(self):
+        return self.escritas - self._inicio()
+
+    def poner(self, dispositivo_id: str, fecha: float, latitud: float, longitud: float,
+              bateria: int, flags: int):
+        if len(self) == self.capacidad:
+            self.perdidas += 1
+        i = self.escritas % self.capacidad
+        self.dispositivo[i] = dispositivo_id
+        self.fecha[i] = fecha
+        self.latitud[i] = latitud
+        self.longitud[i] = longitud
+        self.bateria[i] = bateria
+        self.flags[i] = flags
+        self.escritas += 1
+
+    def leer(self) -> tuple:
+        """(posicion final, filas pendientes como tuplas)"""
+        filas = []
+        for n in range(self._inicio(), self.escritas):
+            i = n % self.capacidad
+            filas.append((
+                self.dispositivo[i], self.fecha[i], self.latitud[i],
+                self.longitud[i], self.bateria[i], self.flags[i]
+            ))
+        return self.escritas, filas
+
+    def confirmar(self, hasta: int):
+        self.confirmadas = max(self.confirmadas, hasta)
+
+    def _inicio(self) -> int:
+        # Las filas sobrescritas antes de volcarse se saltan
+        return max(self.confirmadas, self.escritas - self.capacidad)
+
+
+class RegistroTelemetria:
+    """Buffer de telemetria y registro de dispositivos, con su hilo de volcado"""
+
+    def __init__(self):
+        self.activa = False
+        self.intervalo = 5.0
+        self.umbral_bateria = 20
+
+        self._lock = threading.Lock()
+        self._buffer = BufferCircular(1)
+        # dispositivo_id -> [primera, ultima, latitud, longitud, bateria, flags, uplinks]
+        self._dispositivos = {}
+        # Uplinks de cada dispositivo aun no guardados en la tabla dispositivos
+        self._sin_volcar = {}
+
+        self._db_config = None
+        self._conn = None
+        self._despertar = threading.Event()
+        self._parar = False
+        self._hilo = None
+
+    def iniciar(self, db_config: dict, capacidad: int = 100_000, intervalo: float = 5.0,
+                umbral_bateria: int = 20):
+        """Activa el registro y arranca el volcado periodico"""
+        if self.activa:
+            return
+        self._db_config = db_config
+        self._buffer = BufferCircular(capacidad)
+        self.intervalo = intervalo
+        self.umbral_bateria = umbral_bateria
+        self._parar = False
+        self.activa = True
+
+        METRICAS.medidor('telemetria_pendiente', lambda: len(self._buffer))
+        METRICAS.medidor('telemetria_perdida_total', lambda: self._buffer.perdidas)
+        METRICAS.medidor('dispositivos_bateria_baja', lambda: len(self.bateria_baja()))
+        self._hilo = threading.Thread(target=self._ejecutar, name="telemetria", daemon=True)
+        self._hilo.start()
+        logger.info(f"Telemetria activa: buffer de {capacidad} filas, volcado cada {intervalo:g}s")
+
+    def detener(self, timeout: float = 10.0):
+        """Vuelca lo pendiente y cierra la conexion"""
+        if not self.activa:
+            return
+        self.activa = False
+        self._parar = True
+        self._despertar.set()
+        if self._hilo:
+            self._hilo.join(timeout)
+        self._volcar()
+        self._desconectar()
+
+    def registrar(self, dispositivo_id: str, datos: dict, fecha: float = None):
+        """Anade la telemetria de un uplink decodificado (datos de PayloadDecoder.decode)"""
+        if not self.activa:
+            return
+        fecha = fecha or time.time()
+        with self._lock:
+            self._buffer.poner(
+                dispositivo_id, fecha, datos['latitud'], datos['longitud'],
+                datos['bateria'], datos.get('flags', 0)
+            )
+            registro = self._dispositivos.get(dispositivo_id)
+            if registro is None:
+                self._dispositivos[dispositivo_id] = [
+                    fecha, fecha, datos['latitud'], datos['longitud'],
+                    datos['bateria'], datos.get('flags', 0), 1
+                ]
+            elif fecha >= registro[1]:
+                registro[1:7] = [
+                    fecha, datos['latitud'], datos['longitud'],
+                    datos['bateria'], datos.get('flags', 0), registro[6] + 1
+                ]
+            else:
+                registro[6] += 1
+            self._sin_volcar[dispositivo_id] = self._sin_volcar.get(dispositivo_id, 0) + 1
+            lleno = len(self._buffer) >= self._buffer.capacidad // 2
+
+        if lleno:
+            self._despertar.set()
+
+    def dispositivo(self, dispositivo_id: str) -> dict:
+        """Ultimo uplink conocido del dispositivo en este proceso (None si no hay)"""
+        with self._lock:
+            registro = self._dispositivos.get(dispositivo_id)
+            if registro is None:
+                return None
+            return _registro(dispositivo_id, registro)
+
+    def bateria_baja(self, umbral: int = None) -> list:
+        """Dispositivos vistos por este proceso con bateria <= umbral, la mas baja primero"""
+        umbral = self.umbral_bateria if umbral is None else umbral
+        with self._lock:
+            bajos = [
+                _registro(dispositivo_id, registro)
+                for dispositivo_id, registro in self._dispositivos.items()
+                if registro[4] <= umbral
+            ]
+        bajos.sort(key=lambda d: d['bateria'])
+        return bajos
+
+    def _ejecutar(self):
+        while not self._parar:
+            self._despertar.wait(self.intervalo)
+            self._despertar.clear()
+            if not self._parar:
+                self._volcar()
+
+    def _volcar(self):
+        with self._lock:
+            hasta, filas = self._buffer.leer()
+            sin_volcar = self._sin_volcar
+            self._sin_volcar = {}
+            dispositivos = [
+                (dispositivo_id, *self._dispositivos[dispositivo_id][:6], uplinks)
+                for dispositivo_id, uplinks in sorted(sin_volcar.items())
+            ]
+        if not filas and not dispositivos:
+            return
+
+        try:
+            with METRICAS.cronometro('etapa_segundos', etapa='telemetria'):
+                self._guardar(filas, dispositivos)
+        except (psycopg2.Error, OSError) as e:
+            logger.warning(f"No se pudo volcar la telemetria ({len(filas)} filas): {e}")
+            self._desconectar()
+            # Las filas siguen en el buffer; los contadores de uplinks se devuelven
+            with self._lock:
+                for dispositivo_id, uplinks in sin_volcar.items():
+                    self._sin_volcar[dispositivo_id] = self._sin_volcar.get(dispositivo_id, 0) + uplinks
+            return
+
+        with self._lock:
+            self._buffer.confirmar(hasta)
+        METRICAS.incrementar('telemetria_filas_total', len(filas))
+        logger.debug("Telemetria volcada: %d filas, %d dispositivos", len(filas), len(dispositivos))
+
+    def _guardar(self, filas: list, dispositivos: list):
+        if self._conn is None:
+            self._conectar()
+
+        datos = io.StringIO()
+        for dispositivo_id, fecha, latitud, longitud, bateria, flags in filas:
+            datos.write(f"{_copiar(dispositivo_id)}\t{_marca(fecha)}\t{latitud!r}\t{longitud!r}\t{bateria}\t{flags}\n")
+        datos.seek(0)
+
+        try:
+            with self._conn.cursor() as cursor:
+                cursor.copy_expert(
+                    "COPY telemetria (dispositivo_id, fecha, latitud, longitud, bateria, flags) FROM STDIN",
+                    datos
+                )
+                execute_values(
+                    cursor, UPSERT_DISPOSITIVOS,
+                    [
+                        (d, _marca(primera), _marca(ultima), lat, lon, bat, flags, uplinks)
+                        for d, primera, ultima, lat, lon, bat, flags, uplinks in dispositivos
+                    ],
+                    page_size=1000
+                )
+            self._conn.commit()
+        except Exception:
+            self._conn.rollback()
+            raise
+
+    def _conectar(self):
+        self._conn = psycopg2.connect(
+            host=self._db_config['host'],
+            port=self._db_config.get('port', 5432),
+            database=self._db_config['database'],
+            user=self._db_config['user'],
+            password=self._db_config['password'],
+            options='-c client_encoding=UTF8'
+        )
+
+    def _desconectar(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except psycopg2.Error:
+                pass
+            self._conn = None
+
+
+def _copiar(valor: str) -> str:
+    """Texto en el formato de COPY"""
+    return valor.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _marca(fecha: float) -> str:
+    # Hora local, como CURRENT_TIMESTAMP en las columnas TIMESTAMP
+    return datetime.datetime.fromtimestamp(fecha).isoformat(' ')
+
+
+def _registro(dispositivo_id: str, registro: list) -> dict:
+    primera, ultima, latitud, longitud, bateria, flags, uplinks = registro
+    return {
+        'dispositivo_id': dispositivo_id,
+        'primera_actividad': primera,
+        'ultima_actividad': ultima,
+        'latitud': latitud,
+        'longitud': longitud,
+        'bateria': bateria,
+        'flags': flags,
+        'uplinks': uplinks
+    }
+
+
+TELEMETRIA = RegistroTelemetria()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dispositivos con bateria baja")
+    parser.add_argument('--bateria-baja', type=int, default=20, metavar='NIVEL',
+                        help="mostrar dispositivos con bateria <= NIVEL")
+    args = parser.parse_args()
+
+    from config import DB_CONFIG
+
+    conn = psycopg2.connect(
+        host=DB_CONFIG['host'],
+        port=DB_CONFIG.get('port', 5432),
+        database=DB_CONFIG['database'],
+        user=DB_CONFIG['user'],
+        password=DB_CONFIG['password'],
+        options='-c client_encoding=UTF8'
+    )
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(CONSULTA_BATERIA_BAJA, (args.bateria_baja,))
+            dispositivos = cursor.fetchall()
+    finally:
+        conn.close()
+
+    for d in dispositivos:
+        print(
+            f"{d['dispositivo_id']:<20} bateria {d['bateria']:>3}  "
+            f"ultimo uplink {d['ultima_actividad']:%Y-%m-%d %H:%M}  "
+            f"({d['latitud']:.5f}, {d['longitud']:.5f})  {d['uplinks']} uplinks"
+        )
+    print(f"{len(dispositivos)} dispositivos con bateria <= {args.bateria_baja}")
+
+
+if __name__ == "__main__":
+    main()
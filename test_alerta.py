@@ -21,6 +21,31 @@ def generar_payload(tipo, lat, lon, bateria=85):
     return base64.b64encode(payload_bytes).decode()
 
 
+def crear_mensaje(dev_eui, payload, f_cnt=None):
+    """Mensaje de uplink con el formato de ChirpStack"""
+    mensaje = {
+        "devEUI": dev_eui,
+        "fPort": 1,
+        "data": payload,
+        "rxInfo": [{
+            "rssi": -85,
+            "loRaSNR": 7.5,
+            "gatewayID": "0000000000000001"
+        }],
+        "txInfo": {
+            "frequency": 868100000,
+            "dr": 5
+        }
+    }
+    if f_cnt is not None:
+        mensaje["fCnt"] = f_cnt
+    return mensaje
+
+
+def topic_uplink(dev_eui):
+    return f"application/{APPLICATION_ID}/device/{dev_eui}/event/up"
+
+
 ALERTAS_PRUEBA = {
     '1': {
         'descripcion': 'Emergencia Medica',
@@ -61,23 +86,8 @@ def enviar_alerta(opcion: str):
     
     alerta = ALERTAS_PRUEBA[opcion]
     payload = generar_payload(alerta['tipo'], alerta['lat'], alerta['lon'])
-    topic = f"application/{APPLICATION_ID}/device/{alerta['dev_eui']}/event/up"
-    
-    # Formato ChirpStack
-    mensaje = {
-        "devEUI": alerta['dev_eui'],
-        "fPort": 1,
-        "data": payload,
-        "rxInfo": [{
-            "rssi": -85,
-            "loRaSNR": 7.5,
-            "gatewayID": "0000000000000001"
-        }],
-        "txInfo": {
-            "frequency": 868100000,
-            "dr": 5
-        }
-    }
+    topic = topic_uplink(alerta['dev_eui'])
+    mensaje = crear_mensaje(alerta['dev_eui'], payload)
     
     print(f"\nEnviando alerta: {alerta['descripcion']}")
     print(f"  Dispositivo: {alerta['dev_eui']}")
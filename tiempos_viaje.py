@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+"""
+Tiempos de viaje precalculados por carretera
+
+Etapa offline: a partir de un grafo de carreteras (CSV de tramos) calcula,
+para cada punto de emergencia, el tiempo de viaje hasta cada celda de una
+rejilla que cubre la zona de servicio (Dijkstra desde el recurso). El
+resultado se guarda en un fichero binario compacto (float32 por celda y
+recurso) que el sistema abre con mmap: consultar un tiempo es leer 4 bytes.
+
+En la asignacion, los candidatos KNN se reordenan por el tiempo de la
+rejilla mas el tiempo de preparacion del recurso; si la alerta cae fuera
+de la rejilla, la celda no es alcanzable o el recurso es posterior al
+fichero, se usa la formula de siempre (distancia en linea recta /
+velocidad_promedio_kmh).
+
+Formato del grafo (CSV con cabecera, un tramo recto por linea):
+    lon_origen,lat_origen,lon_destino,lat_destino,velocidad_kmh[,sentido_unico]
+Los extremos con las mismas coordenadas (6 decimales) son el mismo nodo.
+
+Uso:
+    python tiempos_viaje.py carreteras.csv --salida tiempos_viaje.bin
+    python tiempos_viaje.py carreteras.csv --bd --celda 0.002
+"""
+
+import argparse
+import csv
+import heapq
+import logging
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+
+from cache_recursos import distancia_haversine
+
+logger = logging.getLogger(__name__)
+
+MAGIA = b'TVIAJE01'
+# magia, lon_min, lat_min, celda, columnas, filas, recursos
+CABECERA = struct.Struct('<8sdddIII')
+TIEMPO = struct.Struct('<f')
+
+# Velocidad fuera de carretera (del tramo mas cercano al punto, a pie o pista)
+VELOCIDAD_CAMPO_KMH = 5.0
+
+
+class RejillaTiempos:
+    """
+    Fichero de tiempos de viaje abierto con mmap (solo lectura).
+    Varios procesos que abren el mismo fichero comparten las paginas.
+    """
+
+    def __init__(self, ruta: str):
+        self.ruta = ruta
+        with open(ruta, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magia, self.lon_min, self.lat_min, self.celda, self.columnas, self.filas, num = \
+            CABECERA.unpack_from(self._mm, 0)
+        if magia != MAGIA:
+            raise ValueError(f"{ruta} no es un fichero de tiempos de viaje")
+
+        ids = array('i')
+        ids.frombytes(self._mm[CABECERA.size:CABECERA.size + 4 * num])
+        if sys.byteorder != 'little':
+            ids.byteswap()
+        self._posiciones = {recurso_id: k for k, recurso_id in enumerate(ids)}
+        self._inicio = CABECERA.size + 4 * num
+        self._celdas = self.columnas * self.filas
+
+        logger.info(f"Tiempos de viaje: {num} recursos, rejilla {self.columnas}x{self.filas} "
+                    f"de {self.celda} grados ({ruta})")
+
+    def tiempo(self, recurso_id: int, latitud: float, longitud: float) -> float:
+        """Segundos de viaje desde el recurso hasta el punto, o None si no se conoce"""
+        k = self._posiciones.get(recurso_id)
+        if k is None:
+            return None
+        columna = math.floor((longitud - self.lon_min) / self.celda)
+        fila = math.floor((latitud - self.lat_min) / self.celda)
+        if not (0 <= columna < self.columnas and 0 <= fila < self.filas):
+            return None
+
+        segundos = TIEMPO.unpack_from(
+            self._mm, self._inicio + 4 * (k * self._celdas + fila * self.columnas + columna)
+        )[0]
+        return None if math.isnan(segundos) else segundos
+
+    def cerrar(self):
+        self._mm.close()
+
+
+def ordenar_por_tiempo(rejilla: RejillaTiempos, candidatos: list,
+                       latitud: float, longitud: float) -> list:
+    """
+    Candidatos (filas con id, tiempo_preparacion_segundos y
+    tiempo_estimado_segundos) ordenados por tiempo estimado. Donde la
+    rejilla tiene dato, el tiempo estimado pasa a ser viaje por carretera
+    mas preparacion; si no, se queda el de la formula.
+    """
+    ordenados = []
+    for candidato in candidatos:
+        candidato = dict(candidato)
+        segundos = rejilla.tiempo(candidato['id'], latitud, longitud)
+        if segundos is not None:
+            candidato['tiempo_estimado_segundos'] = int(round(
+                segundos + candidato['tiempo_preparacion_segundos']
+            ))
+        ordenados.append(candidato)
+
+    ordenados.sort(key=lambda c: (c['tiempo_estimado_segundos'], c['distancia_metros']))
+    return ordenados
+
+
+# Construccion offline
+
+class _Grafo:
+    """Carreteras y celdas de la rejilla como un unico grafo de Dijkstra"""
+
+    def __init__(self, lon_min, lat_min, celda, columnas, filas, velocidad_campo_kmh):
+        self.lon_min = lon_min
+        self.lat_min = lat_min
+        self.celda = celda
+        self.columnas = columnas
+        self.filas = filas
+        self.campo = velocidad_campo_kmh / 3.6
+
+        # Nodos 0..C-1: centros de celda; a continuacion, nodos de carretera
+        self.coordenadas = [
+            (lon_min + (c + 0.5) * celda, lat_min + (f + 0.5) * celda)
+            for f in range(filas) for c in range(columnas)
+        ]
+        self.adyacentes = [[] for _ in self.coordenadas]
+        self._nodos = {}
+        self._por_celda = {}
+
+    def celda_de(self, lon, lat):
+        columna = math.floor((lon - self.lon_min) / self.celda)
+        fila = math.floor((lat - self.lat_min) / self.celda)
+        if 0 <= columna < self.columnas and 0 <= fila < self.filas:
+            return fila * self.columnas + columna
+        return None
+
+    def nodo(self, lon, lat):
+        clave = (round(lon, 6), round(lat, 6))
+        nodo = self._nodos.get(clave)
+        if nodo is None:
+            nodo = self._nodos[clave] = len(self.coordenadas)
+            self.coordenadas.append(clave)
+            self.adyacentes.append([])
+            celda = self.celda_de(*clave)
+            if celda is not None:
+                self._por_celda.setdefault(celda, []).append(nodo)
+        return nodo
+
+    def tramo(self, origen, destino, velocidad_kmh, sentido_unico=False):
+        (lon1, lat1), (lon2, lat2) = self.coordenadas[origen], self.coordenadas[destino]
+        segundos = distancia_haversine(lat1, lon1, lat2, lon2) / (velocidad_kmh / 3.6)
+        self.adyacentes[origen].append((destino, segundos))
+        if not sentido_unico:
+            self.adyacentes[destino].append((origen, segundos))
+
+    def enlazar_celdas(self):
+        """Cada celda con sus vecinas y con los nodos de carretera de su celda (a pie)"""
+        for celda in range(self.columnas * self.filas):
+            fila, columna = divmod(celda, self.columnas)
+            for df, dc in ((0, 1), (1, 0), (1, 1), (1, -1)):
+                f, c = fila + df, columna + dc
+                if 0 <= f < self.filas and 0 <= c < self.columnas:
+                    self._a_pie(celda, f * self.columnas + c)
+            for nodo in self._por_celda.get(celda, ()):
+                self._a_pie(celda, nodo)
+
+    def cercanos(self, lon, lat):
+        """Nodos de la celda del punto y de las 8 vecinas, con la celda misma"""
+        celda = self.celda_de(lon, lat)
+        if celda is None:
+            return []
+        fila, columna = divmod(celda, self.columnas)
+        nodos = []
+        for f in range(fila - 1, fila + 2):
+            for c in range(columna - 1, columna + 2):
+                if 0 <= f < self.filas and 0 <= c < self.columnas:
+                    vecina = f * self.columnas + c
+                    nodos.append(vecina)
+                    nodos.extend(self._por_celda.get(vecina, ()))
+        return nodos
+
+    def _a_pie(self, a, b):
+        (lon1, lat1), (lon2, lat2) = self.coordenadas[a], self.coordenadas[b]
+        segundos = distancia_haversine(lat1, lon1, lat2, lon2) / self.campo
+        self.adyacentes[a].append((b, segundos))
+        self.adyacentes[b].append((a, segundos))
+
+    def tiempos_desde(self, lon, lat) -> array:
+        """Segundos hasta cada celda desde (lon, lat) (NaN si no se alcanza)"""
+        distancias = {}
+        cola = []
+        for nodo in self.cercanos(lon, lat):
+            lon_n, lat_n = self.coordenadas[nodo]
+            segundos = distancia_haversine(lat, lon, lat_n, lon_n) / self.campo
+            if segundos < distancias.get(nodo, math.inf):
+                distancias[nodo] = segundos
+                heapq.heappush(cola, (segundos, nodo))
+
+        while cola:
+            segundos, nodo = heapq.heappop(cola)
+            if segundos > distancias[nodo]:
+                continue
+            for vecino, coste in self.adyacentes[nodo]:
+                total = segundos + coste
+                if total < distancias.get(vecino, math.inf):
+                    distancias[vecino] = total
+                    heapq.heappush(cola, (total, vecino))
+
+        nan = float('nan')
+        return array('f', (distancias.get(c, nan) for c in range(self.columnas * self.filas)))
+
+
+def leer_tramos(ruta: str):
+    """(lon1, lat1, lon2, lat2, velocidad_kmh, sentido_unico) de cada tramo del CSV"""
+    with open(ruta, newline='', encoding='utf-8') as f:
+        for fila in csv.DictReader(f):
+            yield (
+                float(fila['lon_origen']), float(fila['lat_origen']),
+                float(fila['lon_destino']), float(fila['lat_destino']),
+                float(fila['velocidad_kmh']),
+                fila.get('sentido_unico', '').strip().lower() in ('1', 'true', 'si')
+            )
+
+
+def puntos_desde_bd(db_config: dict) -> list:
+    import psycopg2
+
+    conn = psycopg2.connect(
+        host=db_config['host'],
+        port=db_config.get('port', 5432),
+        database=db_config['database'],
+        user=db_config['user'],
+        password=db_config['password'],
+        options='-c client_encoding=UTF8'
+    )
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT id, ST_X(ubicacion), ST_Y(ubicacion) FROM puntos_emergencia ORDER BY id")
+            return cursor.fetchall()
+    finally:
+        conn.close()
+
+
+def puntos_desde_sql(ruta: str) -> list:
+    """Puntos del script SQL (ids en orden de insercion, como en una BD recien creada)"""
+    from almacen_memoria import AlmacenMemoria
+
+    almacen = AlmacenMemoria()
+    almacen.cargar_sql(ruta)
+    return [(p['id'], p['lon'], p['lat']) for p in almacen.puntos.values()]
+
+
+def construir(tramos, puntos: list, salida: str, celda: float = 0.0025, caja: tuple = None,
+              velocidad_campo_kmh: float = VELOCIDAD_CAMPO_KMH, margen: float = 0.01):
+    """
+    Calcula la rejilla de tiempos de cada punto (id, lon, lat) y la escribe en `salida`
+
+    Args:
+        caja: (lon_min, lat_min, lon_max, lat_max); por defecto la que cubre
+            el grafo y los puntos, con `margen` grados alrededor
+    """
+    tramos = list(tramos)
+    if caja is None:
+        lons = [t[0] for t in tramos] + [t[2] for t in tramos] + [p[1] for p in puntos]
+        lats = [t[1] for t in tramos] + [t[3] for t in tramos] + [p[2] for p in puntos]
+        caja = (min(lons) - margen, min(lats) - margen, max(lons) + margen, max(lats) + margen)
+
+    lon_min, lat_min, lon_max, lat_max = caja
+    columnas = max(1, math.ceil((lon_max - lon_min) / celda))
+    filas = max(1, math.ceil((lat_max - lat_min) / celda))
+
+    grafo = _Grafo(lon_min, lat_min, celda, columnas, filas, velocidad_campo_kmh)
+    for lon1, lat1, lon2, lat2, velocidad, sentido_unico in tramos:
+        grafo.tramo(grafo.nodo(lon1, lat1), grafo.nodo(lon2, lat2), velocidad, sentido_unico)
+    grafo.enlazar_celdas()
+
+    # Se escribe a un temporal y se renombra: quien tenga abierto el
+    # fichero anterior con mmap sigue viendolo entero
+    temporal = salida + '.tmp'
+    with open(temporal, 'wb') as f:
+        f.write(CABECERA.pack(MAGIA, lon_min, lat_min, celda, columnas, filas, len(puntos)))
+        ids = array('i', (p[0] for p in puntos))
+        if sys.byteorder != 'little':
+            ids.byteswap()
+        f.write(ids.tobytes())
+        for _, lon, lat in puntos:
+            tiempos = grafo.tiempos_desde(lon, lat)
+            if sys.byteorder != 'little':
+                tiempos.byteswap()
+            f.write(tiempos.tobytes())
+    os.replace(temporal, salida)
+
+    return {'columnas': columnas, 'filas': filas, 'nodos': len(grafo.coordenadas) - columnas * filas}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rejilla de tiempos de viaje por carretera")
+    parser.add_argument('grafo', help="CSV de tramos de carretera")
+    parser.add_argument('--salida', default='tiempos_viaje.bin')
+    parser.add_argument('--bd', action='store_true', help="leer los recursos de puntos_emergencia")
+    parser.add_argument('--puntos', default='sistema_emergencias.sql',
+                        help="script SQL con los recursos (si no se usa --bd)")
+    parser.add_argument('--celda', type=float, default=0.0025, help="lado de celda en grados")
+    parser.add_argument('--caja', help="lon_min,lat_min,lon_max,lat_max (por defecto, la del grafo)")
+    parser.add_argument('--velocidad-campo', type=float, default=VELOCIDAD_CAMPO_KMH,
+                        help="km/h fuera de carretera")
+    args = parser.parse_args()
+
+    if args.bd:
+        from config import DB_CONFIG
+        puntos = puntos_desde_bd(DB_CONFIG)
+    else:
+        puntos = puntos_desde_sql(args.puntos)
+    caja = tuple(float(x) for x in args.caja.split(',')) if args.caja else None
+
+    print("\n" + "="*60)
+    print(f"TIEMPOS DE VIAJE: {args.grafo} -> {args.salida}")
+    print("="*60)
+
+    inicio = time.monotonic()
+    info = construir(leer_tramos(args.grafo), puntos, args.salida, args.celda, caja, args.velocidad_campo)
+
+    rejilla = RejillaTiempos(args.salida)
+    print(f"  Recursos: {len(puntos)}, nodos de carretera: {info['nodos']:,}")
+    print(f"  Rejilla: {info['columnas']}x{info['filas']} celdas de {args.celda} grados")
+    print(f"  Fichero: {os.path.getsize(args.salida) / 1e6:.1f} MB en {time.monotonic() - inicio:.1f} s")
+    rejilla.cerrar()
+    print("="*60)
+
+
+if __name__ == "__main__":
+    main()